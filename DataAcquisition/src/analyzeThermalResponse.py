@@ -0,0 +1,247 @@
+#!/usr/bin/python
+
+# line-source analysis of recorded thermal response tests, over as many runs as you give it, on all cores
+#   long after the heater comes on, the mean fluid temperature rises linearly with the logarithm of time:
+#       Tmean = Q / (4 pi k H) ln(t) + C
+#   so the ground's thermal conductivity is k = Q / (4 pi H slope), with the heater power Q = amps x volts
+#   and H the borehole depth.  the fit is made over everything after --start, and over sliding windows of
+#   --window samples, which shows whether the slope (and so k) has settled down
+#
+#       python analyzeThermalResponse.py --depth 150 ~/dataAcq/data-*.csv
+#       python analyzeThermalResponse.py --depth 150 --start 36000 --windows windows.csv ~/archive/*.daqz
+#
+# parsing a csv is most of the work, so the columns needed are cached (as .npz files, keyed by a hash
+#   of the file's contents) and a second run over the same files only has to hash them
+
+# OS interaction library imports
+import os
+import argparse
+import hashlib
+import multiprocessing
+
+import numpy
+
+from dataAcquisition import config
+from reprocessData import readHeader, numTimeColumns
+
+# bump this whenever what goes into the cache changes, so the old entries stop matching
+cacheVersion = 1
+
+def fileHash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as inFile:
+        while True:
+            block = inFile.read(1 << 20)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+def parseCsv(path):
+    # (seconds since starting, processed values with a column per channel, channel names, units)
+    with open(path, 'rb') as inFile:
+        summary, headerLine = readHeader(inFile)
+        columns = headerLine.strip().split(',')
+        processed = [c[len('Processed_'):] for c in columns if c.startswith('Processed_')]
+        names = [c[len('Bits_'):] for c in columns if c.startswith('Bits_')]
+        units = [p[len(name):] for name, p in zip(names, processed)]
+        first = numTimeColumns + 2 * len(names)
+        times = []
+        values = []
+        for line in inFile:
+            fields = line.rstrip('\r\n').split(',')
+            if len(fields) < numTimeColumns + 3 * len(names):
+                continue
+            times.append(fields[2])
+            values.append(fields[first:first + len(names)])
+    return (numpy.array(times, dtype=numpy.float64), numpy.array(values, dtype=numpy.float64).reshape(len(times), len(names)),
+            names, units)
+
+def parseArchive(path):
+    # the same from an archiveData.py archive
+    from archiveData import ArchiveReader
+    reader = ArchiveReader(path)
+    names = reader.channelNames()
+    data = reader.columns(['time'] + ['%s.value' % name for name in names])
+    reader.close()
+    values = numpy.column_stack([data['%s.value' % name] for name in names]) if names else numpy.empty((len(data['time']), 0))
+    return data['time'], values, names, [c.get('units', '') for c in reader.header['channels']]
+
+def loadRun(path, cacheDir):
+    # the parsed run, from the cache if this exact file has been parsed before
+    cachePath = None
+    if cacheDir is not None:
+        cachePath = os.path.join(cacheDir, '%s-v%s.npz' % (fileHash(path), cacheVersion))
+        if os.path.exists(cachePath):
+            cached = numpy.load(cachePath)
+            return cached['times'], cached['values'], list(cached['names']), list(cached['units'])
+    if path.endswith('.daqz'):
+        times, values, names, units = parseArchive(path)
+    else:
+        times, values, names, units = parseCsv(path)
+    if cachePath is not None:
+        # written under another name and renamed into place, so a half written entry is never picked up
+        partial = cachePath + '.%s.tmp' % os.getpid()
+        with open(partial, 'wb') as cacheFile:
+            numpy.savez(cacheFile, times=times, values=values, names=numpy.array(names), units=numpy.array(units))
+        os.rename(partial, cachePath)
+    return times, values, names, units
+
+def slidingFits(x, y, window, stride):
+    # least-squares line fits of y against x over every window of `window` points, `stride` points apart,
+    #   all at once from running sums; returns (first index, slope, intercept, r squared) arrays
+    #   the data are centred first, so the sums don't lose the slope to rounding on long runs
+    n = len(x)
+    if n < window or window < 2:
+        empty = numpy.empty(0)
+        return numpy.empty(0, dtype=numpy.intp), empty, empty, empty
+    xMean = x.mean()
+    yMean = y.mean()
+    xc = x - xMean
+    yc = y - yMean
+    def windowSums(a):
+        sums = numpy.concatenate(([0.0], numpy.cumsum(a)))
+        return sums[window:] - sums[:-window]
+    starts = numpy.arange(0, n - window + 1, stride)
+    sx = windowSums(xc)[starts]
+    sy = windowSums(yc)[starts]
+    sxx = windowSums(xc * xc)[starts]
+    sxy = windowSums(xc * yc)[starts]
+    syy = windowSums(yc * yc)[starts]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        varX = window * sxx - sx * sx
+        varY = window * syy - sy * sy
+        covXY = window * sxy - sx * sy
+        slopes = covXY / varX
+        intercepts = (sy - slopes * sx) / window + yMean - slopes * xMean
+        r2 = covXY * covXY / (varX * varY)
+    return starts, slopes, intercepts, r2
+
+def conductivity(slope, power, depth):
+    # line-source estimate, W/(m K) with the power in W, the depth in m and the slope in K per ln(s)
+    return power / (4 * numpy.pi * depth * slope)
+
+def toKelvinScale(units):
+    # the factor turning a temperature difference in these units into kelvin
+    return 5.0 / 9.0 if units.strip('[] ').upper() in ('F', 'DEGF') else 1.0
+
+# the analysis options, set in each worker process by initWorker
+workerOptions = None
+
+def initWorker(options):
+    global workerOptions
+    workerOptions = options
+
+def analyzeRun(path):
+    # the whole-run and sliding window fits of one recorded test, as a dictionary (with 'error' if it can't be done)
+    options = workerOptions
+    result = {'path': path}
+    try:
+        times, values, names, units = loadRun(path, options['cacheDir'])
+        columns = {}
+        for role in ('inlet', 'outlet', 'amps', 'volts'):
+            if options[role] not in names:
+                raise ValueError("no %s channel %s in the file" % (role, options[role]))
+            columns[role] = values[:, names.index(options[role])]
+        kelvins = toKelvinScale(units[names.index(options['inlet'])])
+        meanFluid = 0.5 * (columns['inlet'] + columns['outlet']) * kelvins
+        power = columns['amps'] * columns['volts']
+        # only samples with every input, and after the start of the fit (ln t needs t > 0 anyway)
+        keep = (times > max(0.0, options['start'])) & numpy.isfinite(meanFluid) & numpy.isfinite(power)
+        if options['end'] is not None:
+            keep &= times <= options['end']
+        times = times[keep]
+        meanFluid = meanFluid[keep]
+        power = power[keep]
+        lnTimes = numpy.log(times)
+        result['samples'] = len(times)
+        if len(times) < 2:
+            raise ValueError("fewer than 2 usable samples")
+        result['start'] = times[0]
+        result['end'] = times[-1]
+        result['power'] = power.mean()
+
+        first, slopes, intercepts, r2 = slidingFits(lnTimes, meanFluid, len(times), 1)
+        result['slope'] = slopes[0]
+        result['r2'] = r2[0]
+        result['conductivity'] = conductivity(slopes[0], result['power'], options['depth'])
+
+        # the sliding windows, each with the mean power over its own samples
+        window = min(options['window'], len(times))
+        stride = max(1, options['stride'])
+        first, slopes, intercepts, r2 = slidingFits(lnTimes, meanFluid, window, stride)
+        powerSums = numpy.concatenate(([0.0], numpy.cumsum(power)))
+        windowPower = (powerSums[first + window] - powerSums[first]) / window
+        result['windows'] = numpy.column_stack((times[first], times[first + window - 1], windowPower, slopes,
+                                                conductivity(slopes, windowPower, options['depth']), r2))
+    except (IOError, ValueError) as exception:
+        result['error'] = str(exception)
+    return result
+
+def analyzeRuns(paths, options, jobs):
+    # yields the result for each run as it is done (not necessarily in order)
+    if jobs == 1 or len(paths) == 1:
+        initWorker(options)
+        for path in paths:
+            yield analyzeRun(path)
+        return
+    pool = multiprocessing.Pool(jobs, initWorker, (options,))
+    try:
+        for result in pool.imap_unordered(analyzeRun, paths):
+            yield result
+    finally:
+        pool.terminate()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Line-source thermal conductivity fits of recorded thermal response tests')
+    parser.add_argument('files', nargs='+', help='data-*.csv files written by dataAcquisition.py, or .daqz archives of them')
+    parser.add_argument('--depth', type=float, required=True, help='active borehole depth in m')
+    parser.add_argument('--start', type=float, default=0.0, help='leave out the samples before this many seconds (the early, not yet line-source part)')
+    parser.add_argument('--end', type=float, help='and after this many seconds')
+    parser.add_argument('--window', type=int, default=200, help='samples per sliding window fit')
+    parser.add_argument('--stride', type=int, default=50, help='samples between the starts of sliding windows')
+    parser.add_argument('--inlet', default='HXInletTemp', help='the inlet temperature channel')
+    parser.add_argument('--outlet', default='HXOutletTemp', help='the outlet temperature channel')
+    parser.add_argument('--amps', default='HeaterAmps', help='the heater current channel')
+    parser.add_argument('--volts', default='HeaterVolts', help='the heater voltage channel')
+    parser.add_argument('--output', default='thermalResponse.csv', help='one line of results per run')
+    parser.add_argument('--windows', metavar='CSVFILE', help='also write every sliding window fit here')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='worker processes (default: all cores)')
+    parser.add_argument('--cache', default=os.path.join(config.baseDir(), 'analysis-cache'), help='where parsed runs are cached')
+    parser.add_argument('--no-cache', action='store_true', help="don't read or write the cache")
+    args = parser.parse_args()
+
+    cacheDir = None if args.no_cache else args.cache
+    if cacheDir is not None and not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    options = {'depth': args.depth, 'start': args.start, 'end': args.end, 'window': args.window, 'stride': args.stride,
+               'inlet': args.inlet, 'outlet': args.outlet, 'amps': args.amps, 'volts': args.volts, 'cacheDir': cacheDir}
+
+    results = []
+    for result in analyzeRuns(args.files, options, max(1, args.jobs)):
+        if 'error' in result:
+            print "%s: %s" % (result['path'], result['error'])
+        else:
+            print "%s: k = %.3f W/(m K), slope %.4f K/ln(s), power %.1f W, r2 %.4f, %s samples" % (
+                result['path'], result['conductivity'], result['slope'], result['power'], result['r2'], result['samples'])
+        results.append(result)
+    results.sort(key=lambda r: r['path'])
+
+    with open(args.output, 'wb') as outFile:
+        outFile.write("File,Samples,StartSeconds,EndSeconds,Power[W],Slope[K/ln(s)],Conductivity[W/(m K)],RSquared,Error\n")
+        for r in results:
+            if 'error' in r:
+                outFile.write("%s,,,,,,,,%s\n" % (r['path'], r['error'].replace(',', ';')))
+            else:
+                outFile.write("%s,%d,%.1f,%.1f,%.3f,%.6f,%.4f,%.6f,\n" % (
+                    r['path'], r['samples'], r['start'], r['end'], r['power'], r['slope'], r['conductivity'], r['r2']))
+    print "Wrote %s" % args.output
+
+    if args.windows:
+        with open(args.windows, 'wb') as outFile:
+            outFile.write("File,StartSeconds,EndSeconds,Power[W],Slope[K/ln(s)],Conductivity[W/(m K)],RSquared\n")
+            for r in results:
+                for row in r.get('windows', []):
+                    outFile.write("%s,%.1f,%.1f,%.3f,%.6f,%.4f,%.6f\n" % ((r['path'],) + tuple(row)))
+        print "Wrote %s" % args.windows
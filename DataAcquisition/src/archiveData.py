@@ -0,0 +1,366 @@
+#!/usr/bin/python
+
+# packs a recorded test into a compact archive for keeping and sending around: the data are stored
+#   column by column in chunks of rows, each column of each chunk byte-shuffled and zlib compressed on
+#   all cores, with an index of the chunks' time ranges so a reader only unpacks the chunks it needs
+#   the input can be a data-*.csv, a raw-*.daq capture or a store-* columnar store directory
+#
+#       python archiveData.py ~/dataAcq/data-20140101-120000.csv
+#       python archiveData.py --jobs 4 --output test.daqz ~/dataAcq/raw-20140101-120000.daq
+#       python archiveData.py --extract window.csv --start 3600 --end 7200 test.daqz
+#
+# the archive layout, all little-endian:
+#   8 byte magic, uint16 version, uint32 length of the json header, the json header itself (project info
+#   summary, channels, columns and where it came from), then the compressed column blocks, chunk after chunk,
+#   then the json chunk index, and last uint64 offset and uint32 length of the index and the magic again
+#   every index entry has the chunk's rows and time range, and per column the block's offset, length,
+#   stored dtype and scale (values are kept as integer multiples of the scale, nan as the smallest integer)
+
+# OS interaction library imports
+import sys
+import os
+import argparse
+import json
+import struct
+import zlib
+import multiprocessing
+from collections import deque
+from datetime import datetime
+
+import numpy
+
+from dataAcquisition import channels, IOStuff, RawCaptureFormat, ColumnarStoreReader
+from reprocessData import readHeader, channelNamesFromHeader, chunks, processorsFor, numTimeColumns
+
+magic = 'SDA12ARC'
+version = 1
+preamble = struct.Struct('<8sHI')
+trailer = struct.Struct('<QI8s')
+
+# what an integer column holds for nan
+missingInteger = numpy.iinfo(numpy.int32).min
+
+def shuffle(array):
+    # the first bytes of every value, then all the second bytes, and so on; neighbouring readings share
+    #   their high bytes, so this lines up long runs for zlib
+    array = numpy.ascontiguousarray(array)
+    return array.view(numpy.uint8).reshape(len(array), array.dtype.itemsize).T.tostring()
+
+def unshuffle(data, dtype):
+    dtype = numpy.dtype(dtype)
+    return numpy.frombuffer(data, dtype=numpy.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype).ravel()
+
+def encodeColumn(values, scale, level):
+    # (stored dtype, scale, compressed bytes) of one column of one chunk
+    #   with a scale the values go in as int32 multiples of it, unless they don't fit, then as float64
+    values = numpy.asarray(values)
+    if scale is not None:
+        scaled = numpy.round(numpy.asarray(values, dtype=numpy.float64) / scale)
+        finite = scaled[scaled == scaled]
+        if len(finite) == 0 or (finite.min() > missingInteger and finite.max() <= numpy.iinfo(numpy.int32).max):
+            stored = numpy.where(scaled == scaled, scaled, missingInteger).astype('<i4')
+            return '<i4', scale, zlib.compress(shuffle(stored), level)
+        values = values.astype('<f8')
+    return values.dtype.str, None, zlib.compress(shuffle(values), level)
+
+def decodeColumn(data, dtype, scale):
+    values = unshuffle(zlib.decompress(data), dtype)
+    if scale is None:
+        return values
+    decoded = values * scale
+    decoded[values == missingInteger] = float('nan')
+    return decoded
+
+# the source being archived, set in each worker process by initWorker: a dictionary with its 'kind'
+#   ('csv', 'raw' or 'store'), 'columns' (name, dtype, scale), the compression 'level', and for csv
+#   files the 'numChannels' and whether there's a 'quality' column, for raw captures the 'processors'
+workerSource = None
+
+def initWorker(source):
+    global workerSource
+    workerSource = source
+
+def csvColumns(lines):
+    # the columns of a chunk of data rows, blank or cut-off rows are skipped
+    numChannels = workerSource['numChannels']
+    width = numTimeColumns + 3 * numChannels + workerSource['quality']
+    rows = [line.rstrip('\r\n').split(',') for line in lines]
+    rows = [row for row in rows if len(row) >= width]
+    columns = {
+        'count': numpy.array([int(row[0]) for row in rows], dtype='<u4'),
+        'wall': numpy.array([IOStuff.parseTimeStamp(row[1]) for row in rows], dtype='<f8'),
+        'time': numpy.array([float(row[2]) for row in rows], dtype='<f8'),
+    }
+    if workerSource['quality']:
+        columns['quality'] = numpy.array([int(row[width - 1]) for row in rows], dtype='<u2')
+    data = numpy.array([row[numTimeColumns:numTimeColumns + 3 * numChannels] for row in rows], dtype=numpy.float64)
+    data = data.reshape(len(rows), 3 * numChannels)
+    for i in range(numChannels):
+        name = workerSource['channelNames'][i]
+        columns['%s.bits' % name] = data[:, i]
+        columns['%s.volts' % name] = data[:, numChannels + i]
+        columns['%s.value' % name] = data[:, 2 * numChannels + i]
+    return columns
+
+def rawColumns(records):
+    # the columns of a chunk of raw capture records, converted with the current conversions
+    bits, volts, values = channels.convertBatch(records['bits'], workerSource['processors'])
+    columns = {'count': records['count'], 'wall': records['wallTime'], 'time': records['elapsed']}
+    if 'quality' in records.dtype.names:
+        columns['quality'] = records['quality']
+    for i in range(len(workerSource['channelNames'])):
+        name = workerSource['channelNames'][i]
+        columns['%s.bits' % name] = bits[:, i]
+        columns['%s.volts' % name] = volts[:, i]
+        columns['%s.value' % name] = values[:, i]
+    return columns
+
+def encodeChunk(payload):
+    # parse (if need be) and compress one chunk: returns (rows, first time, last time, [(name, dtype, scale, bytes)])
+    if workerSource['kind'] == 'csv':
+        columns = csvColumns(payload)
+    elif workerSource['kind'] == 'raw':
+        columns = rawColumns(payload)
+    else:
+        columns = payload
+    times = columns['time']
+    if len(times) == 0:
+        return 0, None, None, []
+    blocks = []
+    for name, dtype, scale in workerSource['columns']:
+        storedType, storedScale, data = encodeColumn(numpy.asarray(columns[name], dtype=dtype), scale, workerSource['level'])
+        blocks.append((name, storedType, storedScale, data))
+    return len(times), float(times[0]), float(times[-1]), blocks
+
+def channelColumns(channelNames, decimals):
+    # bits, volts and value columns for each channel; the csv only has 3 decimals anyway,
+    #   so keeping that many costs nothing there and lets most values go in as small integers
+    scale = None if decimals is None else 10.0 ** -decimals
+    columns = []
+    for name in channelNames:
+        columns += [('%s.bits' % name, '<f8', scale), ('%s.volts' % name, '<f8', scale), ('%s.value' % name, '<f8', scale)]
+    return columns
+
+def openSource(inPath, chunkRows, decimals):
+    # returns (source description for the workers, header for the archive, iterator of chunk payloads, file to close)
+    if os.path.isdir(inPath):
+        store = ColumnarStoreReader(inPath)
+        names = store.channelNames()
+        columns = [('time', '<f8', None), ('wall', '<f8', None)]
+        if 'quality' in store.meta['columns']:
+            columns.append(('quality', '<u2', None))
+        columns += channelColumns(names, decimals)
+        source = {'kind': 'store', 'channelNames': names}
+        header = {'summary': store.meta['summary'], 'channels': store.meta['channels'], 'source': 'store'}
+        def storeChunks():
+            for first in range(0, store.rows, chunkRows):
+                yield dict((name, numpy.array(store.column(name)[first:first + chunkRows])) for name, dtype, scale in columns)
+        return source, columns, header, storeChunks(), None
+    inFile = open(inPath, 'rb')
+    if inFile.read(len(RawCaptureFormat.magic)) == RawCaptureFormat.magic:
+        inFile.seek(0)
+        rawHeader, rawFormat = RawCaptureFormat.readHeader(inFile)
+        names = [c['name'] for c in rawHeader['channels']]
+        columns = [('count', '<u4', None), ('time', '<f8', None), ('wall', '<f8', None)]
+        if rawFormat.version >= 2:
+            columns.append(('quality', '<u2', None))
+        columns += channelColumns(names, decimals)
+        source = {'kind': 'raw', 'channelNames': names, 'processors': processorsFor(names)}
+        header = {'summary': rawHeader['summary'], 'channels': rawHeader['channels'], 'source': 'raw'}
+        return source, columns, header, rawFormat.readRecords(inFile, chunkRows), inFile
+    inFile.seek(0)
+    summary, headerLine = readHeader(inFile)
+    names = channelNamesFromHeader(headerLine)
+    headerColumns = headerLine.strip().split(',')
+    quality = 'Quality' in headerColumns
+    # the units are glued onto the end of the Processed_ column names
+    units = [column[len('Processed_%s' % name):] for name, column in
+             zip(names, [c for c in headerColumns if c.startswith('Processed_')])]
+    columns = [('count', '<u4', None), ('time', '<f8', None), ('wall', '<f8', None)]
+    if quality:
+        columns.append(('quality', '<u2', None))
+    columns += channelColumns(names, decimals)
+    source = {'kind': 'csv', 'channelNames': names, 'numChannels': len(names), 'quality': quality}
+    header = {'summary': "".join(summary), 'channels': [{'name': n, 'units': u} for n, u in zip(names, units)], 'source': 'csv'}
+    return source, columns, header, chunks(inFile, chunkRows), inFile
+
+def archiveFile(inPath, outPath, jobs, chunkRows, decimals=3, level=6):
+    source, columns, header, payloads, inFile = openSource(inPath, chunkRows, decimals)
+    source['columns'] = columns
+    source['level'] = level
+    header['columns'] = [name for name, dtype, scale in columns]
+    header['created'] = datetime.now().isoformat()
+    header['from'] = os.path.basename(os.path.normpath(inPath))
+    index = []
+    try:
+        with open(outPath, 'wb') as outFile:
+            headerText = json.dumps(header)
+            outFile.write(preamble.pack(magic, version, len(headerText)) + headerText)
+
+            def writeChunk(encoded):
+                rows, timeStart, timeEnd, blocks = encoded
+                if rows == 0:
+                    return
+                entry = {'rows': rows, 'timeStart': timeStart, 'timeEnd': timeEnd, 'columns': {}}
+                for name, dtype, scale, data in blocks:
+                    entry['columns'][name] = [outFile.tell(), len(data), dtype, scale]
+                    outFile.write(data)
+                index.append(entry)
+
+            if jobs == 1:
+                initWorker(source)
+                for payload in payloads:
+                    writeChunk(encodeChunk(payload))
+            else:
+                # a couple of chunks per worker in flight keeps the memory bounded, and they're written in order
+                pool = multiprocessing.Pool(jobs, initWorker, (source,))
+                try:
+                    pending = deque()
+                    for payload in payloads:
+                        pending.append(pool.apply_async(encodeChunk, (payload,)))
+                        if len(pending) >= 2 * jobs:
+                            writeChunk(pending.popleft().get())
+                    while pending:
+                        writeChunk(pending.popleft().get())
+                finally:
+                    pool.terminate()
+
+            indexText = json.dumps({'chunks': index})
+            indexOffset = outFile.tell()
+            outFile.write(indexText)
+            outFile.write(trailer.pack(indexOffset, len(indexText), magic))
+    finally:
+        if inFile is not None:
+            inFile.close()
+
+class ArchiveReader():
+
+    # opens an archive; only the header and the chunk index are read up front, and each read only
+    #   unpacks the columns it asks for from the chunks that overlap the time range it asks for
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        fileMagic, fileVersion, length = preamble.unpack(self.file.read(preamble.size))
+        if fileMagic != magic or fileVersion > version:
+            raise ValueError("%s is not a version %s archive" % (path, version))
+        self.header = json.loads(self.file.read(length))
+        self.file.seek(-trailer.size, os.SEEK_END)
+        indexOffset, indexLength, endMagic = trailer.unpack(self.file.read(trailer.size))
+        if endMagic != magic:
+            raise ValueError("%s is cut off, it has no chunk index" % path)
+        self.file.seek(indexOffset)
+        self.chunks = json.loads(self.file.read(indexLength))['chunks']
+        self.rows = sum(chunk['rows'] for chunk in self.chunks)
+
+    def summary(self):
+        # the project information, as it is at the top of the csv
+        return self.header['summary']
+
+    def channelNames(self):
+        return [c['name'] for c in self.header['channels']]
+
+    def close(self):
+        self.file.close()
+
+    def chunksFor(self, startTime=None, endTime=None):
+        return [chunk for chunk in self.chunks
+                if (startTime is None or chunk['timeEnd'] >= startTime) and (endTime is None or chunk['timeStart'] <= endTime)]
+
+    def chunkColumns(self, chunk, names):
+        # {name: array} of the given columns of one chunk
+        result = {}
+        for name in names:
+            offset, length, dtype, scale = chunk['columns'][name]
+            self.file.seek(offset)
+            result[name] = decodeColumn(self.file.read(length), dtype, scale)
+        return result
+
+    def columns(self, names, startTime=None, endTime=None):
+        # {name: array} of the given columns ('time', 'wall', 'count', 'quality', '<channel>.bits', ...)
+        #   for the rows with startTime <= time <= endTime (all of them by default)
+        wanted = list(names)
+        if 'time' not in wanted:
+            wanted.append('time')
+        parts = [self.chunkColumns(chunk, wanted) for chunk in self.chunksFor(startTime, endTime)]
+        result = {}
+        for name in wanted:
+            result[name] = numpy.concatenate([part[name] for part in parts]) if parts else numpy.empty(0)
+        # trim the partly covered chunks at either end
+        times = result['time']
+        first = 0 if startTime is None else numpy.searchsorted(times, startTime, 'left')
+        last = len(times) if endTime is None else numpy.searchsorted(times, endTime, 'right')
+        return dict((name, result[name][first:last]) for name in names)
+
+    def read(self, channelName, startTime=None, endTime=None, kind='value'):
+        # (times, values) of one channel over a time window, like ColumnarStoreReader.read
+        #   kind is 'value', 'volts' or 'bits'
+        column = '%s.%s' % (channelName, kind)
+        result = self.columns(['time', column], startTime, endTime)
+        return result['time'], result[column]
+
+def sourceBytes(inPath):
+    # the size on disk of a file, or of all of a store directory's files
+    if os.path.isdir(inPath):
+        return sum(os.path.getsize(os.path.join(inPath, name)) for name in os.listdir(inPath))
+    return os.path.getsize(inPath)
+
+def extractCsv(archivePath, csvPath, startTime=None, endTime=None):
+    # write a time window of an archive back out in the usual data-*.csv layout
+    reader = ArchiveReader(archivePath)
+    names = reader.channelNames()
+    available = reader.header['columns']
+    quality = 'quality' in available
+    wanted = ['time', 'wall'] + [c for c in ('count', 'quality') if c in available]
+    for kind in ('bits', 'volts', 'value'):
+        wanted += ['%s.%s' % (name, kind) for name in names]
+    with open(csvPath, 'wb') as outFile:
+        outFile.write(IOStuff.formatHeaderString(reader.summary(), [(c['name'], c.get('units', '')) for c in reader.header['channels']], quality))
+        # a chunk at a time, so even a whole multi-day archive never has to fit in memory
+        for chunk in reader.chunksFor(startTime, endTime):
+            data = reader.chunkColumns(chunk, wanted)
+            keep = numpy.ones(len(data['time']), dtype=bool)
+            if startTime is not None:
+                keep &= data['time'] >= startTime
+            if endTime is not None:
+                keep &= data['time'] <= endTime
+            data = dict((name, values[keep]) for name, values in data.items())
+            counts = data['count'] if 'count' in data else numpy.arange(1, len(data['time']) + 1)
+            for i in range(len(data['time'])):
+                s_time = ",".join(IOStuff.formatTimes(counts[i], data['wall'][i], data['time'][i]))
+                s_bits = ",".join("%10.3f" % data['%s.bits' % name][i] for name in names)
+                s_volts = ",".join("%10.3f" % data['%s.volts' % name][i] for name in names)
+                s_vals = ",".join("%10.3f" % data['%s.value' % name][i] for name in names)
+                s = ",".join([s_time, s_bits, s_volts, s_vals])
+                if quality:
+                    s += ",%d" % data['quality'][i]
+                outFile.write(s + "\n")
+    reader.close()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Pack recorded tests into compressed archives, or pull a time window back out of one')
+    parser.add_argument('files', nargs='+', help='data-*.csv files, raw-*.daq captures or store-* directories (or an archive, with --extract)')
+    parser.add_argument('--output', help='archive file (only with a single input), default is <input>.daqz')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='worker processes compressing (default: all cores)')
+    parser.add_argument('--chunk-rows', type=int, default=16384, help='rows per chunk, the smallest piece a reader unpacks')
+    parser.add_argument('--decimals', type=int, default=3, help='decimals to keep of the channel columns (default 3, as in the csv)')
+    parser.add_argument('--full-precision', action='store_true', help='keep the channel columns as full float64 instead')
+    parser.add_argument('--level', type=int, default=6, help='zlib compression level, 1 (fastest) to 9 (smallest)')
+    parser.add_argument('--extract', metavar='CSVFILE', help='write the rows of an archive between --start and --end to a csv')
+    parser.add_argument('--start', type=float, help='with --extract, seconds since starting')
+    parser.add_argument('--end', type=float, help='with --extract, seconds since starting')
+    args = parser.parse_args()
+
+    if args.extract:
+        if len(args.files) > 1:
+            parser.error('--extract works on a single archive')
+        extractCsv(args.files[0], args.extract, args.start, args.end)
+        print "Wrote %s" % args.extract
+        sys.exit(0)
+
+    if args.output and len(args.files) > 1:
+        parser.error('--output only works with a single input file')
+    for inPath in args.files:
+        outPath = args.output or '%s.daqz' % os.path.splitext(os.path.normpath(inPath))[0]
+        archiveFile(inPath, outPath, max(1, args.jobs), args.chunk_rows, None if args.full_precision else args.decimals, args.level)
+        print "Wrote %s, %.1f%% of the size of %s" % (outPath, 100.0 * os.path.getsize(outPath) / sourceBytes(inPath), inPath)
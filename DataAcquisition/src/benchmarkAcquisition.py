@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+# benchmarks for the acquisition hot path: reading a scan, converting it, writing it and drawing it
+#   the serial reads go through the real DataReader against the simulated module (sda12Simulator),
+#   and the plot is drawn with the headless Agg backend, so this runs on any Linux box
+#
+#       python benchmarkAcquisition.py --output bench-new.json
+#       python benchmarkAcquisition.py --output bench-new.json --compare bench-old.json
+
+# the plot has to be headless, and this has to happen before anything imports pyplot
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# OS interaction library imports
+import sys
+import shutil
+import tempfile
+import platform
+import resource
+import argparse
+import json
+
+# general math and date/time based library imports
+import time
+from datetime import datetime
+
+import numpy
+
+import dataAcquisition
+from dataAcquisition import config, channels, AChannel, LinearCalibration, DataReader, IOStuff
+from channelDisplay import ChannelDisplay
+from sda12Simulator import SimulatedSDA12
+
+def maxResidentKB():
+    # peak resident memory of this process so far, linux reports it in kilobytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def setChannels(numChannels, numPlotted=2):
+    # replace the configured channels with a generic set of the given size
+    channels.Channels = [AChannel("Ch%02d" % i, LinearCalibration(0.0, 1.0), "[-]", plot=(i < numPlotted)) for i in range(numChannels)]
+    channels.DerivedChannels = []
+    channels.Devices = None
+
+def measure(stage, function, seconds, samplesPerCall, **details):
+    # call function repeatedly for about the given number of seconds and summarize the call latencies
+    memoryBefore = maxResidentKB()
+    latencies = []
+    start = time.time()
+    while time.time() - start < seconds or len(latencies) < 5:
+        t0 = time.time()
+        function()
+        latencies.append(time.time() - t0)
+    total = time.time() - start
+    latencies = numpy.array(latencies)
+    result = {
+        'stage': stage,
+        'calls': len(latencies),
+        'samplesPerSecond': samplesPerCall * len(latencies) / total,
+        'latency': dict(('p%s' % q, float(numpy.percentile(latencies, q))) for q in (50, 90, 99)),
+        'memoryGrowthKB': maxResidentKB() - memoryBefore,
+    }
+    result['latency']['max'] = float(latencies.max())
+    result.update(details)
+    print "%-16s %s  %10.0f samples/s  p50 %8.3f ms  p99 %8.3f ms  +%s kB" % (
+        stage, " ".join("%s=%s" % kv for kv in sorted(details.items())), result['samplesPerSecond'],
+        1000 * result['latency']['p50'], 1000 * result['latency']['p99'], result['memoryGrowthKB'])
+    return result
+
+class PlotView(ChannelDisplay):
+
+    # the GUI's table and plot drawing, on an Agg canvas instead of GTK
+    def __init__(self):
+        self.fig = matplotlib.figure.Figure(figsize=(6, 4), dpi=100)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.liststore = [[ch.name, float('nan'), float('nan'), ch.units, ''] for ch in channels.AllChannels()]
+        self.treeCache = [(float('nan'), float('nan'), ch.units, '') for ch in channels.AllChannels()]
+        self.initPlotLines()
+        # count the full redraws, everything else updatePlot does is a blit
+        self.fullDraws = 0
+        draw = self.canvas.draw
+        def countedDraw():
+            self.fullDraws += 1
+            draw()
+        self.canvas.draw = countedDraw
+
+def checkPlotRedraws(appends=500):
+    # samples coming in one at a time should only need the whole figure drawn when they leave the
+    #   limits, which double in span each time, so about log2(appends) times rather than every time
+    config.historyCapacity = 1000
+    setChannels(2)
+    view = PlotView()
+    for i in range(appends):
+        for ch in channels.Channels:
+            ch.Process(float(i), 2048 + i % 7)
+        view.updatePlot()
+    channels.Channels = []
+    print "updatePlot drew the whole figure %s times for %s appends" % (view.fullDraws, appends)
+    if view.fullDraws > 2 + 2 * numpy.log2(appends):
+        raise AssertionError("updatePlot redrew the whole figure %s times for %s appends" % (view.fullDraws, appends))
+
+def benchChannelCounts(channelCounts, seconds, baudRate):
+    results = []
+    for numChannels in channelCounts:
+        setChannels(numChannels)
+        for ch in channels.Channels:
+            ch.initData()
+
+        # a full scan through the serial port, against a simulated module answering as fast as it can
+        config.baudRate = baudRate
+        sim = SimulatedSDA12(baudRate, realTime=False)
+        reader = DataReader(sim.start())
+        results.append(measure('DoOneIteration', lambda: reader.DoOneIteration(1.0), seconds, numChannels, channels=numChannels))
+        reader.ser.close()
+        sim.stop()
+
+        # converting one reading
+        ch = channels.Channels[0]
+        results.append(measure('Process', lambda: ch.Process(1.0, 2048), seconds, 1, channels=numChannels))
+
+        # formatting and queueing one csv row (the background writer does the actual disk writes)
+        config.dataFormat = 'csv'
+        io = IOStuff()
+        io.issueHeaderString()
+        results.append(measure('issueReport', lambda: io.issueReport(1, time.time(), 1.0), seconds, numChannels, channels=numChannels))
+        io.close()
+
+        # refreshing the tree
+        view = PlotView()
+        results.append(measure('updateTree', view.updateTree, seconds, numChannels, channels=numChannels))
+    return results
+
+def benchHistoryLengths(historyLengths, seconds):
+    results = []
+    for historyLength in historyLengths:
+        # only the plotted channels matter here, so keep the set small to keep the memory down
+        config.historyCapacity = historyLength
+        setChannels(2)
+        times = numpy.arange(historyLength, dtype=numpy.float64)
+        for ch in channels.Channels:
+            ch.history.extend(times, numpy.sin(times / 1000.0))
+        del times
+        view = PlotView()
+        # the first call draws everything, later ones only redraw when the limits move
+        view.updatePlot()
+        view.fullDraws = 0
+        def appendAndPlot():
+            for ch in channels.Channels:
+                ch.Process(ch.history.lastTime() + 1, 2048)
+            view.updatePlot()
+        result = measure('updatePlot', appendAndPlot, seconds, 1, historyLength=historyLength)
+        result['fullDraws'] = view.fullDraws
+        print "%-16s %s of the %s calls drew the whole figure" % ('', view.fullDraws, result['calls'])
+        results.append(result)
+        channels.Channels = []
+    return results
+
+def compare(results, previousPath):
+    # line up stages by name and parameters and show how throughput moved
+    previous = json.load(open(previousPath))['results']
+    key = lambda r: (r['stage'], r.get('channels'), r.get('historyLength'))
+    before = dict((key(r), r) for r in previous)
+    print "\nCompared with %s:" % previousPath
+    for r in results:
+        if key(r) in before:
+            ratio = r['samplesPerSecond'] / before[key(r)]['samplesPerSecond']
+            flag = '  <-- slower' if ratio < 0.9 else ''
+            print "%-16s channels=%s historyLength=%s  %6.2fx%s" % (r['stage'], r.get('channels'), r.get('historyLength'), ratio, flag)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the data acquisition hot path')
+    parser.add_argument('--channels', default='5,16,32,64', help='comma separated channel counts')
+    parser.add_argument('--history', default='1000,100000,1000000,10000000', help='comma separated history lengths for the plot')
+    parser.add_argument('--seconds', type=float, default=1.0, help='time to spend measuring each case')
+    parser.add_argument('--baud', type=int, default=115200, help='baud rate to open the simulated port at')
+    parser.add_argument('--output', default='bench-%s.json' % datetime.now().strftime('%Y%m%d-%H%M%S'), help='results file')
+    parser.add_argument('--compare', help='an earlier results file to compare against')
+    args = parser.parse_args()
+
+    # keep the benchmark's files out of the real data directory
+    workDir = tempfile.mkdtemp(prefix='daqbench-')
+    config.baseDir = lambda: workDir
+    try:
+        checkPlotRedraws()
+        results = benchChannelCounts([int(x) for x in args.channels.split(',')], args.seconds, args.baud)
+        results += benchHistoryLengths([int(x) for x in args.history.split(',')], args.seconds)
+    finally:
+        shutil.rmtree(workDir, True)
+
+    with open(args.output, 'w') as outFile:
+        json.dump({
+            'created': datetime.now().isoformat(),
+            'python': sys.version.split()[0],
+            'numpy': numpy.__version__,
+            'platform': platform.platform(),
+            'results': results,
+        }, outFile, indent=2)
+    print "Wrote %s" % args.output
+
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+# the drawing side of the GUI's table and plot, kept apart from GTK so it can also run headless
+#   (benchmarkAcquisition.py draws with it on an Agg canvas); whatever uses it provides
+#   self.liststore and self.treeCache for the table, and self.ax and self.canvas for the plot
+
+import numpy
+
+from dataAcquisition import channels, metrics, monotonicTime
+
+class ChannelDisplay():
+
+    def updateTree(self, rows=None):
+        # rows are (bits, volts, value, statistics) per channel, straight from the channels if not given
+        #   only cells that actually changed get written, each write makes the tree view redraw
+        if metrics.enabled:
+            started = monotonicTime()
+        allChannels = channels.AllChannels()
+        if rows is None:
+            rows = [ch.Snapshot() for ch in allChannels]
+        for ch in range(len(rows)):
+            bits, volts, value, statistics = rows[ch]
+            cells = (bits, volts, '%s %s' % (value, allChannels[ch].units), statistics)
+            previous = self.treeCache[ch]
+            for column in range(4):
+                if not sameCell(cells[column], previous[column]):
+                    self.liststore[ch][column + 1] = cells[column]
+            self.treeCache[ch] = cells
+        if metrics.enabled:
+            metrics.observe('gui_tree_seconds', monotonicTime() - started)
+
+    def initPlotLines(self):
+        # create one line per plotted channel up front, updatePlot then only swaps their data
+        #   the lines are animated so a full canvas draw leaves them out of the cached background
+        self.ax.clear()
+        self.lines = []
+        for ch in channels.AllChannels():
+            if ch.plot:
+                line, = self.ax.plot([], [], label=ch.name, animated=True)
+                self.lines.append((ch, line))
+        self.ax.xaxis.grid(True)
+        self.ax.yaxis.grid(True)
+        self.ax.legend(loc='upper left')
+        self.plotLayout = None
+        self.background = None
+
+    def growLimits(self, tMin, tMax, vMin, vMax):
+        # the limits stay put until the data leave them, so most refreshes can blit; then the time axis
+        #   starts at the oldest sample with room for as much again ahead of the newest, and the value
+        #   axis takes in the data with a 10% margin
+        if tMax < tMin:
+            return
+        first = self.plotLayout is None
+        left, right = self.ax.get_xlim()
+        # (the history dropping its oldest half off the left counts as leaving too)
+        if first or tMin < left or tMax > right or tMin > 0.5 * (left + right):
+            self.ax.set_xlim(tMin, tMin + 2 * max(tMax - tMin, 1.0))
+        bottom, top = self.ax.get_ylim()
+        if vMax >= vMin and (first or vMin < bottom or vMax > top):
+            margin = 0.1 * (vMax - vMin) or max(0.1 * abs(vMax), 1.0)
+            self.ax.set_ylim(vMin - margin, vMax + margin)
+
+    def updatePlot(self):
+        if metrics.enabled:
+            started = monotonicTime()
+        # never hand matplotlib more than about two points per horizontal pixel
+        maxPoints = 2 * max(1, int(self.ax.bbox.width))
+        tMin = vMin = float('inf')
+        tMax = vMax = -float('inf')
+        for ch, line in self.lines:
+            times, values = ch.history.envelope(maxPoints)
+            line.set_data(times, values)
+            if len(times):
+                tMin = min(tMin, times[0])
+                tMax = max(tMax, times[-1])
+                values = values[numpy.isfinite(values)]
+                if len(values):
+                    vMin = min(vMin, values.min())
+                    vMax = max(vMax, values.max())
+        self.growLimits(tMin, tMax, vMin, vMax)
+        # only redraw the whole figure (axes, ticks, legend) when the limits or size changed,
+        #   otherwise paste the cached background back and blit just the lines on top of it
+        layout = (self.ax.get_xlim(), self.ax.get_ylim(), self.ax.bbox.bounds)
+        if layout != self.plotLayout or self.background is None:
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+            self.plotLayout = layout
+        else:
+            self.canvas.restore_region(self.background)
+        for ch, line in self.lines:
+            self.ax.draw_artist(line)
+        self.canvas.blit(self.ax.bbox)
+        if metrics.enabled:
+            metrics.observe('gui_plot_seconds', monotonicTime() - started)
+
+def sameCell(a, b):
+    # like a == b, except that nan (an out-of-range reading) counts as the same as nan
+    return a == b or (a != a and b != b)
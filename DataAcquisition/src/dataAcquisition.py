@@ -1,33 +1,74 @@
 #!/usr/bin/python
 
-# import the gtk libraries, initialize the threads to alert that this will be multithreaded
-import gtk, gobject
-gtk.gdk.threads_init()
+# the data acquisition core: configuration, channels, the serial reader and the sampling loop
+#   nothing in here needs a display; the GTK window lives in dataAcquisitionGUI.py and is just
+#   one of the sinks the sampling loop reports to
+#
+#       python dataAcquisition.py                 (the GUI)
+#       python dataAcquisition.py --headless      (no GUI, for unattended loggers)
 
 # OS interaction library imports
 import sys
 import os
 import errno
+import struct
+import json
+import signal
+import argparse
+import subprocess
 
 # general math and date/time based library imports
 import math
+import bisect
 import time
 from datetime import datetime
 from random import randint
 
-# for serial communication, we import the python-serial library
-import serial
+# (the python-serial library for the serial communication is only loaded once there's a port to
+#   open, see DataReader, so starting up and everything that only works on files stays quick)
 
 # for background threading we need to import the threading library
-from threading import Thread
-
-# for graphical plot need to install python-matplotlib
-import matplotlib
-matplotlib.use('GtkAgg')
-from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg as Canvas
-import pylab
-import cairo
-import numpy.numarray as na
+from threading import Thread, Event, Lock
+from Queue import Queue, Empty
+
+# for the channel history and batch conversions
+import numpy
+
+# a clock that never jumps (NTP corrections, DST, someone fixing the laptop clock) for timing the samples
+#   python 2 doesn't have time.monotonic, so go straight to clock_gettime where we can
+try:
+    monotonicTime = time.monotonic
+except AttributeError:
+    try:
+        import ctypes
+        class _timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        try:
+            # any recent glibc has it, and that's already loaded
+            _clock_gettime = ctypes.CDLL(None, use_errno=True).clock_gettime
+        except AttributeError:
+            # older ones keep it in librt; find_library runs ldconfig (or worse), so only as a last resort
+            import ctypes.util
+            _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt'), use_errno=True).clock_gettime
+        _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        _CLOCK_MONOTONIC = 1
+        def monotonicTime():
+            t = _timespec()
+            if _clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+                raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+            return t.tv_sec + t.tv_nsec * 1e-9
+        monotonicTime()
+    except (OSError, AttributeError, TypeError):
+        # no luck (windows, probably), so fall back on the wall clock
+        monotonicTime = time.time
+
+# how a scan went, or-ed together into the Quality column of the data file (0 is a clean scan)
+#   with burst sampling, the flags of all the scans that went into the sample
+QUALITY_TIMEOUT = 1  # some readings didn't arrive, they are recorded as -999999
+QUALITY_RESYNC = 2  # a response was out of step with the channels and had to be thrown away
+QUALITY_RETRIED = 4  # the scan was taken again after a bad response
+QUALITY_RECONNECTED = 8  # the serial port had to be reopened for this scan
+QUALITY_DISCONNECTED = 16  # the serial port was gone, there are no readings
 
 class Configuration():
 
@@ -35,6 +76,9 @@ class Configuration():
     #   a) define the channels in the ChannelClass.__init__() function
     #   b) modify the digital to analog conversion function to give: volts=f(bits)
     #   c) add conversion functions for each channel to give a physical value from the volts
+    #   or instead, give a channel configuration file (see channelConfig.example.json and ChannelClass.Load)
+    #   here, or on the command line with --channel-config
+    channelConfigFile = None
 
     # 1: set a base directory to store the data,
     #   the expanduser function is platform independent by itself, and the '~' gives the home dir
@@ -43,7 +87,13 @@ class Configuration():
 
     # 2: define the time step, in seconds as a function of the current time
     #   this allows you to vary the sampling rate over the course of a test
+    #   (or turn on adaptiveSampling below to have it follow how fast the channels are changing;
+    #   a 'step' rule in 3 takes over from both while it fires)
     def getTimeStep(self, currentTime):
+        if self.ruleEngine is not None and self.ruleEngine.timeStep is not None:
+            return self.ruleEngine.timeStep
+        if self.adaptiveSampling and self.adaptiveStepper is not None:
+            return self.adaptiveStepper.getTimeStep(currentTime)
         if currentTime < 3:
             return 0.5
         elif currentTime < 8:
@@ -51,15 +101,26 @@ class Configuration():
         else:
             return 2
 
-    # 3: define the data acquisition flag (the time to stop taking data)
-    #   this allows you to easily stop the test after, say, 24 hours (86400s)
-    #   perhaps this could also eventually be more sophisticated to check other things
-    #   it would be easy enough to check the latest sample data for out-of-range
+    # 3: define when to stop taking data, and what else to watch for while sampling (see RuleEngine)
+    #   every rule is checked after each scan against the latest readings of the channels it lists
+    #   ('*' for all of them, derived ones too); when it fires it can 'stop' the test, switch to a time
+    #   'step' of 'timeStep' seconds for as long as it keeps firing, or just 'notify' (printed, and shown
+    #   in the GUI's status bar).  the kinds of rule are:
+    #     'elapsed'  the test has been going for 'limit' seconds (say 86400 to stop after 24 hours)
+    #     'above', 'below'  a channel's value is above (below) 'limit'
+    #     'rate'  a channel is changing faster than 'limit' units per second, over the last 'samples' scans
+    #     'stale'  a channel hasn't had a valid reading for 'limit' seconds
+    #   with a 'duration' a rule only fires once its condition has held for that many seconds straight
+    #   for example:  {'name': 'loop too hot', 'kind': 'above', 'channels': ['HXInletTemp', 'HXOutletTemp'],
+    #                  'limit': 120.0, 'duration': 30.0, 'action': 'stop'}
+    rules = [
+        {'name': 'test length', 'kind': 'elapsed', 'limit': 120, 'action': 'stop'},
+    ]
+    ruleEngine = None  # set up by the sampling loop
+
+    #   sampling carries on until this returns False, which by default is when a 'stop' rule fires
     def getContinueFlag(self, currentTime):
-        if currentTime < 120:
-            return True
-        else:
-            return False
+        return self.ruleEngine is None or self.ruleEngine.stopMessage is None
 
     # 4: define the portName, these will vary based on OS
     def getPortName(self):
@@ -68,14 +129,143 @@ class Configuration():
         elif sys.platform.startswith('linux'):
             return '/dev/ttyUSB0'
 
+    #   with more than one module, list each one's port and the names of the channels wired to it,
+    #   in the module's own channel order; every module is read at the same time on its own thread
+    #   for example:  return [('/dev/ttyUSB0', ['HXInletTemp', 'HXOutletTemp', 'HXFlowRate']),
+    #                         ('/dev/ttyUSB1', ['HeaterAmps', 'HeaterVolts'])]
+    def getDevices(self):
+        if channels.Devices is not None:
+            # as given in the channel configuration file
+            return channels.Devices
+        return [(self.getPortName(), [ch.name for ch in channels.Channels])]
+
     # 5: define the resolution and scale of the digital converter, in mV/bit
     milliVoltsPerBit = 1  # not sure this is the right approach...
     minimumBits = 0  # just for reporting purposes to avoid plotting out-of-range data
     maximumBits = 5000  # just for reporting purposes to avoid plotting out-of-range data
 
+    # 6: define how much history each channel keeps in memory for plotting and live display
+    #   the buffer is allocated once, so this caps memory use no matter how long the test runs
+    #   at a 2 second time step, 200000 samples is a bit over 4.5 days of data per channel
+    historyCapacity = 200000
+    #   if enabled, samples that fall off the end of the in-memory history are appended to a
+    #   binary file in the base directory (pairs of float64 time, value) instead of being lost
+    spillHistoryToDisk = False
+
+    # 7: define the data file format and how hard to push it to the disk
+    #   'csv' writes the readable data-*.csv file directly, 'binary' writes a compact raw-*.daq capture
+    #   which can be turned into the same csv layout later:  python dataAcquisition.py --convert raw-*.daq
+    dataFormat = 'csv'
+    #   the file is written by a background thread, this is how many samples may be waiting on it
+    #   before the sampling loop has to wait (it should only ever happen if the disk is hopelessly slow)
+    writerQueueSize = 1000
+    #   'none' leaves buffering to python and the OS, 'flush' hands the data to the OS periodically,
+    #   'fsync' also forces it onto the disk, which is safest for power loss but hardest on SD cards
+    flushPolicy = 'flush'
+    flushEverySeconds = 5.0
+
+    # 8: define the serial line settings
+    baudRate = 2400
+    #   read the whole response to a scan request in one go and decode it all at once,
+    #   rather than making two 1-byte reads (each with its own timeout) per channel
+    bulkRead = True
+    #   send the next scan request as soon as a response arrives, so the module is already busy
+    #   while we process, write and wait; each reading is then as of the previous request
+    pipelineRequests = False
+    #   allowance for the module to start answering, on top of the time the bytes take on the wire
+    serialLatency = 0.025
+
+    # 9: define how often (per second) the GUI may redraw the table and plot at most
+    #   the GUI always shows the newest scan, scans that arrive in between redraws are just skipped
+    guiMaxRefreshRate = 10.0
+
+    # 10: define how many of the latest samples the windowed (recent) channel statistics cover
+    statisticsWindow = 300
+
+    # 11: also record the run in a columnar store (a directory of flat binary arrays, one per column)
+    #   which can be memory-mapped to pull any time window of a long test back up almost instantly
+    #   see ColumnarStoreReader for reading one back
+    writeColumnarStore = False
+
+    # 12: adaptive sampling: instead of the fixed schedule in getTimeStep, halve the time step whenever
+    #   a watched channel changes faster than its threshold rate (in its units per second), and let it
+    #   grow back gradually while everything is steady, staying between the minimum and maximum step
+    #   set the thresholds well above what noise alone does from one sample to the next
+    adaptiveSampling = False
+    adaptiveMinStep = 0.25
+    adaptiveMaxStep = 10.0
+    adaptiveRateThresholds = {'HXInletTemp': 0.5, 'HXOutletTemp': 0.5}
+    adaptiveStepper = None  # set up by the sampling loop
+
+    # 13: deadband compression: only write a sample to the data file when some channel has moved by more
+    #   than its deadband (in its units) since the last sample written, or when maxInterval seconds
+    #   have gone by; channels not listed never trigger a write on their own
+    deadbandCompression = False
+    deadbands = {'HXInletTemp': 0.05, 'HXOutletTemp': 0.05, 'HXFlowRate': 0.1, 'HeaterAmps': 0.05, 'HeaterVolts': 0.5}
+    deadbandMaxInterval = 300.0
+
+    # 14: publish every scan over TCP for remote monitoring (see liveStream.py), None turns it off
+    #   use '0.0.0.0' as the host to allow connections from other machines, not just this one
+    liveStreamPort = None
+    liveStreamHost = '127.0.0.1'
+    #   how much may pile up for one slow client before its frames start getting dropped
+    liveStreamClientBuffer = 256 * 1024
+
+    # 15: every so often save a checkpoint next to the data file (<data file>.checkpoint) with the sample
+    #   count, the time base and the channel statistics, so a test that gets killed or loses power can
+    #   carry on with the same file:  python dataAcquisition.py --headless --resume ~/dataAcq/data-*.csv
+    #   None turns the checkpoints off (a data file can still be resumed, its whole length is read then)
+    checkpointEverySeconds = 60.0
+
+    # 16: instrumentation: timers around the serial writes and reads, the conversions, the file writes and
+    #   the GUI updates, and counters of read timeouts, out-of-range readings and schedule overruns
+    #   (see metricDescriptions); when this is off the sampling loop only checks a flag
+    collectMetrics = False
+    #   with it on, write them to this file in the base directory every so often, in 'prometheus' text
+    #   format (node_exporter's textfile collector picks it up) or as 'json'; None for no file
+    metricsFileName = 'metrics.prom'
+    metricsFormat = 'prometheus'
+    metricsEverySeconds = 10.0
+    #   and/or serve them at http://host:port/metrics (and /metrics.json), None for no server
+    metricsHttpPort = None
+    metricsHttpHost = '127.0.0.1'
+
+    # 17: recovering from serial trouble: a scan whose response comes back short or with stray bytes
+    #   behind it is taken again (after throwing away whatever is in the input) up to this many times,
+    #   as long as that still fits in the first half of its time slot
+    serialRetries = 2
+    #   if the port goes away (an unplugged USB adapter, say) the readings are recorded as missing and
+    #   it's reopened after this many seconds, doubling after every failed attempt up to the maximum
+    reconnectDelay = 0.5
+    reconnectMaxDelay = 30.0
+
+    # 18: burst oversampling: rather than sleeping until the next sample is due, keep scanning the modules,
+    #   and log the combination of all the scans since the last sample as the next one; with N scans to a
+    #   sample the noise comes down by about sqrt(N) without writing any more data.  the readings are combined
+    #   in bits, before the conversions, by their 'mean', 'median' or 'trimmed' mean (leaving out the
+    #   burstTrimFraction lowest and highest of each channel, so it has to be under 0.5); missing and
+    #   out-of-range readings are left out
+    burstSampling = False
+    burstReduction = 'mean'
+    burstTrimFraction = 0.1
+    #   stop this long before the sample is due, so its own scan still starts on time
+    burstMargin = 0.02
+    #   also add a Count_<channel> and StdBits_<channel> column per channel to the csv, for how many readings
+    #   went into each sample and their standard deviation in bits
+    burstStatistics = True
+    #   at most this many scans go into one sample; a module that gets there sits out the rest of the slot
+    burstMaxScans = 1000
+
 class ChannelClass():
 
     def __init__(self):
+        # made up empirical correlations, each gives a physical value from the volts
+        #   these work on single readings as well as numpy arrays of readings
+        self.fTemperatureIn = LinearCalibration(0.2, 0.3)
+        self.fTemperatureOut = LinearCalibration(0.6, 0.1)
+        self.fFlowRate = LinearCalibration(0.9, 0.2)
+        self.fHeaterAmps = LinearCalibration(0.1, 0.6)
+        self.fHeaterVolts = LinearCalibration(0.8, 0.23)
         self.Channels = []
         # add any number of channels here
         self.Channels.append(AChannel("HXInletTemp", self.fTemperatureIn, "[F]", plot=True))
@@ -83,30 +273,198 @@ class ChannelClass():
         self.Channels.append(AChannel("HXFlowRate", self.fFlowRate, "[GPM]", plot=False))
         self.Channels.append(AChannel("HeaterAmps", self.fHeaterAmps, "[A]", plot=False))
         self.Channels.append(AChannel("HeaterVolts", self.fHeaterVolts, "[V]", plot=False))
-        
+        # channels calculated from the others each scan, from their names and a function of their values
+        #   the functions get whole arrays when a batch of scans is processed at once, so keep them to arithmetic
+        self.DerivedChannels = []
+        self.DerivedChannels.append(DerivedChannel("DeltaT", ["HXInletTemp", "HXOutletTemp"], lambda tIn, tOut: tIn - tOut, "[F]", plot=False))
+        self.DerivedChannels.append(DerivedChannel("HeaterPower", ["HeaterAmps", "HeaterVolts"], lambda amps, volts: amps * volts, "[W]", plot=False))
+        self.resolveDerivedInputs()
+        # how the latest scan went (the QUALITY_ flags), set by the DeviceRegistry
+        self.ScanQuality = 0
+        # which module each channel is on, None for all of them on getPortName() as listed above
+        self.Devices = None
+        if config.channelConfigFile is not None:
+            self.Load(config.channelConfigFile)
+
+    def resolveDerivedInputs(self):
+        byName = dict((ch.name, ch) for ch in self.Channels)
+        for ch in self.DerivedChannels:
+            missing = [name for name in ch.inputNames if name not in byName]
+            if missing:
+                raise ValueError("Derived channel %s uses %s, which isn't a channel" % (ch.name, ", ".join(missing)))
+            ch.inputs = [byName[name] for name in ch.inputNames]
+
+    def Load(self, path):
+        # replace the channels above with the ones in a json channel configuration file, like:
+        #   {"channels": [{"name": "HXInletTemp", "units": "[F]", "plot": true, "device": "/dev/ttyUSB0", "index": 0,
+        #                  "calibration": {"type": "linear", "offset": 0.2, "slope": 0.3}}, ...],
+        #    "derived": [{"name": "DeltaT", "units": "[F]", "inputs": ["HXInletTemp", "HXOutletTemp"], "operation": "difference"}]}
+        #   the calibration types are those of makeCalibration, and the operations those in derivedOperations
+        #   device defaults to getPortName(), and index (the module's channel number) to the order in the file
+        with open(path, 'rb') as inFile:
+            spec = json.load(inFile)
+        loaded = []
+        devices = {}
+        for c in spec['channels']:
+            try:
+                ch = AChannel(str(c['name']), makeCalibration(c['calibration']), str(c.get('units', '[-]')), bool(c.get('plot', False)))
+            except (KeyError, ValueError, TypeError) as exception:
+                raise ValueError("Channel %s in %s: %s" % (c.get('name', len(loaded)), path, exception))
+            loaded.append(ch)
+            portName = str(c.get('device') or config.getPortName())
+            if portName not in devices:
+                devices[portName] = []
+            devices[portName].append((c.get('index', len(devices[portName])), ch.name))
+        names = [ch.name for ch in loaded]
+        if len(set(names)) != len(names):
+            raise ValueError("%s defines a channel name more than once" % path)
+        # the module answers with its channels 0..n-1, so each device's indexes have to be exactly that
+        self.Devices = []
+        for portName, indexed in sorted(devices.items()):
+            indexed.sort()
+            if [index for index, name in indexed] != range(len(indexed)):
+                raise ValueError("The channel indexes on %s in %s aren't 0 to %s" % (portName, path, len(indexed) - 1))
+            self.Devices.append((portName, [name for index, name in indexed]))
+        derived = []
+        for c in spec.get('derived', []):
+            if c.get('operation') not in derivedOperations:
+                raise ValueError("Derived channel %s in %s: operation should be one of %s" % (c.get('name'), path, ", ".join(sorted(derivedOperations))))
+            # checked here, or the wrong number of inputs would only show up at the first scan
+            fewest, most = derivedInputCounts[c['operation']]
+            numInputs = len(c.get('inputs') or [])
+            if numInputs < fewest or (most is not None and numInputs > most):
+                raise ValueError("Derived channel %s in %s: %s takes %s inputs, not %s" % (c.get('name'), path, c['operation'],
+                                 fewest if fewest == most else '%s or more' % fewest, numInputs))
+            derived.append(DerivedChannel(str(c['name']), [str(name) for name in c['inputs']], derivedOperations[c['operation']],
+                                          str(c.get('units', '[-]')), bool(c.get('plot', False))))
+        self.Channels = loaded
+        self.DerivedChannels = derived
+        self.resolveDerivedInputs()
+
+    def AllChannels(self):
+        # the measured channels followed by the derived ones
+        return self.Channels + self.DerivedChannels
+
+    def ProcessDerived(self, time):
+        # call after every scan, once the measured channels have their new readings
+        for ch in self.DerivedChannels:
+            ch.ProcessDerived(time)
+
     def digitalToAnalog(self, bits):
         # made up conversion
         return (config.milliVoltsPerBit / 1000.0) * bits
 
-    def fTemperatureIn(self, volts):
-        # made up empirical correlation
-        return 0.2 + 0.3*volts
-
-    def fTemperatureOut(self, volts):
-        # made up empirical correlation
-        return 0.6 + 0.1*volts
-
-    def fFlowRate(self, volts):
-        # made up empirical correlation
-        return 0.9 + 0.2*volts
-
-    def fHeaterAmps(self, volts):
-        # made up empirical correlation
-        return 0.1 + 0.6*volts
-        
-    def fHeaterVolts(self, volts):
-        # made up empirical correlation
-        return 0.8 + 0.23*volts        
+    def convertBatch(self, rawBits, processors=None):
+        # convert a whole block of raw readings at once, rather than one reading at a time
+        #   rawBits is an array of shape (scans, channels), columns in the same order as self.Channels
+        #   (or as the given list of conversion functions, to convert some other set of channels)
+        #   returns (bits, volts, values) arrays of the same shape, nan wherever the reading was out of range
+        if processors is None:
+            processors = [ch.processor for ch in self.Channels]
+        raw = numpy.asarray(rawBits, dtype=numpy.float64)
+        if raw.ndim == 1:
+            raw = raw.reshape(1, -1)
+        bits = raw.copy()
+        # (readings missing from a csv come in as nan bits, which are out of range anyway)
+        with numpy.errstate(invalid='ignore'):
+            bits[(raw < config.minimumBits) | (raw > config.maximumBits)] = float('nan')
+        volts = self.digitalToAnalog(bits)
+        values = numpy.empty_like(volts)
+        for i in range(len(processors)):
+            values[:, i] = processors[i](volts[:, i])
+        return bits, volts, values
+
+    def ProcessBatch(self, times, rawBits):
+        # like calling AChannel.Process for every reading of every scan, but vectorized
+        times = numpy.asarray(times, dtype=numpy.float64)
+        if len(times) == 0:
+            return
+        raw = numpy.asarray(rawBits, dtype=numpy.float64).reshape(len(times), -1)
+        bits, volts, values = self.convertBatch(raw)
+        for i in range(len(self.Channels)):
+            self.Channels[i].ProcessConverted(times, bits[:, i], volts[:, i], values[:, i])
+            self.Channels[i].rawBits = raw[-1, i]
+        byName = dict((self.Channels[i].name, values[:, i]) for i in range(len(self.Channels)))
+        nan = numpy.empty(len(times))
+        nan.fill(float('nan'))
+        for ch in self.DerivedChannels:
+            ch.ProcessConverted(times, nan, nan, ch.combine(*[byName[name] for name in ch.inputNames]))
+
+class LinearCalibration():
+
+    # value = offset + slope * volts
+    def __init__(self, offset, slope):
+        self.offset = offset
+        self.slope = slope
+
+    def __call__(self, volts):
+        return self.offset + self.slope * volts
+
+class PolynomialCalibration():
+
+    # value = c0 + c1 * volts + c2 * volts^2 + ..., coefficients given lowest order first
+    def __init__(self, coefficients):
+        self.coefficients = list(coefficients)
+        # numpy.polyval wants the highest order first
+        self.polyCoefficients = numpy.array(self.coefficients[::-1], dtype=numpy.float64)
+        self.hornerCoefficients = [float(c) for c in self.coefficients[::-1]]
+
+    def __call__(self, volts):
+        if isinstance(volts, float):
+            # a single reading: plain Horner's rule is many times quicker than polyval on a scalar
+            value = 0.0
+            for c in self.hornerCoefficients:
+                value = value * volts + c
+            return value
+        return numpy.polyval(self.polyCoefficients, volts)
+
+class LookupCalibration():
+
+    # piecewise linear interpolation in a (volts, value) table, clamped at either end
+    def __init__(self, voltsTable, valueTable):
+        order = numpy.argsort(voltsTable)
+        self.voltsTable = numpy.asarray(voltsTable, dtype=numpy.float64)[order]
+        self.valueTable = numpy.asarray(valueTable, dtype=numpy.float64)[order]
+
+    def __call__(self, volts):
+        return numpy.interp(volts, self.voltsTable, self.valueTable)
+
+def makeCalibration(spec):
+    # a conversion from volts to a physical value, from its description in a channel configuration file:
+    #   {"type": "linear", "offset": a, "slope": b}
+    #   {"type": "polynomial", "coefficients": [c0, c1, c2, ...]}  (lowest order first)
+    #   {"type": "lookup", "volts": [...], "values": [...]}
+    kind = spec['type']
+    if kind == 'linear':
+        return LinearCalibration(float(spec['offset']), float(spec['slope']))
+    elif kind == 'polynomial':
+        coefficients = [float(c) for c in spec['coefficients']]
+        if not coefficients:
+            raise ValueError('a polynomial calibration needs at least one coefficient')
+        # a straight line is quicker to evaluate as a linear calibration
+        if len(coefficients) <= 2:
+            return LinearCalibration(coefficients[0], (coefficients + [0.0])[1])
+        return PolynomialCalibration(coefficients)
+    elif kind == 'lookup':
+        if len(spec['volts']) != len(spec['values']) or len(spec['volts']) < 2:
+            raise ValueError('a lookup calibration needs matching volts and values tables of at least two points')
+        return LookupCalibration([float(v) for v in spec['volts']], [float(v) for v in spec['values']])
+    raise ValueError("unknown calibration type '%s', use linear, polynomial or lookup" % kind)
+
+# what a derived channel in a channel configuration file can do with its inputs
+derivedOperations = {
+    'sum': lambda *inputs: sum(inputs[1:], inputs[0]),
+    'difference': lambda a, b: a - b,
+    'product': lambda a, b: a * b,
+    'ratio': lambda a, b: numpy.true_divide(a, b),
+}
+#   and how many inputs each one takes, as (fewest, most) with None for no limit
+derivedInputCounts = {
+    'sum': (1, None),
+    'difference': (2, 2),
+    'product': (2, 2),
+    'ratio': (2, 2),
+}
   
 class AChannel():
 
@@ -118,27 +476,433 @@ class AChannel():
         self.initData()
 
     def initData(self):
-        self.timeHistory = [float('nan')]
-        self.valueHistory = [float('nan')]
+        # the history buffer is only allocated the first time through, later calls just rewind it
+        if hasattr(self, 'history'):
+            self.history.reset()
+        else:
+            self.history = ChannelHistory(config.historyCapacity, self.name, config.spillHistoryToDisk)
+        self.time = float('nan')
+        self.rawBits = float('nan')
         self.bits = float('nan')
         self.volts = float('nan')
+        self.value = float('nan')
+        # how many readings went into the latest one, and how much they varied (see Configuration.burstSampling)
+        self.burstCount = 0
+        self.burstStd = float('nan')
+        self.stats = RunningStatistics(config.statisticsWindow)
 
     def Process(self, time, bits):
+        if metrics.enabled:
+            started = monotonicTime()
+        # keep the reading exactly as it came from the device for the raw capture file
+        self.rawBits = bits
         if bits < config.minimumBits or bits > config.maximumBits:
+            if metrics.enabled:
+                metrics.count('read_timeouts_total' if bits == -999999 else 'out_of_range_total')
             bits = float('nan')
             volts = float('nan')
             val = float('nan')
         else:
             volts = channels.digitalToAnalog(bits)
             val = self.processor(volts)
-        self.timeHistory.append(time)
+        self.history.append(time, val)
+        self.stats.update(time, val)
+        self.time = time
         self.bits = bits
         self.volts = volts
-        self.valueHistory.append(val)
+        self.value = val
+        if metrics.enabled:
+            metrics.observe('conversion_seconds', monotonicTime() - started)
+
+    def ProcessConverted(self, times, bits, volts, values):
+        # take a block of already converted readings (see ChannelClass.ProcessBatch)
+        if len(times) == 0:
+            return
+        self.history.extend(times, values)
+        for i in range(len(times)):
+            self.stats.update(times[i], values[i])
+        self.time = times[-1]
+        self.bits = bits[-1]
+        self.volts = volts[-1]
+        self.value = values[-1]
 
     #call this function anytime (like: for ch in channels.Channels: ch.Spew())
     def Spew(self):
-        print "%s: (%s, %s, %s, %s)" % (self.name, self.timeHistory[-1], self.bits, self.volts, self.valueHistory[-1])
+        print "%s: (%s, %s, %s, %s)" % (self.name, self.time, self.bits, self.volts, self.value)
+
+    def Snapshot(self):
+        # what the GUI shows for this channel: (bits, volts, value, statistics text)
+        return (self.bits, self.volts, self.value, self.stats.Summary())
+
+class DerivedChannel(AChannel):
+
+    # a channel calculated from the latest values of other channels rather than read from the module
+    def __init__(self, ChannelName, inputNames, fCombine, Units, plot):
+        self.inputNames = inputNames
+        self.combine = fCombine
+        self.inputs = []
+        AChannel.__init__(self, ChannelName, None, Units, plot)
+
+    def ProcessDerived(self, time):
+        val = self.combine(*[ch.value for ch in self.inputs])
+        self.history.append(time, val)
+        self.stats.update(time, val)
+        self.time = time
+        self.value = val
+
+class RunningStatistics():
+
+    # statistics of a channel updated one sample at a time, without ever looking back through the history:
+    #   mean and standard deviation over the whole run and over the latest `window` samples, min and max over
+    #   the whole run, and the least squares slope of the value against ln(time), which is what a thermal
+    #   response test is after
+    #   nan samples (out-of-range readings) are left out
+    def __init__(self, window):
+        self.window = int(window)
+        self.recent = numpy.empty(self.window, dtype=numpy.float64)
+        self.reset()
+
+    def reset(self):
+        nan = float('nan')
+        # whole run, Welford's running mean and sum of squared deviations
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.minimum = nan
+        self.maximum = nan
+        # the latest `window` samples, in a ring
+        self.recentCount = 0
+        self.recentHead = 0
+        self.recentMean = 0.0
+        self.recentM2 = 0.0
+        # sums for the regression of value against x = ln(time)
+        self.fitCount = 0
+        self.sumX = 0.0
+        self.sumY = 0.0
+        self.sumXX = 0.0
+        self.sumXY = 0.0
+
+    def update(self, time, value):
+        if value != value:
+            return
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.count == 1:
+            self.minimum = self.maximum = value
+        elif value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+
+        if self.recentCount < self.window:
+            # still filling up, same as above
+            self.recentCount += 1
+            delta = value - self.recentMean
+            self.recentMean += delta / self.recentCount
+            self.recentM2 += delta * (value - self.recentMean)
+        else:
+            # the new sample replaces the oldest one in the window
+            old = self.recent[self.recentHead]
+            oldMean = self.recentMean
+            self.recentMean += (value - old) / self.window
+            self.recentM2 += (value - old) * (value - self.recentMean + old - oldMean)
+        self.recent[self.recentHead] = value
+        self.recentHead = (self.recentHead + 1) % self.window
+
+        if time > 0:
+            x = math.log(time)
+            self.fitCount += 1
+            self.sumX += x
+            self.sumY += value
+            self.sumXX += x * x
+            self.sumXY += x * value
+
+    # the running sums, which together with the window contents are all there is to the state
+    stateNames = ('count', 'mean', 'm2', 'minimum', 'maximum', 'recentCount', 'recentHead', 'recentMean', 'recentM2',
+                  'fitCount', 'sumX', 'sumY', 'sumXX', 'sumXY')
+
+    def getState(self):
+        # as plain numbers and lists, for saving in a checkpoint
+        state = dict((name, getattr(self, name)) for name in self.stateNames)
+        state['window'] = self.window
+        state['recent'] = self.recent[:self.recentCount].tolist()
+        return state
+
+    def setState(self, state):
+        # carry on from a getState() result; if the window size has changed since, the window starts over
+        for name in self.stateNames:
+            setattr(self, name, state[name])
+        if state['window'] == self.window:
+            self.recent[:self.recentCount] = state['recent']
+        else:
+            self.recentCount = self.recentHead = 0
+            self.recentMean = self.recentM2 = 0.0
+
+    def stdDev(self):
+        if self.count < 2:
+            return float('nan')
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def recentStdDev(self):
+        if self.recentCount < 2:
+            return float('nan')
+        return math.sqrt(max(0.0, self.recentM2) / (self.recentCount - 1))
+
+    def logTimeSlope(self):
+        # change in value per unit of ln(time), from all samples so far
+        n = self.fitCount
+        denominator = n * self.sumXX - self.sumX * self.sumX
+        if n < 2 or denominator <= 0:
+            return float('nan')
+        return (n * self.sumXY - self.sumX * self.sumY) / denominator
+
+    def Summary(self):
+        if self.count == 0:
+            return ''
+        return 'mean %.3f, min %.3f, max %.3f, std %.3f, recent %.3f +/- %.3f, slope %.3f /ln(s)' % (
+            self.mean, self.minimum, self.maximum, self.stdDev(), self.recentMean, self.recentStdDev(), self.logTimeSlope())
+
+class ChannelHistory():
+
+    # a fixed-capacity ring buffer of (time, value) samples backed by numpy arrays
+    #   every sample is written twice, at slot i and slot i+capacity, so the most recent
+    #   N samples are always one contiguous slice and can be handed out as views without copying
+    def __init__(self, capacity, name, spillToDisk=False):
+        self.capacity = int(capacity)
+        self.name = name
+        self.times = numpy.empty(2 * self.capacity, dtype=numpy.float64)
+        self.values = numpy.empty(2 * self.capacity, dtype=numpy.float64)
+        # samples are spilled in blocks so the disk is not touched on every append
+        self.spillToDisk = spillToDisk
+        self.spillBlock = max(1, min(4096, self.capacity // 8))
+        self.spillFile = None
+        self.reset()
+
+    def reset(self):
+        # rewind the buffer without reallocating, and start a new spill file if one was in use
+        self.head = 0  # slot the next sample goes in
+        self.count = 0  # total number of samples appended since the reset
+        self.spilled = 0  # total number of samples already written to the spill file
+        self.closeSpill()
+        # the plot envelope's cached buckets (see envelope)
+        self.clearEnvelope(None, 0)
+
+    def clearEnvelope(self, size, first):
+        self.envelopeSize = size  # samples per bucket
+        self.envelopeFirst = first  # number of the first sample of the first bucket
+        self.envelopeBuckets = numpy.empty((0, 4))  # per bucket: time and value of its minimum, then of its maximum
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, time, value):
+        # write out the oldest block before the buffer wraps around onto it
+        if self.spillToDisk and self.count - self.capacity >= self.spilled:
+            self.spill()
+        head = self.head
+        self.times[head] = self.times[head + self.capacity] = time
+        self.values[head] = self.values[head + self.capacity] = value
+        head += 1
+        if head == self.capacity:
+            head = 0
+        self.head = head
+        self.count += 1
+
+    def extend(self, times, values):
+        # append a block of samples, equivalent to calling append for each one
+        n = len(times)
+        pos = 0
+        while pos < n:
+            if self.spillToDisk and self.count - self.capacity >= self.spilled:
+                self.spill()
+            # copy up to the physical end of the buffer, and never past samples not yet spilled
+            k = min(n - pos, self.capacity - self.head)
+            if self.spillToDisk and self.count >= self.capacity:
+                k = min(k, self.spilled - (self.count - self.capacity))
+            head = self.head
+            self.times[head:head + k] = self.times[head + self.capacity:head + self.capacity + k] = times[pos:pos + k]
+            self.values[head:head + k] = self.values[head + self.capacity:head + self.capacity + k] = values[pos:pos + k]
+            self.head = (head + k) % self.capacity
+            self.count += k
+            pos += k
+
+    def latest(self, n=None):
+        # return (times, values) views of the most recent n samples (or everything available)
+        #   these are views into the buffer, so copy them if you need them to outlive later appends
+        #   the count is only read once, so the slice is consistent even with the sampling thread appending
+        #   (the head is always count % capacity, and count only goes up once a sample is fully written)
+        count = self.count
+        available = min(count, self.capacity)
+        if n is None or n > available:
+            n = available
+        end = count % self.capacity + self.capacity
+        return self.times[end - n:end], self.values[end - n:end]
+
+    def copyRange(self, first, last):
+        # copies of the samples numbered first to last - 1 (counting from the reset), for another thread
+        #   than the one appending; any at the start that got overwritten while copying are left off,
+        #   keeping one slot of slack for a sample that is being written right then
+        start = first % self.capacity
+        times = self.times[start:start + last - first].copy()
+        values = self.values[start:start + last - first].copy()
+        lost = max(0, self.count + 1 - self.capacity - first)
+        return times[lost:], values[lost:]
+
+    def envelope(self, maxPoints):
+        # return (times, values) for plotting, reduced to at most about maxPoints points
+        #   the minimum and maximum of every whole bucket of samples (a power of two of them, lined up on
+        #   multiples of it) are kept from one call to the next, so a redraw only has to go through the
+        #   samples that came in since the last one, plus the partly covered buckets at either end
+        #   everything is read from copies, since the GUI calls this while the sampling thread keeps appending
+        #   (once the buffer is full that's all but the oldest sample, whose slot is the next one written)
+        count = self.count
+        windowStart = count - min(count, self.capacity - 1)
+        if count - windowStart <= maxPoints:
+            return self.copyRange(windowStart, count)
+        numBuckets = max(1, maxPoints // 2)
+        size = 1
+        while size * numBuckets < count - windowStart:
+            size *= 2
+        if self.envelopeSize is None or self.envelopeSize > size:
+            self.clearEnvelope(size, windowStart)
+        while self.envelopeSize < size:
+            # the history grew, twice as many samples to a bucket from now on
+            self.envelopeFirst, self.envelopeBuckets = mergeBucketPairs(self.envelopeFirst, self.envelopeBuckets, self.envelopeSize)
+            self.envelopeSize *= 2
+        # forget the buckets the start of the window has moved past
+        firstWhole = -(-windowStart // size) * size
+        if self.envelopeFirst < firstWhole:
+            self.envelopeBuckets = self.envelopeBuckets[(firstWhole - self.envelopeFirst) // size:]
+            self.envelopeFirst = firstWhole
+        if len(self.envelopeBuckets) == 0:
+            self.envelopeFirst = firstWhole
+        # and add the ones completed since last time
+        cachedEnd = self.envelopeFirst + len(self.envelopeBuckets) * size
+        wholeEnd = count // size * size
+        if wholeEnd > cachedEnd:
+            times, values = self.copyRange(cachedEnd, wholeEnd)
+            if len(times) < wholeEnd - cachedEnd:
+                # the buffer wrapped around under the copy, start over next time
+                self.clearEnvelope(None, 0)
+                return minMaxDecimate(*self.copyRange(windowStart, count), maxPoints=maxPoints)
+            self.envelopeBuckets = numpy.concatenate((self.envelopeBuckets, bucketExtremes(times, values, size)))
+            cachedEnd = wholeEnd
+        # the partly covered buckets at either end straight from the samples
+        parts = []
+        for first, last in ((windowStart, self.envelopeFirst), (cachedEnd, count)):
+            if last > first:
+                times, values = self.copyRange(first, last)
+                parts.append(bucketExtremes(times, values, len(times)) if len(times) else numpy.empty((0, 4)))
+            else:
+                parts.append(numpy.empty((0, 4)))
+        buckets = numpy.concatenate((parts[0], self.envelopeBuckets, parts[1]))
+        # each bucket's minimum and maximum in time order, so the line doesn't double back on itself
+        minFirst = buckets[:, 0] <= buckets[:, 2]
+        times = numpy.empty(2 * len(buckets))
+        values = numpy.empty(2 * len(buckets))
+        times[0::2] = numpy.where(minFirst, buckets[:, 0], buckets[:, 2])
+        values[0::2] = numpy.where(minFirst, buckets[:, 1], buckets[:, 3])
+        times[1::2] = numpy.where(minFirst, buckets[:, 2], buckets[:, 0])
+        values[1::2] = numpy.where(minFirst, buckets[:, 3], buckets[:, 1])
+        return times, values
+
+    def lastTime(self):
+        if self.count == 0:
+            return float('nan')
+        return self.times[self.head + self.capacity - 1]
+
+    def lastValue(self):
+        if self.count == 0:
+            return float('nan')
+        return self.values[self.head + self.capacity - 1]
+
+    def spill(self):
+        # once the buffer is full the oldest sample sits at the head slot, so the next block
+        #   to be overwritten is always the contiguous run starting there
+        if self.spillFile is None:
+            baseDir = config.baseDir()
+            if not os.path.isdir(baseDir):
+                os.makedirs(baseDir)
+            self.spillPath = os.path.join(baseDir, "spill-%s-%s.bin" % (self.name, datetime.now().strftime('%Y%m%d-%H%M%S')))
+            self.spillFile = open(self.spillPath, 'ab')
+        n = self.spillBlock
+        block = numpy.empty((n, 2), dtype=numpy.float64)
+        block[:, 0] = self.times[self.head:self.head + n]
+        block[:, 1] = self.values[self.head:self.head + n]
+        block.tofile(self.spillFile)
+        self.spillFile.flush()
+        self.spilled = self.count - self.capacity + n
+
+    def closeSpill(self):
+        if self.spillFile is not None:
+            self.spillFile.close()
+            self.spillFile = None
+
+    @staticmethod
+    def readSpill(path):
+        # load a spill file back as (times, values) arrays
+        data = numpy.fromfile(path, dtype=numpy.float64).reshape(-1, 2)
+        return data[:, 0], data[:, 1]
+
+def bucketExtremes(times, values, size):
+    # the time and value of the minimum and of the maximum of each whole bucket of size samples, one row per
+    #   bucket; nan samples (out-of-range readings) are never picked over a real value
+    numBuckets = len(values) // size
+    finite = numpy.isfinite(values[:numBuckets * size])
+    lows = numpy.where(finite, values[:numBuckets * size], numpy.inf).reshape(numBuckets, size)
+    highs = numpy.where(finite, values[:numBuckets * size], -numpy.inf).reshape(numBuckets, size)
+    offsets = numpy.arange(numBuckets) * size
+    iMin = lows.argmin(axis=1) + offsets
+    iMax = highs.argmax(axis=1) + offsets
+    return numpy.column_stack((times[iMin], values[iMin], times[iMax], values[iMax]))
+
+def mergeBucketPairs(first, buckets, size):
+    # bucketExtremes rows of buckets of size samples, starting at sample number first, into buckets of twice
+    #   that lined up on multiples of 2 size; a bucket left without a partner at either end is dropped
+    #   returns (the new first, the new rows)
+    if first % (2 * size):
+        buckets = buckets[1:]
+        first += size
+    buckets = buckets[:len(buckets) // 2 * 2]
+    a = buckets[0::2]
+    b = buckets[1::2]
+    # nan loses, and the earlier one wins a tie, the same as in bucketExtremes
+    lowA = numpy.where(a[:, 1] == a[:, 1], a[:, 1], numpy.inf)
+    lowB = numpy.where(b[:, 1] == b[:, 1], b[:, 1], numpy.inf)
+    highA = numpy.where(a[:, 3] == a[:, 3], a[:, 3], -numpy.inf)
+    highB = numpy.where(b[:, 3] == b[:, 3], b[:, 3], -numpy.inf)
+    merged = a.copy()
+    merged[:, 0:2] = numpy.where((lowB < lowA)[:, None], b[:, 0:2], a[:, 0:2])
+    merged[:, 2:4] = numpy.where((highB > highA)[:, None], b[:, 2:4], a[:, 2:4])
+    return first, merged
+
+def minMaxDecimate(times, values, maxPoints):
+    # reduce a series to the minimum and maximum of each of maxPoints/2 buckets, in time order
+    #   drawing these pairs looks the same as drawing every sample at screen resolution,
+    #   since every spike still shows up, but costs the same no matter how long the history is
+    n = len(values)
+    numBuckets = max(1, maxPoints // 2)
+    size = int(math.ceil(float(n) / numBuckets))
+    numFull = n // size
+    # nan samples (out-of-range readings) should never be picked over a real value
+    finite = numpy.isfinite(values)
+    lows = numpy.where(finite, values, numpy.inf)
+    highs = numpy.where(finite, values, -numpy.inf)
+    offsets = numpy.arange(numFull) * size
+    iMin = lows[:numFull * size].reshape(numFull, size).argmin(axis=1) + offsets
+    iMax = highs[:numFull * size].reshape(numFull, size).argmax(axis=1) + offsets
+    # a partial bucket at the end, if the length doesn't divide evenly
+    if numFull * size < n:
+        start = numFull * size
+        iMin = numpy.append(iMin, start + lows[start:].argmin())
+        iMax = numpy.append(iMax, start + highs[start:].argmax())
+    # keep each pair in time order so the line doesn't double back on itself
+    indices = numpy.empty(2 * len(iMin), dtype=numpy.intp)
+    indices[0::2] = numpy.minimum(iMin, iMax)
+    indices[1::2] = numpy.maximum(iMin, iMax)
+    return times[indices], values[indices]
 
 class AInfo():
 
@@ -171,22 +935,309 @@ class InfoClass():
             summary += '%s %s\n' % (inf.label, inf.value)
         return summary
 
-class IOStuff():
+class AcquisitionSink():
+
+    # something that wants to hear from the sampling loop: a data file, the GUI, a console, ...
+    #   all of these are called on the sampling thread, so they should hand off anything slow
+    def onStart(self):
+        pass
+
+    def onScan(self, readerCount, wallTime, currentTime):
+        # the channels hold the readings of this scan (ch.bits, ch.volts, ch.value, ch.history)
+        pass
 
+    def onStatus(self, message):
+        pass
+
+    def onAlarm(self, message):
+        # a rule just fired (see RuleEngine), called before the scan's onStatus
+        pass
+
+    def onComplete(self, message):
+        pass
+
+class LatestValueMailbox():
+
+    # hands values from one thread to another where only the newest one matters
+    #   posting replaces whatever hasn't been picked up yet, and those replaced values are counted
+    def __init__(self):
+        self.lock = Lock()
+        self.value = None
+        self.full = False
+        self.posted = 0
+        self.dropped = 0
+
+    def post(self, value):
+        with self.lock:
+            if self.full:
+                self.dropped += 1
+            self.value = value
+            self.full = True
+            self.posted += 1
+
+    def take(self):
+        # returns (True, value) if something new arrived since the last take, else (False, None)
+        with self.lock:
+            if not self.full:
+                return False, None
+            value, self.value, self.full = self.value, None, False
+            return True, value
+
+class ConsoleSink(AcquisitionSink):
+
+    # prints the status to stdout now and then, for running without the GUI
+    def __init__(self, statusEverySeconds=60.0):
+        self.statusEverySeconds = statusEverySeconds
+        self.lastPrint = None
+
+    def onStatus(self, message):
+        now = time.time()
+        if self.lastPrint is None or now - self.lastPrint >= self.statusEverySeconds:
+            print "%s %s" % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message)
+            sys.stdout.flush()
+            self.lastPrint = now
+
+    def onAlarm(self, message):
+        # these always get printed
+        print "%s Rule fired: %s" % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message)
+        sys.stdout.flush()
+
+    def onComplete(self, message):
+        print "%s %s" % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), message)
+
+class RollingHistogram():
+
+    # durations (or any other amounts) counted into fixed log-spaced buckets over the whole run,
+    #   from 1 us to 10 s at four buckets a decade, plus the latest `window` of them for percentiles of now
+    bucketEdges = [1e-6 * 10 ** (i / 4.0) for i in range(29)]
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.recent = numpy.zeros(window)
+        self.head = 0
+        # buckets[i] counts what fell in (bucketEdges[i-1], bucketEdges[i]], the last one everything bigger
+        self.buckets = [0] * (len(self.bucketEdges) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.maximum = float('nan')
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(self.bucketEdges, value)] += 1
+        self.count += 1
+        self.sum += value
+        if not value <= self.maximum:
+            self.maximum = value
+        self.recent[self.head] = value
+        self.head = (self.head + 1) % self.window
+
+    def percentiles(self, qs):
+        recent = self.recent[:min(self.count, self.window)]
+        if len(recent) == 0:
+            return [float('nan')] * len(qs)
+        return [float(x) for x in numpy.percentile(recent, qs)]
+
+# what each metric is, these double as the HELP lines of the prometheus output
+metricDescriptions = {
+    'scan_seconds': 'Time to read and convert one scan from all the modules',
+    'sinks_seconds': 'Time to hand one scan to the file, display and other sinks',
+    'serial_write_seconds': 'Time to send a scan request',
+    'serial_read_seconds': 'Time to read the response to a scan request',
+    'conversion_seconds': 'Time to convert and record one reading (AChannel.Process)',
+    'format_seconds': 'Time to format and queue one sample for the data file',
+    'file_write_seconds': 'Time the background writer spends writing a batch to the data file',
+    'file_flush_seconds': 'Time the background writer spends flushing the data file',
+    'schedule_jitter_seconds': 'How late each sample started compared to its slot',
+    'gui_update_seconds': 'Time for one GUI refresh',
+    'gui_tree_seconds': 'Time to refresh the GUI table',
+    'gui_plot_seconds': 'Time to redraw the GUI plot',
+    'rules_seconds': 'Time to check the rules against one scan',
+    'scans_total': 'Scans taken',
+    'short_reads_total': 'Scan responses that came back incomplete',
+    'read_timeouts_total': 'Readings missing from a scan response (recorded as -999999)',
+    'out_of_range_total': 'Readings outside minimumBits to maximumBits',
+    'schedule_overruns_total': 'Samples that ran past the start of the next slot',
+    'missed_slots_total': 'Slots skipped entirely to get back onto the schedule',
+    'file_write_bytes_total': 'Bytes written to the data file',
+    'writer_queue_depth': 'Samples waiting on the background writer',
+    'gui_updates_skipped': 'Scans the GUI never showed because a newer one came in first',
+    'serial_resyncs_total': 'Scan responses thrown away for being out of step with the channels',
+    'serial_retries_total': 'Scans taken again after a bad response',
+    'serial_disconnects_total': 'Times the serial port went away',
+    'serial_reconnects_total': 'Times the serial port was reopened',
+    'rule_hits_total': 'Times a rule started firing',
+    'burst_scans_total': 'Extra scans taken between samples in burst mode',
+    'burst_overflows_total': 'Samples whose burst stopped short at burstMaxScans',
+}
+
+class Metrics():
+
+    # where the instrumented code reports to; the reports are all behind `if metrics.enabled:`
+    #   so that with collecting off (the default) the cost is a single attribute check
     def __init__(self):
-        # put a base file path here
-        baseDir = config.baseDir()
-        self.make_sure_path_exists(baseDir)
-        # get a filename
-        now = datetime.now()
-        date = now.strftime('%Y%m%d-%H%M%S')
-        sfile = "data-%s.csv" % date
-        path = os.path.join(baseDir, sfile)
+        self.enabled = False
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.gauges = {}
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.timers:
+                self.timers[name] = RollingHistogram()
+            self.timers[name].observe(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    def prometheusText(self):
+        # the prometheus text exposition format, every name prefixed with daq_
+        lines = []
+        with self.lock:
+            for name, timer in sorted(self.timers.items()):
+                lines.append('# HELP daq_%s %s' % (name, metricDescriptions.get(name, name)))
+                lines.append('# TYPE daq_%s histogram' % name)
+                cumulative = 0
+                for edge, count in zip(RollingHistogram.bucketEdges + ['+Inf'], timer.buckets):
+                    cumulative += count
+                    lines.append('daq_%s_bucket{le="%s"} %s' % (name, edge if edge == '+Inf' else '%.3g' % edge, cumulative))
+                lines.append('daq_%s_sum %r' % (name, timer.sum))
+                lines.append('daq_%s_count %s' % (name, timer.count))
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name, value in sorted(values.items()):
+                    lines.append('# HELP daq_%s %s' % (name, metricDescriptions.get(name, name)))
+                    lines.append('# TYPE daq_%s %s' % (name, kind))
+                    lines.append('daq_%s %r' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def jsonText(self):
+        # the same, with percentiles of the latest observations rather than the buckets
+        with self.lock:
+            timers = {}
+            for name, timer in self.timers.items():
+                p50, p90, p99 = timer.percentiles([50, 90, 99])
+                timers[name] = {'count': timer.count, 'sum': timer.sum, 'max': timer.maximum, 'recentP50': p50, 'recentP90': p90, 'recentP99': p99}
+            return json.dumps({'timers': timers, 'counters': dict(self.counters), 'gauges': dict(self.gauges)}, indent=2, sort_keys=True)
+
+class MetricsExporter(AcquisitionSink):
+
+    # writes the metrics to a file every so often and/or serves them over HTTP, all off the sampling thread
+    def __init__(self, path, fileFormat, everySeconds, httpHost, httpPort):
+        self.path = path
+        self.fileFormat = fileFormat
+        self.everySeconds = everySeconds
+        self.httpHost = httpHost
+        self.httpPort = httpPort
+        self.stopping = Event()
+        self.threads = []
+        self.server = None
+
+    def onStart(self):
+        if self.path is not None:
+            self.threads.append(Thread(target=self.writeLoop))
+        if self.httpPort is not None:
+            import BaseHTTPServer
+            class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path == '/metrics':
+                        body, contentType = metrics.prometheusText(), 'text/plain; version=0.0.4'
+                    elif self.path == '/metrics.json':
+                        body, contentType = metrics.jsonText(), 'application/json'
+                    else:
+                        self.send_error(404)
+                        return
+                    self.send_response(200)
+                    self.send_header('Content-Type', contentType)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                def log_message(self, format, *args):
+                    pass
+            self.server = BaseHTTPServer.HTTPServer((self.httpHost, self.httpPort), MetricsRequestHandler)
+            self.threads.append(Thread(target=self.server.serve_forever))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def onComplete(self, message):
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        for thread in self.threads:
+            thread.join()
+        if self.path is not None:
+            self.writeFile()
+
+    def writeLoop(self):
+        while not self.stopping.wait(self.everySeconds):
+            self.writeFile()
+
+    def writeFile(self):
+        # rename a complete file into place, so whatever reads it never sees half of one
+        text = metrics.jsonText() if self.fileFormat == 'json' else metrics.prometheusText()
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as outFile:
+            outFile.write(text)
+        os.rename(temporary, self.path)
+
+class IOStuff(AcquisitionSink):
+
+    def __init__(self, resume=None):
+        self.resumed = resume is not None
+        # files from before the quality flags are carried on without them
+        self.rawVersion = RawCaptureFormat.version
+        self.qualityColumn = True
+        self.burstColumns = config.burstSampling and config.burstStatistics
+        if self.resumed:
+            # carry on with the data file of a test that stopped (see resumeDataFile)
+            self.dataFormat = resume['dataFormat']
+            self.rawVersion = resume['rawVersion']
+            self.qualityColumn = resume['qualityColumn']
+            self.burstColumns = resume['burstColumns']
+            path = resume['dataPath']
+        else:
+            # put a base file path here
+            baseDir = config.baseDir()
+            self.make_sure_path_exists(baseDir)
+            # get a filename
+            now = datetime.now()
+            date = now.strftime('%Y%m%d-%H%M%S')
+            self.dataFormat = config.dataFormat
+            if self.dataFormat == 'binary':
+                sfile = "raw-%s.daq" % date
+            else:
+                sfile = "data-%s.csv" % date
+            path = os.path.join(baseDir, sfile)
         try:
-            self.outFile = open(path, 'w')
+            if self.resumed:
+                # cut off anything after the last complete sample and write on from there
+                self.outFile = open(path, 'r+b')
+                self.outFile.truncate(resume['dataBytes'])
+                self.outFile.seek(resume['dataBytes'])
+            else:
+                self.outFile = open(path, 'wb')
         except:
             print "Couldn't open output file at the desired path (%s), something's wrong" % (path)
             sys.exit(1)
+        self.path = path
+        # all the actual writing happens on a background thread so a slow disk can't hold up sampling
+        self.writer = BackgroundWriter(self.outFile, config.writerQueueSize, config.flushPolicy, config.flushEverySeconds)
+        self.writer.start()
+        # optionally skip samples that don't tell us anything new
+        self.deadband = None
+        if config.deadbandCompression:
+            self.deadband = DeadbandFilter(config.deadbands, config.deadbandMaxInterval)
+        self.lastCheckpoint = time.time()
+        self.lastScan = None
 
     def make_sure_path_exists(self, path):
         try:
@@ -196,29 +1247,732 @@ class IOStuff():
                 raise
 
     def issueHeaderString(self):
-        s = info.GetSummary()
-        s += "ReadCount,TimeStamp,SecondsSinceStarting,LogarithmSeconds,"
-        for ch in channels.Channels:
-            s += "Bits_%s," % ch.name
-        for ch in channels.Channels:
-            s += "Volts_%s," % ch.name
-        for ch in channels.Channels:
-            s += "Processed_%s%s," % (ch.name, ch.units)
-        self.outFile.write(s)
-        self.outFile.write("\n") # is this cross-platform?
+        if self.dataFormat == 'binary':
+            self.rawFormat = RawCaptureFormat(len(channels.Channels))
+            self.writer.write(self.rawFormat.headerBytes(info.GetSummary(), channels.Channels))
+        else:
+            self.writer.write(self.formatHeaderString(info.GetSummary(), [(ch.name, ch.units) for ch in channels.Channels], True, self.burstColumns))
+
+    def issueReport(self, readerCount, wallTime, currentTime):
+        if metrics.enabled:
+            started = monotonicTime()
+        if self.dataFormat == 'binary':
+            self.writer.write(self.rawFormat.packRecord(readerCount, wallTime, currentTime, [ch.rawBits for ch in channels.Channels], channels.ScanQuality))
+        else:
+            self.issueReportString(self.formatTimes(readerCount, wallTime, currentTime))
+        if metrics.enabled:
+            metrics.observe('format_seconds', monotonicTime() - started)
+            metrics.gauge('writer_queue_depth', self.writer.queue.qsize())
 
     def issueReportString(self, times):
         s_time = ",".join(times)
         s_bits = ",".join("%10.3f" % x.bits for x in channels.Channels)
         s_volts = ",".join("%10.3f" % x.volts for x in channels.Channels)
-        s_vals = ",".join("%10.3f" % x.valueHistory[-1] for x in channels.Channels)
+        s_vals = ",".join("%10.3f" % x.value for x in channels.Channels)
         s = ",".join([s_time, s_bits, s_volts, s_vals])
-        self.outFile.write(s)
-        self.outFile.write("\n") # is this cross platform?
+        if self.qualityColumn:
+            s += ",%d" % channels.ScanQuality
+        if self.burstColumns:
+            s += "," + ",".join("%d" % x.burstCount for x in channels.Channels)
+            s += "," + ",".join("%10.3f" % x.burstStd for x in channels.Channels)
+        self.writer.write(s + "\n") # is this cross platform?
+
+    def close(self):
+        # wait for everything queued to make it out to the file
+        self.writer.close()
+
+    def issueCheckpoint(self, readerCount, wallTime, currentTime, complete=False):
+        # queued behind the samples, so it only gets saved once they are all in the file
+        self.writer.write(Checkpoint(self.path, self.dataFormat, readerCount, wallTime, currentTime, complete))
+        self.lastCheckpoint = time.time()
+
+    # as a sink of the sampling loop
+    def onStart(self):
+        if self.resumed:
+            # the header is already in the file
+            self.rawFormat = RawCaptureFormat(len(channels.Channels), self.rawVersion)
+        else:
+            self.issueHeaderString()
+
+    def onScan(self, readerCount, wallTime, currentTime):
+        if self.deadband is None or self.deadband.shouldWrite(currentTime):
+            self.issueReport(readerCount, wallTime, currentTime)
+        self.lastScan = (readerCount, wallTime, currentTime)
+        if config.checkpointEverySeconds is not None and time.time() - self.lastCheckpoint >= config.checkpointEverySeconds:
+            self.issueCheckpoint(readerCount, wallTime, currentTime)
+
+    def onComplete(self, message):
+        if config.checkpointEverySeconds is not None and self.lastScan is not None:
+            self.issueCheckpoint(*self.lastScan, complete=True)
+        self.close()
+        if self.deadband is not None:
+            print "Deadband compression: wrote %s of %s samples" % (self.deadband.written, self.deadband.seen)
+
+    @staticmethod
+    def formatHeaderString(summary, channelNamesAndUnits, quality=True, burst=False):
+        s = summary
+        s += "ReadCount,TimeStamp,SecondsSinceStarting,LogarithmSeconds,"
+        for name, units in channelNamesAndUnits:
+            s += "Bits_%s," % name
+        for name, units in channelNamesAndUnits:
+            s += "Volts_%s," % name
+        for name, units in channelNamesAndUnits:
+            s += "Processed_%s%s," % (name, units)
+        if quality:
+            # the scan's QUALITY_ flags
+            s += "Quality,"
+        if burst:
+            # see Configuration.burstStatistics
+            for name, units in channelNamesAndUnits:
+                s += "Count_%s," % name
+            for name, units in channelNamesAndUnits:
+                s += "StdBits_%s," % name
+        return s + "\n" # is this cross-platform?
+
+    @staticmethod
+    def formatTimes(readerCount, wallTime, currentTime):
+        # integer count, timestamp, time-secs, log(time-secs)
+        times = []
+        times.append(str(readerCount))
+        times.append(str(datetime.fromtimestamp(wallTime)))
+        times.append(str(round(currentTime, 4)))
+        times.append(str(round(math.log(currentTime), 4)))
+        return times
+
+    @staticmethod
+    def parseTimeStamp(text):
+        # back to a wall clock time from the TimeStamp column (local time, whole seconds drop the fraction)
+        stamp = datetime.strptime(text, '%Y-%m-%d %H:%M:%S.%f' if '.' in text else '%Y-%m-%d %H:%M:%S')
+        return time.mktime(stamp.timetuple()) + stamp.microsecond / 1e6
+
+class DeadbandFilter():
+
+    # decides whether a scan is different enough from the last one written to be worth writing
+    def __init__(self, deadbands, maxInterval):
+        byName = dict((ch.name, ch) for ch in channels.AllChannels())
+        self.watched = [(byName[name], band) for name, band in deadbands.items() if name in byName]
+        self.maxInterval = maxInterval
+        self.lastWritten = None
+        self.lastTime = None
+        self.seen = 0
+        self.written = 0
+
+    def shouldWrite(self, currentTime):
+        self.seen += 1
+        values = [ch.value for ch, band in self.watched]
+        write = self.lastWritten is None or currentTime - self.lastTime >= self.maxInterval
+        if not write:
+            for i in range(len(self.watched)):
+                value, last = values[i], self.lastWritten[i]
+                # a reading dropping out (nan) or coming back counts as a change too
+                if (value != value) != (last != last) or abs(value - last) > self.watched[i][1]:
+                    write = True
+                    break
+        if write:
+            self.lastWritten = values
+            self.lastTime = currentTime
+            self.written += 1
+        return write
+
+class AdaptiveTimeStep():
+
+    # picks the time step from how fast the watched channels changed over the last step
+    def __init__(self, minStep, maxStep, rateThresholds):
+        byName = dict((ch.name, ch) for ch in channels.AllChannels())
+        self.watched = [(byName[name], threshold) for name, threshold in rateThresholds.items() if name in byName]
+        self.minStep = minStep
+        self.maxStep = maxStep
+        # start out fast, the start of a test is where the transients are
+        self.step = minStep
 
-class DataReader():
+    def getTimeStep(self, currentTime):
+        # the fastest change relative to its threshold, over the last two samples of each channel
+        ratio = 0.0
+        for ch, threshold in self.watched:
+            times, values = ch.history.latest(2)
+            if len(times) == 2 and times[1] > times[0]:
+                rate = abs(values[1] - values[0]) / (times[1] - times[0])
+                if rate == rate:
+                    ratio = max(ratio, rate / threshold)
+        if ratio > 1.0:
+            self.step = max(self.minStep, self.step / 2)
+        elif ratio < 0.25:
+            self.step = min(self.maxStep, self.step * 1.25)
+        return self.step
+
+class RuleEngine():
+
+    # checks the rules of Configuration.rules after every scan
+    #   each rule is expanded up front into one condition per channel it watches, and the conditions are
+    #   kept in flat arrays, so checking all of them is the same handful of numpy operations however many
+    #   rules and channels there are; python only loops over conditions in the scan they start firing
+    kinds = ('elapsed', 'above', 'below', 'rate', 'stale')
+    actions = ('stop', 'step', 'notify')
+
+    def __init__(self, rules):
+        self.channelList = channels.AllChannels()
+        byName = dict((ch.name, i) for i, ch in enumerate(self.channelList))
+        self.rules = list(rules)
+        ruleOf = []
+        channelOf = []
+        for r in range(len(self.rules)):
+            rule = self.rules[r]
+            name = rule.get('name', 'rule %s' % (r + 1))
+            if rule.get('kind') not in self.kinds:
+                raise ValueError("%s: the kind has to be one of %s" % (name, ", ".join(self.kinds)))
+            if rule.get('action', 'notify') not in self.actions:
+                raise ValueError("%s: the action has to be one of %s" % (name, ", ".join(self.actions)))
+            if rule.get('action') == 'step' and not rule.get('timeStep', 0) > 0:
+                raise ValueError("%s: a step rule needs a timeStep (in seconds)" % name)
+            if rule['kind'] == 'elapsed':
+                # not about any channel, but it still needs a place in the arrays
+                watched = [0]
+            elif rule.get('channels') == '*':
+                watched = range(len(self.channelList))
+            else:
+                missing = [n for n in rule.get('channels', []) if n not in byName]
+                if missing or not rule.get('channels'):
+                    raise ValueError("%s: no channel called %s" % (name, ", ".join(missing) or "(no channels given)"))
+                watched = [byName[n] for n in rule['channels']]
+            ruleOf += [r] * len(watched)
+            channelOf += watched
+        self.ruleOf = numpy.array(ruleOf, dtype=numpy.intp)
+        self.channelOf = numpy.array(channelOf, dtype=numpy.intp)
+        kind = numpy.array([self.rules[r]['kind'] for r in ruleOf], dtype=object)
+        action = numpy.array([self.rules[r].get('action', 'notify') for r in ruleOf], dtype=object)
+        self.limits = numpy.array([self.rules[r].get('limit', 0.0) for r in ruleOf], dtype=numpy.float64)
+        self.durations = numpy.array([self.rules[r].get('duration', 0.0) for r in ruleOf], dtype=numpy.float64)
+        # 'below' is 'above' with the signs flipped
+        self.signs = numpy.where(kind == 'below', -1.0, 1.0)
+        self.limits *= self.signs
+        self.thresholds = numpy.flatnonzero((kind == 'above') | (kind == 'below'))
+        self.rates = numpy.flatnonzero(kind == 'rate')
+        self.stales = numpy.flatnonzero(kind == 'stale')
+        self.elapseds = numpy.flatnonzero(kind == 'elapsed')
+        self.steps = numpy.flatnonzero(action == 'step')
+        self.stepSizes = numpy.array([self.rules[self.ruleOf[c]]['timeStep'] for c in self.steps], dtype=numpy.float64)
+        # the latest scans of every channel, as many as the longest rate rule looks back, in a ring
+        self.lags = numpy.array([max(1, int(self.rules[self.ruleOf[c]].get('samples', 1))) for c in self.rates], dtype=numpy.intp)
+        self.windowRows = 1 + (self.lags.max() if len(self.lags) else 1)
+        self.window = numpy.empty((self.windowRows, len(self.channelList)), dtype=numpy.float64)
+        self.windowTimes = numpy.empty(self.windowRows, dtype=numpy.float64)
+        self.reset()
+
+    def reset(self):
+        self.window.fill(float('nan'))
+        self.windowTimes.fill(float('nan'))
+        self.row = 0
+        self.lastValid = None
+        # when each condition started holding (nan while it doesn't), and whether it's firing
+        self.since = numpy.empty(len(self.ruleOf), dtype=numpy.float64)
+        self.since.fill(float('nan'))
+        self.firing = numpy.zeros(len(self.ruleOf), dtype=bool)
+        self.stopMessage = None
+        self.timeStep = None
+
+    def evaluate(self, currentTime):
+        # check every condition against the scan just taken, and return messages for the rules that just fired
+        values = numpy.fromiter((ch.value for ch in self.channelList), numpy.float64, len(self.channelList))
+        self.row = (self.row + 1) % self.windowRows
+        self.window[self.row] = values
+        self.windowTimes[self.row] = currentTime
+        if self.lastValid is None:
+            # a channel that never reads counts as stale from the first scan
+            self.lastValid = numpy.empty(len(self.channelList), dtype=numpy.float64)
+            self.lastValid.fill(currentTime)
+        self.lastValid[values == values] = currentTime
+
+        # what each condition measures, to be compared with its limit (nan never passes)
+        measured = numpy.empty(len(self.ruleOf), dtype=numpy.float64)
+        measured[self.thresholds] = self.signs[self.thresholds] * values[self.channelOf[self.thresholds]]
+        if len(self.rates):
+            earlier = (self.row - self.lags) % self.windowRows
+            chans = self.channelOf[self.rates]
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                measured[self.rates] = numpy.abs(values[chans] - self.window[earlier, chans]) / (currentTime - self.windowTimes[earlier])
+        measured[self.stales] = currentTime - self.lastValid[self.channelOf[self.stales]]
+        measured[self.elapseds] = currentTime
+        with numpy.errstate(invalid='ignore'):
+            holding = measured > self.limits
+            self.since[~holding] = float('nan')
+            self.since[holding & (self.since != self.since)] = currentTime
+            firing = holding & (currentTime - self.since >= self.durations)
+        started = firing & ~self.firing
+        self.firing = firing
+
+        if len(self.steps):
+            stepping = firing[self.steps]
+            self.timeStep = self.stepSizes[stepping].min() if stepping.any() else None
+        if not started.any():
+            return []
+        return self.describe(numpy.flatnonzero(started), values, currentTime)
+
+    def describe(self, started, values, currentTime):
+        # one message per rule that just started firing, naming the channels that set it off
+        messages = []
+        for r in numpy.unique(self.ruleOf[started]):
+            rule = self.rules[r]
+            name = rule.get('name', 'rule %s' % (r + 1))
+            if rule['kind'] == 'elapsed':
+                detail = '%s s elapsed' % round(currentTime, 1)
+            else:
+                detail = ', '.join('%s = %.3f %s' % (self.channelList[i].name, values[i], self.channelList[i].units)
+                                   for i in self.channelOf[started[self.ruleOf[started] == r]])
+            message = '%s (%s): %s' % (name, rule['kind'], detail)
+            if rule.get('action') == 'stop' and self.stopMessage is None:
+                self.stopMessage = message
+                message += ', stopping'
+            elif rule.get('action') == 'step':
+                message += ', time step %s s' % rule['timeStep']
+            messages.append(message)
+        return messages
+
+class BackgroundWriter(Thread):
+
+    # writes strings handed to it from other threads out to a file, in batches, on its own thread
+    def __init__(self, outFile, queueSize, flushPolicy, flushEverySeconds):
+        Thread.__init__(self)
+        self.daemon = True
+        self.outFile = outFile
+        self.queue = Queue(maxsize=queueSize)
+        self.flushPolicy = flushPolicy
+        self.flushEverySeconds = flushEverySeconds
+        self.error = None
+
+    def write(self, data):
+        # if the writer died, say so here rather than quietly filling the queue and then blocking forever
+        if self.error is not None:
+            raise self.error
+        self.queue.put(data)
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        lastFlush = time.time()
+        done = False
+        try:
+            while not done:
+                try:
+                    batch = [self.queue.get(timeout=self.flushEverySeconds)]
+                except Empty:
+                    batch = []
+                # grab whatever else is already waiting so it all goes out in one write
+                while True:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Empty:
+                        break
+                if None in batch:
+                    batch = batch[:batch.index(None)]
+                    done = True
+                if batch:
+                    self.writeBatch(batch)
+                if done or time.time() - lastFlush >= self.flushEverySeconds:
+                    self.flush()
+                    lastFlush = time.time()
+        except Exception as exception:
+            self.error = exception
+        finally:
+            self.outFile.close()
+
+    def writeBatch(self, batch):
+        # strings go straight out; a checkpoint is saved once everything queued ahead of it is on the disk
+        if metrics.enabled:
+            started = monotonicTime()
+            metrics.count('file_write_bytes_total', sum(len(item) for item in batch if not isinstance(item, Checkpoint)))
+        pending = []
+        for item in batch:
+            if isinstance(item, Checkpoint):
+                self.outFile.write("".join(pending))
+                pending = []
+                self.outFile.flush()
+                os.fsync(self.outFile.fileno())
+                item.save(self.outFile.tell())
+            else:
+                pending.append(item)
+        if pending:
+            self.outFile.write("".join(pending))
+        if metrics.enabled:
+            metrics.observe('file_write_seconds', monotonicTime() - started)
+
+    def flush(self):
+        if metrics.enabled:
+            started = monotonicTime()
+        if self.flushPolicy in ('flush', 'fsync'):
+            self.outFile.flush()
+        if self.flushPolicy == 'fsync':
+            os.fsync(self.outFile.fileno())
+        if metrics.enabled:
+            metrics.observe('file_flush_seconds', monotonicTime() - started)
+
+class Checkpoint():
+
+    # the state of a run as of one sample, saved next to its data file as <data file>.checkpoint
+    #   along with how long the file was at that sample, see resumeDataFile for the other end
+    def __init__(self, dataPath, dataFormat, readerCount, wallTime, currentTime, complete=False):
+        self.path = dataPath + '.checkpoint'
+        # the channel statistics are copied now, on the sampling thread, while they match the sample
+        self.state = {
+            'dataFormat': dataFormat,
+            'readerCount': readerCount,
+            'wallTime': wallTime,
+            'currentTime': currentTime,
+            'complete': complete,
+            'channels': dict((ch.name, ch.stats.getState()) for ch in channels.AllChannels()),
+        }
+
+    def save(self, dataBytes):
+        # write a new file and rename it over the old one, so there is always one whole checkpoint on the disk
+        self.state['dataBytes'] = dataBytes
+        temporary = self.path + '.tmp'
+        with open(temporary, 'wb') as outFile:
+            json.dump(self.state, outFile)
+            outFile.flush()
+            os.fsync(outFile.fileno())
+        os.rename(temporary, self.path)
+        # and make sure the rename itself is on the disk
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+def resumeDataFile(dataPath):
+    # get ready to carry on a test that stopped, with the same data file: restore the channel statistics
+    #   from the checkpoint, replay the samples written after it, and find where the last complete sample ends
+    #   only the part of the file since the checkpoint is read, so this is quick however long the test has run
+    #   returns a dictionary of the data file's path, format and length to keep, and the last sample's
+    #   count, wall clock time and seconds since starting; call it after the channels' initData()
+    if dataPath.endswith('.checkpoint'):
+        dataPath = dataPath[:-len('.checkpoint')]
+    with open(dataPath, 'rb') as inFile:
+        # the header says which channels the file has, which had better be the ones configured now
+        if inFile.read(len(RawCaptureFormat.magic)) == RawCaptureFormat.magic:
+            inFile.seek(0)
+            header, rawFormat = RawCaptureFormat.readHeader(inFile)
+            dataFormat = 'binary'
+            names = [c['name'] for c in header['channels']]
+            qualityColumn = rawFormat.version >= 2
+            burstColumns = False
+        else:
+            inFile.seek(0)
+            dataFormat = 'csv'
+            while True:
+                line = inFile.readline()
+                if not line:
+                    raise ValueError("%s doesn't have a ReadCount,... column header line" % dataPath)
+                if line.startswith('ReadCount,'):
+                    break
+            names = [column[len('Bits_'):] for column in line.strip().split(',') if column.startswith('Bits_')]
+            qualityColumn = 'Quality' in line.strip().split(',')
+            burstColumns = ('Count_%s' % names[0]) in line.strip().split(',') if names else False
+            rawFormat = RawCaptureFormat(len(names))
+        if names != [ch.name for ch in channels.Channels]:
+            raise ValueError("%s was recorded with the channels %s, not the ones configured now" % (dataPath, ", ".join(names)))
+        resume = {'dataPath': dataPath, 'dataFormat': dataFormat, 'dataBytes': inFile.tell(),
+                  'rawVersion': rawFormat.version, 'qualityColumn': qualityColumn, 'burstColumns': burstColumns,
+                  'readerCount': 0, 'wallTime': None, 'currentTime': 0.0}
+
+        # without a checkpoint (it stopped before the first one) everything after the header gets replayed
+        checkpointPath = dataPath + '.checkpoint'
+        if os.path.exists(checkpointPath):
+            with open(checkpointPath, 'rb') as checkpointFile:
+                state = json.load(checkpointFile)
+            for ch in channels.AllChannels():
+                if ch.name in state['channels']:
+                    ch.stats.setState(state['channels'][ch.name])
+            for key in ('dataBytes', 'readerCount', 'wallTime', 'currentTime'):
+                resume[key] = state[key]
+        inFile.seek(resume['dataBytes'])
+        tail = inFile.read()
+
+    # the complete samples written after the checkpoint; a half written one at the end is dropped
+    numChannels = len(channels.Channels)
+    if dataFormat == 'binary':
+        whole = len(tail) // rawFormat.recordType.itemsize
+        complete = whole * rawFormat.recordType.itemsize
+        records = numpy.frombuffer(tail[:complete], dtype=rawFormat.recordType)
+        counts, wallTimes, times, bits = records['count'], records['wallTime'], records['elapsed'], records['bits']
+    else:
+        counts, wallTimes, times, bits = [], [], [], []
+        complete = 0
+        for line in tail.splitlines(True):
+            fields = line.rstrip('\r\n').split(',')
+            if not line.endswith('\n') or len(fields) != 4 + (3 + 2 * burstColumns) * numChannels + qualityColumn:
+                break
+            try:
+                row = (int(fields[0]), IOStuff.parseTimeStamp(fields[1]), float(fields[2]),
+                       [float(x) for x in fields[4:4 + numChannels]])
+            except ValueError:
+                break
+            counts.append(row[0])
+            wallTimes.append(row[1])
+            times.append(row[2])
+            bits.append(row[3])
+            complete += len(line)
+    resume['dataBytes'] += complete
+    if len(counts):
+        channels.ProcessBatch(times, numpy.array(bits, dtype=numpy.float64).reshape(len(counts), numChannels))
+        resume['readerCount'] = int(counts[-1])
+        resume['wallTime'] = float(wallTimes[-1])
+        resume['currentTime'] = float(times[-1])
+    return resume
+
+class RawCaptureFormat():
+
+    # binary capture layout, all little-endian:
+    #   8 byte magic, uint16 version, uint32 length of the json header, the json header itself
+    #   (project info summary and channel metadata), then fixed size records of:
+    #   uint32 read count, float64 wall clock time, float64 seconds since starting, uint16 scan quality flags
+    #   (from version 2 on), float32 bits per channel
+    #   float32 keeps the -999999 timeout value and is exact for the converter's 12 bit words
+    magic = 'SDA12RAW'
+    version = 2
+    preamble = struct.Struct('<8sHI')
+
+    def __init__(self, numChannels, version=None):
+        self.numChannels = numChannels
+        if version is not None:
+            self.version = version
+        if self.version >= 2:
+            self.record = struct.Struct('<IddH%df' % numChannels)
+            self.recordType = numpy.dtype([('count', '<u4'), ('wallTime', '<f8'), ('elapsed', '<f8'), ('quality', '<u2'), ('bits', '<f4', (numChannels,))])
+        else:
+            self.record = struct.Struct('<Idd%df' % numChannels)
+            self.recordType = numpy.dtype([('count', '<u4'), ('wallTime', '<f8'), ('elapsed', '<f8'), ('bits', '<f4', (numChannels,))])
+
+    def headerBytes(self, summary, channelList):
+        header = json.dumps({
+            'summary': summary,
+            'channels': [{'name': ch.name, 'units': ch.units, 'plot': ch.plot} for ch in channelList],
+            'milliVoltsPerBit': config.milliVoltsPerBit,
+            'minimumBits': config.minimumBits,
+            'maximumBits': config.maximumBits,
+        })
+        return self.preamble.pack(self.magic, self.version, len(header)) + header
+
+    def packRecord(self, readerCount, wallTime, currentTime, rawBits, quality=0):
+        if self.version >= 2:
+            return self.record.pack(readerCount, wallTime, currentTime, quality, *rawBits)
+        return self.record.pack(readerCount, wallTime, currentTime, *rawBits)
+
+    @classmethod
+    def readHeader(cls, inFile):
+        # returns (header dictionary, format instance for the file's version) and leaves the file at the first record
+        magic, version, length = cls.preamble.unpack(inFile.read(cls.preamble.size))
+        if magic != cls.magic or not 1 <= version <= cls.version:
+            raise ValueError("%s is not a version 1 to %s raw capture file" % (inFile.name, cls.version))
+        header = json.loads(inFile.read(length))
+        return header, cls(len(header['channels']), version)
+
+    def readRecords(self, inFile, chunkSize=10000):
+        # yield structured arrays of up to chunkSize records, ignoring a partial record at the very end
+        while True:
+            data = inFile.read(chunkSize * self.recordType.itemsize)
+            whole = len(data) // self.recordType.itemsize
+            if whole == 0:
+                break
+            yield numpy.frombuffer(data[:whole * self.recordType.itemsize], dtype=self.recordType)
+
+class ColumnarStore(AcquisitionSink):
+
+    # records the run as a directory of little-endian float64 arrays that only ever get appended to:
+    #   time.f8 (seconds since starting), wall.f8 (wall clock), quality.f8 (the scan's QUALITY_ flags),
+    #   <channel>.bits.f8, <channel>.volts.f8, <channel>.value.f8 for every channel (derived ones too),
+    #   plus time.idx, a sparse index holding every indexStride-th time, and meta.json describing it all
+    #   the time column is shared by all channels, since they are all read in the same scan
+    indexStride = 4096
+    blockRows = 256
 
     def __init__(self):
+        self.path = os.path.join(config.baseDir(), "store-%s" % datetime.now().strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(self.path)
+        self.channelList = channels.AllChannels()
+        self.columns = ['time', 'wall', 'quality']
+        for ch in self.channelList:
+            self.columns += ['%s.bits' % ch.name, '%s.volts' % ch.name, '%s.value' % ch.name]
+        # rows are collected into a block here, and whole blocks go out on the writer thread
+        self.block = numpy.empty((self.blockRows, len(self.columns)), dtype='<f8')
+        self.blockFill = 0
+        self.rows = 0
+        self.queue = Queue(maxsize=config.writerQueueSize)
+        self.writerThread = Thread(target=self.writeBlocks)
+        self.writerThread.daemon = True
+
+    def onStart(self):
+        with open(os.path.join(self.path, 'meta.json'), 'w') as metaFile:
+            json.dump({
+                'summary': info.GetSummary(),
+                'channels': [{'name': ch.name, 'units': ch.units, 'plot': ch.plot} for ch in self.channelList],
+                'columns': self.columns,
+                'indexStride': self.indexStride,
+            }, metaFile, indent=2)
+        self.files = [open(os.path.join(self.path, '%s.f8' % column), 'ab') for column in self.columns]
+        self.indexFile = open(os.path.join(self.path, 'time.idx'), 'ab')
+        self.writerThread.start()
+
+    def onScan(self, readerCount, wallTime, currentTime):
+        row = self.block[self.blockFill]
+        row[0] = currentTime
+        row[1] = wallTime
+        row[2] = channels.ScanQuality
+        i = 3
+        for ch in self.channelList:
+            row[i] = ch.bits
+            row[i + 1] = ch.volts
+            row[i + 2] = ch.value
+            i += 3
+        self.blockFill += 1
+        if self.blockFill == self.blockRows:
+            self.flushBlock()
+
+    def onComplete(self, message):
+        self.flushBlock()
+        self.queue.put(None)
+        self.writerThread.join()
+
+    def flushBlock(self):
+        if self.blockFill == 0:
+            return
+        self.queue.put((self.rows, self.block[:self.blockFill].copy()))
+        self.rows += self.blockFill
+        self.blockFill = 0
+
+    def writeBlocks(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            firstRow, block = item
+            for column in range(len(self.columns)):
+                numpy.ascontiguousarray(block[:, column]).tofile(self.files[column])
+            # index entries for any multiples of the stride that fall in this block
+            first = -(-firstRow // self.indexStride) * self.indexStride
+            block[first - firstRow::self.indexStride, 0].tofile(self.indexFile)
+            for f in self.files + [self.indexFile]:
+                f.flush()
+        for f in self.files + [self.indexFile]:
+            f.close()
+
+class ColumnarStoreReader():
+
+    # opens a ColumnarStore directory; everything handed back is a memory-mapped view, nothing is read
+    #   until it's actually used, so opening even a multi-day run and pulling out a window is quick
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as metaFile:
+            self.meta = json.load(metaFile)
+        self.indexStride = self.meta['indexStride']
+        # if the run was cut off, some columns may be a block ahead of others; only use complete rows
+        self.rows = min(os.path.getsize(os.path.join(path, '%s.f8' % column)) // 8 for column in self.meta['columns'])
+        self.times = self.column('time')
+        indexEntries = min(os.path.getsize(os.path.join(path, 'time.idx')) // 8, -(-self.rows // self.indexStride))
+        self.index = self.mapFile('time.idx', indexEntries)
+
+    def channelNames(self):
+        return [c['name'] for c in self.meta['channels']]
+
+    def mapFile(self, fileName, count):
+        if count == 0:
+            return numpy.empty(0, dtype='<f8')
+        return numpy.memmap(os.path.join(self.path, fileName), dtype='<f8', mode='r', shape=(count,))
+
+    def column(self, name):
+        # a whole column, 'time', 'wall', 'quality' or '<channel>.bits', '<channel>.volts', '<channel>.value'
+        return self.mapFile('%s.f8' % name, self.rows)
+
+    def locate(self, t, side):
+        # the row where t would go in the time column, narrowed down with the sparse index first so only
+        #   a single stride's worth of the time column gets touched
+        k = numpy.searchsorted(self.index, t, side)
+        lo = max(0, (k - 1) * self.indexStride)
+        hi = self.rows if k >= len(self.index) else min(self.rows, k * self.indexStride + 1)
+        return lo + numpy.searchsorted(self.times[lo:hi], t, side)
+
+    def rowRange(self, startTime, endTime):
+        # (first, last + 1) rows with startTime <= time <= endTime
+        return self.locate(startTime, 'left'), self.locate(endTime, 'right')
+
+    def read(self, channelName, startTime=None, endTime=None, kind='value'):
+        # (times, values) views of one channel over a time window (all of it by default)
+        #   kind is 'value', 'volts' or 'bits'
+        first = 0 if startTime is None else self.locate(startTime, 'left')
+        last = self.rows if endTime is None else self.locate(endTime, 'right')
+        return self.times[first:last], self.column('%s.%s' % (channelName, kind))[first:last]
+
+def convertRawCapture(rawPath, csvPath=None):
+    # regenerate the usual csv layout from a binary raw capture, using the current channel conversions
+    #   channels are matched up by name, so a recorded channel that no longer exists just comes out as nan
+    if csvPath is None:
+        csvPath = os.path.splitext(rawPath)[0].replace('raw-', 'data-') + '.csv'
+    byName = dict((ch.name, ch.processor) for ch in channels.Channels)
+    nanProcessor = lambda volts: volts * float('nan')
+    with open(rawPath, 'rb') as inFile:
+        header, rawFormat = RawCaptureFormat.readHeader(inFile)
+        recorded = [(c['name'], c['units']) for c in header['channels']]
+        processors = [byName.get(name, nanProcessor) for name, units in recorded]
+        quality = rawFormat.version >= 2
+        with open(csvPath, 'wb') as outFile:
+            outFile.write(IOStuff.formatHeaderString(header['summary'], recorded, quality))
+            for records in rawFormat.readRecords(inFile):
+                bits, volts, values = channels.convertBatch(records['bits'], processors)
+                for i in range(len(records)):
+                    s_time = ",".join(IOStuff.formatTimes(records['count'][i], records['wallTime'][i], records['elapsed'][i]))
+                    s_bits = ",".join("%10.3f" % x for x in bits[i])
+                    s_volts = ",".join("%10.3f" % x for x in volts[i])
+                    s_vals = ",".join("%10.3f" % x for x in values[i])
+                    s = ",".join([s_time, s_bits, s_volts, s_vals])
+                    if quality:
+                        s += ",%d" % records['quality'][i]
+                    outFile.write(s + "\n")
+    return csvPath
+
+burstReductions = ('mean', 'median', 'trimmed')
+
+def reduceBurst(scans, reduction='mean', trimFraction=0.1):
+    # combine a burst of scans, one per row, into a reading per channel (column), all in one go
+    #   readings that are missing (-999999) or out of range are left out
+    #   returns (readings, counts, standard deviations), with -999999 for a channel without a single good reading
+    scans = numpy.array(scans, dtype=numpy.float64)
+    scans[(scans < config.minimumBits) | (scans > config.maximumBits)] = float('nan')
+    good = scans == scans
+    counts = good.sum(axis=0)
+    zeroed = numpy.where(good, scans, 0.0)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        means = zeroed.sum(axis=0) / counts
+        stds = numpy.sqrt(numpy.square(numpy.where(good, scans - means, 0.0)).sum(axis=0) / (counts - 1))
+        if reduction == 'mean':
+            readings = means
+        else:
+            # sorting puts the missing readings at the bottom of each column, under the counts good ones
+            ordered = numpy.sort(scans, axis=0)
+            columns = numpy.arange(scans.shape[1])
+            if reduction == 'median':
+                readings = 0.5 * (ordered[(counts - 1) // 2, columns] + ordered[counts // 2, columns])
+            else:
+                # the sum of the middle rows from a running sum down the columns
+                trim = numpy.floor(counts * trimFraction).astype(numpy.intp)
+                sums = numpy.zeros((scans.shape[0] + 1, scans.shape[1]))
+                numpy.cumsum(numpy.where(ordered == ordered, ordered, 0.0), axis=0, out=sums[1:])
+                readings = (sums[counts - trim, columns] - sums[trim, columns]) / (counts - 2 * trim)
+    readings[counts == 0] = -999999
+    return readings, counts, numpy.where(counts > 1, stds, float('nan'))
+
+class DataReader():
+
+    # reads one module; by default the one at getPortName() with all the channels on it
+    def __init__(self, portName=None, channelList=None):
+
+        if portName is None:
+            portName = config.getPortName()
+        if channelList is None:
+            channelList = channels.Channels
+        self.portName = portName
+        self.channelList = channelList
 
         # for testing, you can enable this flag so it won't try to actually read data from the device
         #   instead it will just generate random values
@@ -227,411 +1981,568 @@ class DataReader():
         # if we aren't faking the data, then open the serial port here
         if not self.fakeDataSource:
 
+            # for serial communication, we import the python-serial library
+            import serial
+
+            # what a port that has gone away (an unplugged USB adapter) can raise; on posix pyserial
+            #   lets some termios errors straight through
+            self.serialErrors = (serial.SerialException, OSError, IOError)
+            try:
+                import termios
+                self.serialErrors += (termios.error,)
+            except ImportError:
+                pass
+
             # configure the serial connections
-            self.ser = serial.Serial(port=config.getPortName(), baudrate=2400, timeout=0.025)
+            self.ser = serial.Serial(port=self.portName, baudrate=config.baudRate, timeout=0.025)
 
-            # open the serial connection
-            self.ser.open()
+            # open the serial connection (newer pyserial versions already opened it when given the port)
+            if not self.ser.isOpen():
+                self.ser.open()
+
+            # a bulk read has to wait for the whole response: 2 bytes per channel, 10 bits per byte on the wire
+            if config.bulkRead:
+                self.ser.timeout = config.serialLatency + (2 * len(self.channelList) * 10.0) / config.baudRate
 
         # initialize a constant for convenience
         self.iZeroChar = ord('0') # should be 48, but this looks a bit nicer
 
-    def DoOneIteration(self, curTime):
+        # the least a scan can take, for its response to cross the wire: 2 bytes per channel, 10 bits per byte
+        self.minScanTime = (2 * len(self.channelList) * 10.0) / config.baudRate
+
+        # whether a scan request has already been sent ahead (see Configuration.pipelineRequests)
+        self.requestPending = False
+
+        # how the latest scan went, and when to next try reopening the port if it goes away
+        self.quality = 0
+        # in burst mode, the scans taken since the last sample, and how they went
+        self.burstScans = []
+        self.burstQuality = 0
+        self.reconnectDelay = config.reconnectDelay
+        self.nextReconnect = 0.0
+
+    def DoOneIteration(self, curTime, retryUntil=None):
+        # retryUntil: the monotonicTime() past which a bad scan isn't taken again, None for no limit
+        #   how the scan went ends up in self.quality (see the QUALITY_ flags)
+        self.quality = 0
+        reads = self.TakeScan(retryUntil)
+        if config.burstSampling:
+            # this scan is the last of the burst, the sample is all of them together
+            self.burstScans.append(reads)
+            reads, counts, stds = reduceBurst(self.burstScans, config.burstReduction, config.burstTrimFraction)
+            self.quality |= self.burstQuality
+            self.burstScans = []
+            self.burstQuality = 0
+        # process each reading by the channel itself
+        for ch, read in zip(self.channelList, reads):
+            ch.Process(curTime, read)
+        if config.burstSampling:
+            for i in range(len(self.channelList)):
+                self.channelList[i].burstCount = counts[i]
+                self.channelList[i].burstStd = stds[i]
+
+    def BurstScan(self, retryUntil=None):
+        # one of the extra scans between samples in burst mode, kept until the sample combines them
+        #   returns None, or the monotonicTime() before which there's no point trying another one
+        self.quality = 0
+        if len(self.burstScans) >= config.burstMaxScans:
+            if metrics.enabled:
+                metrics.count('burst_overflows_total')
+            return float('inf')
+        if not self.fakeDataSource and not self.ser.isOpen():
+            # with the port gone, only try again when it's due to be reopened (the sample's own scan
+            #   records it as disconnected), rather than piling up missing scans
+            if monotonicTime() < self.nextReconnect or not self.Reconnect():
+                return self.nextReconnect
+        self.burstScans.append(self.TakeScan(retryUntil))
+        self.burstQuality |= self.quality
+        if metrics.enabled:
+            metrics.count('burst_scans_total')
+        return None
+
+    def TakeScan(self, retryUntil=None):
+        # read one scan of the module, returning the readings in channel order (-999999 for missing ones)
+        #   and or-ing how it went into self.quality
 
         # configure channels here, and transmit character
-        numChannels = len(channels.Channels)
+        numChannels = len(self.channelList)
         maxChannel = numChannels - 1 # zero-based
         cMaxChannel = chr(self.iZeroChar + maxChannel)
 
+        # with the port gone, every reading is missing until it can be opened again
+        if not self.fakeDataSource and not self.ser.isOpen() and not self.Reconnect():
+            self.quality |= QUALITY_DISCONNECTED
+            reads = [-999999] * numChannels
+        else:
+            try:
+                if config.bulkRead and not self.fakeDataSource:
+                    reads = self.ReadScan('!0RA' + cMaxChannel, numChannels, retryUntil)
+                else:
+                    reads = self.ReadScanBytes('!0RA' + cMaxChannel, numChannels)
+            except self.serialErrors as exception:
+                # most likely the USB adapter got unplugged; carry on sampling and try to reopen it
+                self.Disconnect(exception)
+                self.quality |= QUALITY_DISCONNECTED
+                reads = [-999999] * numChannels
+        if -999999 in reads:
+            self.quality |= QUALITY_TIMEOUT
+        return reads
+
+    def ReadScanBytes(self, request, numChannels):
+        # the original way, two 1-byte reads per channel, returning the readings in channel order
+        reads = [-999999] * numChannels
         # send a transmit signal
         if not self.fakeDataSource:
-            self.ser.write('!0RA' + cMaxChannel)
-        # loop over all channels
-        for ch in reversed(channels.Channels):
+            if metrics.enabled:
+                started = monotonicTime()
+            self.ser.flushInput()
+            self.ser.write(request)
+            if metrics.enabled:
+                metrics.observe('serial_write_seconds', monotonicTime() - started)
+        # loop over all channels, the module sends the highest one first
+        for channel in reversed(range(numChannels)):
             if self.fakeDataSource:
                 msb = chr(randint(18,20))
                 lsb = chr(randint(1,3))
             else:
                 # read msb and lsb bytes
+                if metrics.enabled:
+                    started = monotonicTime()
                 msb = self.ser.read(1)
                 lsb = self.ser.read(1)
+                if metrics.enabled:
+                    metrics.observe('serial_read_seconds', monotonicTime() - started)
             # check for errors
             if msb == '' or lsb == '':
-                # could not receive data
-                read = -999999
-            else:
-                # calculate a reading value
-                read = (ord(msb)*256) + ord(lsb)
-            # process this by the channel itself
-            ch.Process(curTime, read)
+                # could not receive data, and any bytes after a lost one would be paired up wrong,
+                #   so leave the rest of this scan missing and throw away whatever else turns up
+                if not self.fakeDataSource:
+                    self.ser.flushInput()
+                self.quality |= QUALITY_RESYNC
+                break
+            # calculate a reading value
+            reads[channel] = (ord(msb)*256) + ord(lsb)
+        return reads
+
+    def ReadScan(self, request, numChannels, retryUntil=None):
+        # send the request (unless it went out ahead of time) and read the whole response at once
+        #   a response that comes back short, or with more bytes behind it, is out of step with the
+        #   channels; the input is thrown away and the scan taken again, while there's time for it
+        for attempt in range(config.serialRetries + 1):
+            timing = metrics.enabled
+            if timing:
+                started = monotonicTime()
+            if not self.requestPending:
+                # anything still waiting is left over from an earlier response that went wrong
+                self.ser.flushInput()
+                self.ser.write(request)
+            if timing:
+                written = monotonicTime()
+            data = self.ser.read(2 * numChannels)
+            stray = self.ser.inWaiting()
+            if timing:
+                metrics.observe('serial_write_seconds', written - started)
+                metrics.observe('serial_read_seconds', monotonicTime() - written)
+                if len(data) < 2 * numChannels:
+                    metrics.count('short_reads_total')
+            if len(data) == 2 * numChannels and not stray:
+                # get the module started on the next scan while we deal with this one
+                if config.pipelineRequests:
+                    self.ser.write(request)
+                self.requestPending = config.pipelineRequests
+                return self.ParseResponse(data, numChannels)
+            # out of step: start over from a clean input, without any request sent ahead
+            self.quality |= QUALITY_RESYNC
+            self.requestPending = False
+            self.ser.flushInput()
+            if metrics.enabled:
+                metrics.count('serial_resyncs_total')
+            if attempt == config.serialRetries or (retryUntil is not None and monotonicTime() + self.ser.timeout > retryUntil):
+                break
+            self.quality |= QUALITY_RETRIED
+            if metrics.enabled:
+                metrics.count('serial_retries_total')
+        # out of retries: even a short response made of whole words can't be trusted, as the missing
+        #   bytes may have come from anywhere in it and there's no telling which reading is which
+        return [-999999] * numChannels
+
+    def Disconnect(self, exception):
+        print "Lost the serial port %s (%s), will keep trying to reopen it" % (self.portName, exception)
+        sys.stdout.flush()
+        try:
+            self.ser.close()
+        except self.serialErrors:
+            pass
+        self.requestPending = False
+        self.reconnectDelay = config.reconnectDelay
+        self.nextReconnect = monotonicTime() + self.reconnectDelay
+        if metrics.enabled:
+            metrics.count('serial_disconnects_total')
+
+    def Reconnect(self):
+        # try to reopen the port, backing off further after every failure; True once it's open again
+        if monotonicTime() < self.nextReconnect:
+            return False
+        try:
+            self.ser.open()
+            self.ser.flushInput()
+        except self.serialErrors:
+            try:
+                self.ser.close()
+            except self.serialErrors:
+                pass
+            self.reconnectDelay = min(2 * self.reconnectDelay, config.reconnectMaxDelay)
+            self.nextReconnect = monotonicTime() + self.reconnectDelay
+            return False
+        print "Reopened the serial port %s" % self.portName
+        sys.stdout.flush()
+        self.quality |= QUALITY_RECONNECTED
+        if metrics.enabled:
+            metrics.count('serial_reconnects_total')
+        return True
+
+    def ParseResponse(self, data, numChannels):
+        # the response is a big-endian 16 bit word per channel, highest channel first
+        #   returns the readings in channel order
+        words = numpy.frombuffer(data[:len(data) // 2 * 2], dtype='>u2')
+        reads = [-999999] * numChannels
+        reads[numChannels - len(words):] = words[::-1].tolist()
+        return reads
+
+class DeviceRegistry():
+
+    # maps the channel groups from Configuration.getDevices() onto a DataReader per module
+    #   with several modules, each gets its own thread and they all read the same scan at once,
+    #   so a scan takes as long as the slowest module rather than the sum of all of them
+    def __init__(self):
+        byName = dict((ch.name, ch) for ch in channels.Channels)
+        self.readers = []
+        assigned = set()
+        for portName, channelNames in config.getDevices():
+            for name in channelNames:
+                if name not in byName:
+                    raise ValueError("Device %s lists channel %s, which isn't defined in ChannelClass" % (portName, name))
+                if name in assigned:
+                    raise ValueError("Channel %s is listed on more than one device" % name)
+                assigned.add(name)
+            self.readers.append(DataReader(portName, [byName[name] for name in channelNames]))
+        for ch in channels.Channels:
+            if ch.name not in assigned:
+                print "Channel %s isn't on any device, it won't be read" % ch.name
+        # no point in the thread hand-off with a single module
+        self.threads = []
+        if len(self.readers) > 1:
+            for reader in self.readers:
+                thread = DeviceReaderThread(reader)
+                thread.start()
+                self.threads.append(thread)
+        # the least a scan of every module can take, the modules all going at once on their own threads
+        self.minScanTime = max([reader.minScanTime for reader in self.readers] or [0.0])
+
+    def DoOneIteration(self, curTime, retryUntil=None):
+        if not self.threads:
+            for reader in self.readers:
+                reader.DoOneIteration(curTime, retryUntil)
+        else:
+            # start every module on this scan, then wait for all of them so the scan comes out whole
+            for thread in self.threads:
+                thread.startScan(curTime, retryUntil)
+            for thread in self.threads:
+                thread.waitForScan()
+        # the scan's quality is the combination of how it went on every module
+        channels.ScanQuality = 0
+        for reader in self.readers:
+            channels.ScanQuality |= reader.quality
+
+    def BurstScan(self, retryUntil=None):
+        # an extra scan of every module for burst sampling (see SampleScheduler.waitForNextSlot)
+        #   returns None while any module is still scanning, otherwise when the first one could again
+        if not self.threads:
+            resumeTimes = [reader.BurstScan(retryUntil) for reader in self.readers]
+        else:
+            for thread in self.threads:
+                thread.startScan(None, retryUntil, burst=True)
+            for thread in self.threads:
+                thread.waitForScan()
+            resumeTimes = [thread.resumeAt for thread in self.threads]
+        if not resumeTimes or None in resumeTimes:
+            return None
+        return min(resumeTimes)
+
+    def close(self):
+        for thread in self.threads:
+            thread.stop()
+
+class DeviceReaderThread(Thread):
+
+    # runs one DataReader's scans on a thread of its own, one scan each time it is told to
+    def __init__(self, reader):
+        Thread.__init__(self)
+        self.daemon = True
+        self.reader = reader
+        self.go = Event()
+        self.done = Event()
+        self.curTime = None
+        self.retryUntil = None
+        self.burst = False
+        self.resumeAt = None
+        self.stopping = False
+        self.error = None
+
+    def startScan(self, curTime, retryUntil=None, burst=False):
+        self.curTime = curTime
+        self.retryUntil = retryUntil
+        self.burst = burst
+        self.done.clear()
+        self.go.set()
+
+    def waitForScan(self):
+        self.done.wait()
+        # pass any problem reading the module back to the sampling loop
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def stop(self):
+        self.stopping = True
+        self.go.set()
+
+    def run(self):
+        while True:
+            self.go.wait()
+            self.go.clear()
+            if self.stopping:
+                break
+            try:
+                if self.burst:
+                    self.resumeAt = self.reader.BurstScan(self.retryUntil)
+                else:
+                    self.reader.DoOneIteration(self.curTime, self.retryUntil)
+            except Exception as exception:
+                self.error = exception
+            self.done.set()
 
 class MainDataLooper():
 
-    def __init__(self, allDoneCallbackFunction, statusCallbackFunction, writeData):
+    def __init__(self, sinks, writeData, resumePath=None):
 
-        # initialize the callbacks based on arguments
-        self.allDoneCallbackFunction = allDoneCallbackFunction
-        self.statusCallbackFunction = statusCallbackFunction
+        # everything that gets told about the scans and the status (see AcquisitionSink)
+        self.sinks = list(sinks)
 
         # initialize the flag for whether or not we should actually write data
         self.writeData = writeData
 
         # tell all the channels to clear themselves for a fresh start
-        for ch in channels.Channels:
+        for ch in channels.AllChannels():
             ch.initData()
 
+        # or to pick up where an earlier run of the same test left off
+        self.resume = None
+        if resumePath is not None:
+            self.resume = resumeDataFile(resumePath)
+
         # initialize the flag that the GUI uses to force me to stop
         self.forceStop = False
 
-    def run(self):
+        # fresh metrics for this run, if they're being collected
+        metrics.reset()
+        metrics.enabled = config.collectMetrics
 
-        # set up file IO if we are actually writing data
-        if self.writeData:
+        # a fresh adaptive time step for this run, if it's in use
+        if config.adaptiveSampling:
+            config.adaptiveStepper = AdaptiveTimeStep(config.adaptiveMinStep, config.adaptiveMaxStep, config.adaptiveRateThresholds)
 
-            # instantiate the IO class, which will help with some formatting and file I/O operations
-            io = IOStuff()
+        # and fresh rules
+        config.ruleEngine = RuleEngine(config.rules)
 
-            # spew the header
-            io.issueHeaderString()
+        if config.burstSampling and config.burstReduction not in burstReductions:
+            raise ValueError("Configuration.burstReduction has to be one of %s" % ", ".join(burstReductions))
+        if config.burstSampling and not 0 <= config.burstTrimFraction < 0.5:
+            # trimming half or more from each end would leave nothing to average
+            raise ValueError("Configuration.burstTrimFraction has to be at least 0 and less than 0.5")
 
-        # instantiate the reader, passing in the channel class instance
-        reader = DataReader()
+    def run(self):
+
+        # set up file IO if we are actually writing data
+        #   the IO class handles the formatting and file I/O, and is just the first sink
+        sinks = list(self.sinks)
+        if self.writeData:
+            sinks.insert(0, IOStuff(self.resume))
+            if config.writeColumnarStore:
+                sinks.insert(1, ColumnarStore())
+        if config.liveStreamPort is not None:
+            import liveStream
+            sinks.append(liveStream.LiveStreamServer(config.liveStreamHost, config.liveStreamPort, config.liveStreamClientBuffer))
+        if config.collectMetrics and (config.metricsFileName is not None or config.metricsHttpPort is not None):
+            metricsPath = None
+            if config.metricsFileName is not None:
+                metricsPath = os.path.join(config.baseDir(), config.metricsFileName)
+            sinks.append(MetricsExporter(metricsPath, config.metricsFormat, config.metricsEverySeconds, config.metricsHttpHost, config.metricsHttpPort))
+
+        # spew the headers
+        for sink in sinks:
+            sink.onStart()
+
+        # instantiate the readers, one for each module listed in the configuration
+        reader = DeviceRegistry()
 
         # initialize the loop counter
         readerCount = 0
+        startOffset = 0.0
+        if self.resume is not None:
+            # a resumed test carries on counting, and its time base includes the time it was stopped for
+            readerCount = self.resume['readerCount']
+            if self.resume['wallTime'] is not None:
+                startOffset = self.resume['currentTime'] + max(0.0, time.time() - self.resume['wallTime'])
 
         # re-initialize the start time before we start doing real stuff
-        startTime = time.time()
+        #   the scheduler keeps the samples on the getTimeStep schedule, measured from right now
+        scheduler = SampleScheduler(config.getTimeStep, reader.minScanTime)
+        scheduler.start(startOffset)
 
         # infinite loop while we read and spew data
         while True:
             if self.forceStop: break
             readerCount += 1
-            # clear and add integer count, timestamp, time-secs, log(time-secs)
-            times = []
-            times.append(str(readerCount))
-            times.append(str(datetime.now()))
-            currentTime = time.time() - startTime
-            times.append(str(round(currentTime, 4)))
-            times.append(str(round(math.log(currentTime), 4)))
+            wallTime = time.time()
+            currentTime = scheduler.elapsed()
             # get the bits and processed values
-            reader.DoOneIteration(currentTime)
-            # send an update to the status callback
-            gobject.idle_add(self.statusCallbackFunction, 'Sampling: Sample count = %s, Current time = %s [s]' % (readerCount, currentTime))
-            # create string representations for each list (times are already strings...no need to cast)
-            if self.writeData: io.issueReportString(times)
-            # get a new time step value from the config routine
-            thisTimeStep = config.getTimeStep(currentTime)
-            # then pause for a moment
-            time.sleep(thisTimeStep)
-            # finally check the flag to see if we are done
+            if metrics.enabled:
+                started = monotonicTime()
+            reader.DoOneIteration(currentTime, scheduler.retryDeadline())
+            channels.ProcessDerived(currentTime)
+            if metrics.enabled:
+                handedOff = monotonicTime()
+                metrics.observe('scan_seconds', handedOff - started)
+                metrics.count('scans_total')
+            # check the rules against it
+            alarms = config.ruleEngine.evaluate(currentTime)
+            if metrics.enabled:
+                checked = monotonicTime()
+                metrics.observe('rules_seconds', checked - handedOff)
+                metrics.count('rule_hits_total', len(alarms))
+                handedOff = checked
+            # hand the sample off to be written and displayed
+            message = 'Sampling: Sample count = %s, Current time = %s [s], %s' % (readerCount, currentTime, scheduler.Summary())
+            for sink in sinks:
+                sink.onScan(readerCount, wallTime, currentTime)
+                for alarm in alarms:
+                    sink.onAlarm(alarm)
+                sink.onStatus(message)
+            if metrics.enabled:
+                metrics.observe('sinks_seconds', monotonicTime() - handedOff)
+            # check the flag to see if we are done, there's no need to wait out the slot then
             if not config.getContinueFlag(currentTime): break
-
-        gobject.idle_add(self.statusCallbackFunction, 'Sampling Complete: Sample count = %s, Final time = %s [s]' % (readerCount, currentTime))
-
-class InputWindow(gtk.Dialog):
-
-    def __init__(self):
-        gtk.Dialog.__init__(self)
-
-        # make sure we understand we are modal so we block
-        self.set_modal(True)
-
-        # initialization
-        self.set_title("Can I have some inputs?")
-        self.set_border_width(10)
-
-        # add all the entries, to keep things obvious we aren't doing a loop or anything
-        self.entry_name = gtk.Entry()
-        self.entry_name.set_text(info.name.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.name.label))
-        hbox.pack_start(self.entry_name)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_location = gtk.Entry()
-        self.entry_location.set_text(info.location.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.location.label))
-        hbox.pack_start(self.entry_location)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_date = gtk.Entry()
-        self.entry_date.set_text(info.date.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.date.label))
-        hbox.pack_start(self.entry_date)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_depth = gtk.Entry()
-        self.entry_depth.set_text(info.depth.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.depth.label))
-        hbox.pack_start(self.entry_depth)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_diameter = gtk.Entry()
-        self.entry_diameter.set_text(info.diameter.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.diameter.label))
-        hbox.pack_start(self.entry_diameter)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_loop = gtk.Entry()
-        self.entry_loop.set_text(info.loop.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.loop.label))
-        hbox.pack_start(self.entry_loop)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_grout = gtk.Entry()
-        self.entry_grout.set_text(info.grout.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.grout.label))
-        hbox.pack_start(self.entry_grout)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_cement = gtk.Entry()
-        self.entry_cement.set_text(info.cement.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.cement.label))
-        hbox.pack_start(self.entry_cement)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_swl = gtk.Entry()
-        self.entry_swl.set_text(info.swl.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.swl.label))
-        hbox.pack_start(self.entry_swl)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_tester = gtk.Entry()
-        self.entry_tester.set_text(info.tester.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.tester.label))
-        hbox.pack_start(self.entry_tester)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        self.entry_witness = gtk.Entry()
-        self.entry_witness.set_text(info.witness.value)
-        hbox = gtk.HBox(spacing=6)
-        hbox.pack_start(gtk.Label(info.witness.label))
-        hbox.pack_start(self.entry_witness)
-        self.vbox.pack_start(hbox, False, False, 0)
-
-        # add the response buttons here
-        self.add_button("OK", gtk.RESPONSE_OK)
-        self.add_button("Cancel", gtk.RESPONSE_CANCEL)
-
-        # show myself
-        self.show_all()
-
-class GUI(gtk.Window):
-
-    def __init__(self):
-        gtk.Window.__init__(self)
-        self.connect("destroy", self.onClose)
-
-        # GUI layout initialization
-        self.initLayout()
-
-        # center it on the screen
-        self.set_position(gtk.WIN_POS_CENTER)
-
-        # show the form
-        self.show_all()
-
-    def initLayout(self):
-
-        # initialization
-        self.set_title("Data Acquisition")
-        self.set_border_width(10)
-
-        # add snapshot reading outputs, a tree on the left and a plot on the right
-        self.liststore = gtk.ListStore(str, float, float, str)
-
-        # create the TreeView using liststore
-        self.treeview = gtk.TreeView(self.liststore)
-
-        # setup a row in the liststore for each channel
-        for ch in channels.Channels:
-            self.liststore.append([ch.name, float('nan'), float('nan'), ch.units])
-
-        # create a channel name column
-        self.tvcolumn = gtk.TreeViewColumn('Channel Name')
-        self.cell = gtk.CellRendererText()
-        self.tvcolumn.pack_start(self.cell, True)
-        self.tvcolumn.set_attributes(self.cell, text=0)
-
-        # create a channel bits column
-        self.tvcolumn1 = gtk.TreeViewColumn('Digital Bits')
-        self.cell1 = gtk.CellRendererText()
-        self.tvcolumn1.pack_start(self.cell1, True)
-        self.tvcolumn1.set_attributes(self.cell1, text=1)
-
-        # create a channel analog voltage column
-        self.tvcolumn2 = gtk.TreeViewColumn('Analog Voltage')
-        self.cell2 = gtk.CellRendererText()
-        self.tvcolumn2.pack_start(self.cell2, True)
-        self.tvcolumn2.set_attributes(self.cell2, text=2)
-
-        # create a channel analog voltage column
-        self.tvcolumn3 = gtk.TreeViewColumn('Value [units]')
-        self.cell3 = gtk.CellRendererText()
-        self.tvcolumn3.pack_start(self.cell3, True)
-        self.tvcolumn3.set_attributes(self.cell3, text=3)
-
-        # add columns to treeview
-        self.treeview.append_column(self.tvcolumn)
-        self.treeview.append_column(self.tvcolumn1)
-        self.treeview.append_column(self.tvcolumn2)
-        self.treeview.append_column(self.tvcolumn3)
-
-        # create the plot and add it also
-        self.plt = matplotlib.pyplot
-        self.fig = self.plt.figure()
-        self.ax = self.fig.add_subplot(1,1,1)
-        self.canvas = Canvas(self.fig)
-        self.ax.xaxis.grid(True)
-        self.ax.yaxis.grid(True)
-        self.ax.plot([0],[0])
-        self.canvas.set_size_request(600,400)
-
-        # create the hbox to hold this tree and the snapshot plot
-        hbox_plot = gtk.HBox(spacing=6)
-        hbox_plot.pack_start(self.treeview)
-        hbox_plot.pack_start(self.canvas)
-
-        # form buttons
-        self.btnEditInfo = gtk.Button(label = "Edit Info")
-        self.btnEditInfo.connect("clicked", self.onEdit)
-        self.btnRunTest = gtk.Button(label = "Start (test)")
-        self.btnRunTest.connect("clicked", self.onRunTest)
-        self.btnRun = gtk.Button(label = "Start (write data)")
-        self.btnRun.connect("clicked", self.onRun)
-        self.btnStop = gtk.Button(label = "Stop")
-        self.btnStop.connect("clicked", self.onStop)
-        self.btnStop.set_sensitive(False)
-        self.btnClose = gtk.Button(stock = gtk.STOCK_CLOSE)
-        self.btnClose.connect("clicked", self.onClose)
-        hbox_btns = gtk.HBox(spacing=6)
-        hbox_btns.pack_start(self.btnEditInfo)
-        hbox_btns.pack_start(self.btnRunTest)
-        hbox_btns.pack_start(self.btnRun)
-        hbox_btns.pack_start(self.btnStop)
-        hbox_btns.pack_start(self.btnClose)
-
-        # status bar
-        self.sbar = gtk.Statusbar()
-        self.context_id = self.sbar.get_context_id("Statusbar")
-        self.sbar.push(self.context_id, "Program has been initialized!")
-        self.sbar.show()
-        hbox_status = gtk.HBox(spacing=6)
-        hbox_status.pack_start(self.sbar)
-
-        # vbox to hold everything
-        vbox = gtk.VBox(spacing=6)
-        vbox.pack_start(hbox_plot, False, False, 0)
-        vbox.pack_start(hbox_btns, False, False, 0)
-        vbox.pack_start(hbox_status)
-
-        # store master container in the window
-        self.add(vbox)
-
-    def startThread(self, writeData = True):
-        # instantiate the main data acquisition class
-        self.DataAcquirer = MainDataLooper(gui.processIsComplete, gui.updateStatus, writeData)
-        # start the data acquisition as a separate (background) thread
-        Thread(target=self.DataAcquirer.run).start()
-
-    def onRunTest(self, widget):
-        for ch in channels.Channels:
-            self.ax.plot(ch.timeHistory, ch.valueHistory, label=ch.name)
-        self.startThread(writeData = False)
-        self.btnRun.set_sensitive(False)
-        self.btnRunTest.set_sensitive(False)
-        self.btnEditInfo.set_sensitive(False)
-        self.btnStop.set_sensitive(True)
-
-    def onRun(self, widget):
-        for ch in channels.Channels:
-            self.ax.plot(ch.timeHistory, ch.valueHistory, label=ch.name)
-        self.startThread()
-        self.btnRun.set_sensitive(False)
-        self.btnRunTest.set_sensitive(False)
-        self.btnEditInfo.set_sensitive(False)
-        self.btnStop.set_sensitive(True)
-
-    def onStop(self, widget):
-        self.DataAcquirer.forceStop = True
-        self.btnRun.set_sensitive(True)
-        self.btnRunTest.set_sensitive(True)
-        self.btnEditInfo.set_sensitive(True)
-        self.btnStop.set_sensitive(False)
-
-    def onClose(self, widget):
-        if hasattr(self, 'DataAcquirer'):
-            self.DataAcquirer.forceStop = True
-        gtk.main_quit()
-
-    def onEdit(self, widget):
-
-        # need to get project inputs first:
-        InputWin = InputWindow()
-
-        # this will block until the user clicks or destroys the form
-        retVal = InputWin.run()
-
-        # only continue if we surely got the OK response
-        if retVal == gtk.RESPONSE_OK:
-            # update the info class
-            info.name.set_val(InputWin.entry_name.get_text())
-            info.location.set_val(InputWin.entry_location.get_text())
-            info.date.set_val(InputWin.entry_date.get_text())
-            info.depth.set_val(InputWin.entry_depth.get_text())
-            info.diameter.set_val(InputWin.entry_diameter.get_text())
-            info.loop.set_val(InputWin.entry_loop.get_text())
-            info.grout.set_val(InputWin.entry_grout.get_text())
-            info.cement.set_val(InputWin.entry_cement.get_text())
-            info.swl.set_val(InputWin.entry_swl.get_text())
-            info.tester.set_val(InputWin.entry_tester.get_text())
-            info.witness.set_val(InputWin.entry_witness.get_text())
-            # update on the status bar
-            self.sbar.push(self.context_id, "Project information was updated!")
-
-        # of course we can destroy the window now
-        InputWin.destroy()
-
-    def updateTree(self):
-        bits = []
-        for ch in range(len(channels.Channels)):
-            bits.append(channels.Channels[ch].bits)
-            self.liststore[ch][1] = channels.Channels[ch].bits
-            self.liststore[ch][2] = channels.Channels[ch].volts
-            self.liststore[ch][3] = '%s %s' % (channels.Channels[ch].valueHistory[-1], channels.Channels[ch].units)
-
-    def updatePlot(self):
-        self.ax.clear()
-        for ch in channels.Channels:
-            if ch.plot:
-                self.ax.plot(ch.timeHistory, ch.valueHistory, label=ch.name)
-        self.ax.xaxis.grid(True)
-        self.ax.yaxis.grid(True)
-        self.plt.legend(loc='upper left')
-        self.canvas.draw()
-
-    def updateStatus(self, msg):
-        self.sbar.push(self.context_id, msg)
-        self.updateTree()
-        self.updatePlot()
-
-    def processIsComplete(self):
-        self.btnRun.set_sensitive(True)
-        self.btnRunTest.set_sensitive(True)
-        self.btnEditInfo.set_sensitive(True)
-        self.btnStop.set_sensitive(False)
-        # update on the status bar
-        self.sbar.push(self.context_id, "Data Acquisition Process Complete!")
+            # then pause until the next slot on the schedule, or in burst mode keep scanning until then
+            scheduler.waitForNextSlot(currentTime, reader.BurstScan if config.burstSampling else None)
+
+        # let the reader threads go, and tell the sinks we're done (the file makes sure everything is written)
+        reader.close()
+        print 'Scheduling: %s' % scheduler.Summary()
+        message = 'Sampling Complete: Sample count = %s, Final time = %s [s], %s' % (readerCount, currentTime, scheduler.Summary())
+        for sink in sinks:
+            sink.onComplete(message)
+
+class SampleScheduler():
+
+    # keeps sampling on a fixed grid of deadlines (start + step + step + ...) on the monotonic clock,
+    #   so the time spent reading and writing a sample doesn't push every later sample back
+    def __init__(self, getTimeStep, minBurstScanTime=0.0):
+        # minBurstScanTime: the least a burst scan can take, however quickly it comes back
+        self.getTimeStep = getTimeStep
+        self.minBurstScanTime = minBurstScanTime
+
+    def start(self, elapsedOffset=0.0):
+        # elapsedOffset: seconds already on the clock, for carrying on the time base of a resumed test
+        self.deadline = monotonicTime()
+        self.startTime = self.deadline - elapsedOffset
+        self.lastStep = None
+        # how long the slowest recent burst scan took (see fillSlot)
+        self.burstScanTime = self.minBurstScanTime
+        # overruns: slots we got to late, missedSlots: slots skipped entirely to get back on the grid
+        self.overruns = 0
+        self.missedSlots = 0
+        # running statistics of how late we woke up compared to the deadline, in seconds
+        self.jitterCount = 0
+        self.jitterMean = 0.0
+        self.jitterM2 = 0.0
+        self.jitterMax = 0.0
+        self.lastJitter = 0.0
+
+    def elapsed(self):
+        return monotonicTime() - self.startTime
+
+    def retryDeadline(self):
+        # a bad scan may be taken again until half way through its slot, so the rest still fits in;
+        #   until the first step is known only the number of retries limits it
+        if self.lastStep is None:
+            return None
+        return self.deadline + 0.5 * self.lastStep
+
+    def waitForNextSlot(self, currentTime, burstScan=None):
+        # the next deadline is one step (as of the sample just taken) further along the grid
+        #   burstScan: if given, called to take extra scans for as long as they fit in before the deadline
+        step = self.getTimeStep(currentTime)
+        self.lastStep = step
+        self.deadline += step
+        late = monotonicTime() - self.deadline
+        if late > 0:
+            # the work for this sample ran past the next deadline, so go again right away,
+            #   skipping any whole slots that have already gone by to get back onto the grid
+            self.overruns += 1
+            if metrics.enabled:
+                metrics.count('schedule_overruns_total')
+            if late >= step:
+                missed = int(late // step)
+                self.missedSlots += missed
+                self.deadline += missed * step
+                if metrics.enabled:
+                    metrics.count('missed_slots_total', missed)
+        else:
+            if burstScan is not None:
+                self.fillSlot(burstScan)
+            time.sleep(max(0.0, self.deadline - monotonicTime()))
+        self.recordJitter(monotonicTime() - self.deadline)
+        if metrics.enabled:
+            metrics.observe('schedule_jitter_seconds', self.lastJitter)
+
+    def fillSlot(self, burstScan):
+        # scan until the next one might not be done burstMargin before the deadline; a scan is assumed to
+        #   take as long as the slowest recent one, and a bad one isn't retried past that point either
+        stopAt = self.deadline - config.burstMargin
+        started = monotonicTime()
+        while started + self.burstScanTime < stopAt:
+            resumeAt = burstScan(stopAt)
+            finished = monotonicTime()
+            if resumeAt is not None:
+                # nothing can be scanned until then (the port is gone, or the burst is full), so sleep on it
+                time.sleep(max(0.0, min(resumeAt, self.deadline) - finished))
+                started = monotonicTime()
+                continue
+            if finished - started < self.minBurstScanTime:
+                # back sooner than the bytes could have crossed the wire (fake data), so don't spin
+                time.sleep(self.minBurstScanTime - (finished - started))
+                finished = monotonicTime()
+            self.burstScanTime = max(finished - started, 0.9 * self.burstScanTime)
+            started = finished
+
+    def recordJitter(self, jitter):
+        # Welford's running mean and variance
+        self.lastJitter = jitter
+        self.jitterCount += 1
+        delta = jitter - self.jitterMean
+        self.jitterMean += delta / self.jitterCount
+        self.jitterM2 += delta * (jitter - self.jitterMean)
+        self.jitterMax = max(self.jitterMax, jitter)
+
+    def jitterStdDev(self):
+        if self.jitterCount < 2:
+            return 0.0
+        return math.sqrt(self.jitterM2 / (self.jitterCount - 1))
+
+    def Summary(self):
+        return 'Overruns = %s, Missed slots = %s, Jitter mean/std/max = %.1f/%.1f/%.1f [ms]' % (
+            self.overruns, self.missedSlots, 1000 * self.jitterMean, 1000 * self.jitterStdDev(), 1000 * self.jitterMax)
 
 # instantiate the configuration globally, this is where most of the project-specific changes will go
 config = Configuration()
@@ -642,8 +2553,73 @@ info = InfoClass()
 # set up the channels
 channels = ChannelClass()
 
-# instantiate the GUI, it handles everything
-gui = GUI()
-
-# run
-gtk.main()
+# and the (normally switched off) instrumentation
+metrics = Metrics()
+
+def checkImportTime(budget):
+    # how long a fresh python takes to import the acquisition core, against a budget in seconds, so a field
+    #   laptop can start sampling right after boot; also flags anything heavy that shouldn't get loaded yet
+    #   the best of a few tries is what counts, the first one may also be waiting on the disk cache
+    script = ("import sys, time\n"
+              "started = time.time()\n"
+              "import dataAcquisition\n"
+              "print time.time() - started\n"
+              "print ' '.join(m for m in ('serial', 'gtk', 'matplotlib', 'pylab') if m in sys.modules)\n")
+    times = []
+    for attempt in range(3):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)))
+        lines = output.splitlines()
+        times.append(float(lines[0]))
+        heavy = lines[1].split() if len(lines) > 1 else []
+    print "Importing the acquisition core took %s ms (budget %.0f ms)" % (", ".join("%.0f" % (1000 * t) for t in times), 1000 * budget)
+    if heavy:
+        print "It also loaded %s, which should wait until they're needed" % ", ".join(heavy)
+    return 0 if min(times) <= budget and not heavy else 1
+
+def main(argv):
+
+    parser = argparse.ArgumentParser(description='Sample data from a BB electronics 232 SDA12 module')
+    parser.add_argument('--headless', action='store_true', help='run the sampling loop without the GUI')
+    parser.add_argument('--test', action='store_true', help="with --headless, sample but don't write a data file")
+    parser.add_argument('--status-every', type=float, default=60.0, help='with --headless, seconds between status lines')
+    parser.add_argument('--convert', nargs='+', metavar='RAWFILE', help='convert binary raw captures to csv and exit')
+    parser.add_argument('--channel-config', metavar='JSONFILE', help='load the channels from this file instead of ChannelClass')
+    parser.add_argument('--check-import-time', type=float, nargs='?', const=0.25, metavar='SECONDS',
+                        help='time how long a fresh python takes to import the acquisition core, and fail if over budget (default 0.25 s)')
+    parser.add_argument('--resume', metavar='DATAFILE', help='with --headless, carry on a test that stopped, appending to its data file')
+    args = parser.parse_args(argv)
+    if args.resume and (not args.headless or args.test):
+        parser.error('--resume needs --headless, and a data file to write to')
+
+    if args.check_import_time is not None:
+        return checkImportTime(args.check_import_time)
+
+    if args.channel_config:
+        channels.Load(args.channel_config)
+
+    # convert binary raw captures to csv files instead of sampling
+    if args.convert:
+        for rawPath in args.convert:
+            print "Wrote %s" % convertRawCapture(rawPath)
+        return 0
+
+    if not args.headless:
+        # the GUI handles everything, and only now do we pay for loading gtk and matplotlib
+        import dataAcquisitionGUI
+        dataAcquisitionGUI.main()
+        return 0
+
+    # run the loop right here, and let ctrl-c or a kill stop it cleanly (closing the data file)
+    looper = MainDataLooper([ConsoleSink(args.status_every)], writeData=not args.test, resumePath=args.resume)
+    def requestStop(signum, frame):
+        looper.forceStop = True
+    signal.signal(signal.SIGINT, requestStop)
+    signal.signal(signal.SIGTERM, requestStop)
+    looper.run()
+    return 0
+
+if __name__ == '__main__':
+    # run main() from the module as imported by name, so this and the GUI module share the same
+    #   config, info and channels instead of each getting their own copy of this file
+    import dataAcquisition
+    sys.exit(dataAcquisition.main(sys.argv[1:]))
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+
+# the GTK window for the data acquisition, a snapshot table and a live plot of the channels
+#   it subscribes to the sampling loop in dataAcquisition.py like any other sink
+
+# import the gtk libraries, initialize the threads to alert that this will be multithreaded
+import gtk, gobject
+gtk.gdk.threads_init()
+
+# for background threading we need to import the threading library
+from threading import Thread
+
+# (for the graphical plot you need python-matplotlib, it's loaded in GUI.initPlot once the window is up)
+
+from dataAcquisition import config, info, channels, metrics, monotonicTime, MainDataLooper, AcquisitionSink, LatestValueMailbox
+from channelDisplay import ChannelDisplay
+
+class GtkSink(AcquisitionSink):
+
+    # passes snapshots of the sampling loop's status over to the GTK main loop, which owns the window
+    #   they go through a mailbox the GUI checks on a timer, so however fast the sampling goes the
+    #   GUI redraws at most guiMaxRefreshRate times a second, and always with the newest scan
+    #   the last rule that fired stays on the end of the status message, so it can't be missed
+    def __init__(self):
+        self.mailbox = LatestValueMailbox()
+        self.alarm = None
+
+    def snapshot(self, message, complete):
+        rows = [ch.Snapshot() for ch in channels.AllChannels()]
+        if self.alarm is not None:
+            message += ' | %s' % self.alarm
+        self.mailbox.post((message, rows, complete))
+
+    def onStatus(self, message):
+        self.snapshot(message, False)
+
+    def onAlarm(self, message):
+        self.alarm = message
+
+    def onComplete(self, message):
+        self.snapshot(message, True)
+
+class InputWindow(gtk.Dialog):
+
+    def __init__(self):
+        gtk.Dialog.__init__(self)
+
+        # make sure we understand we are modal so we block
+        self.set_modal(True)
+
+        # initialization
+        self.set_title("Can I have some inputs?")
+        self.set_border_width(10)
+
+        # add all the entries, to keep things obvious we aren't doing a loop or anything
+        self.entry_name = gtk.Entry()
+        self.entry_name.set_text(info.name.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.name.label))
+        hbox.pack_start(self.entry_name)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_location = gtk.Entry()
+        self.entry_location.set_text(info.location.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.location.label))
+        hbox.pack_start(self.entry_location)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_date = gtk.Entry()
+        self.entry_date.set_text(info.date.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.date.label))
+        hbox.pack_start(self.entry_date)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_depth = gtk.Entry()
+        self.entry_depth.set_text(info.depth.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.depth.label))
+        hbox.pack_start(self.entry_depth)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_diameter = gtk.Entry()
+        self.entry_diameter.set_text(info.diameter.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.diameter.label))
+        hbox.pack_start(self.entry_diameter)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_loop = gtk.Entry()
+        self.entry_loop.set_text(info.loop.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.loop.label))
+        hbox.pack_start(self.entry_loop)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_grout = gtk.Entry()
+        self.entry_grout.set_text(info.grout.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.grout.label))
+        hbox.pack_start(self.entry_grout)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_cement = gtk.Entry()
+        self.entry_cement.set_text(info.cement.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.cement.label))
+        hbox.pack_start(self.entry_cement)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_swl = gtk.Entry()
+        self.entry_swl.set_text(info.swl.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.swl.label))
+        hbox.pack_start(self.entry_swl)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_tester = gtk.Entry()
+        self.entry_tester.set_text(info.tester.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.tester.label))
+        hbox.pack_start(self.entry_tester)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        self.entry_witness = gtk.Entry()
+        self.entry_witness.set_text(info.witness.value)
+        hbox = gtk.HBox(spacing=6)
+        hbox.pack_start(gtk.Label(info.witness.label))
+        hbox.pack_start(self.entry_witness)
+        self.vbox.pack_start(hbox, False, False, 0)
+
+        # add the response buttons here
+        self.add_button("OK", gtk.RESPONSE_OK)
+        self.add_button("Cancel", gtk.RESPONSE_CANCEL)
+
+        # show myself
+        self.show_all()
+
+class GUI(gtk.Window, ChannelDisplay):
+
+    def __init__(self):
+        gtk.Window.__init__(self)
+        self.connect("destroy", self.onClose)
+
+        # GUI layout initialization
+        self.initLayout()
+
+        # the timer that shows the sampling's progress (see pollUpdates), while there's one going
+        self.pollTimer = None
+
+        # center it on the screen
+        self.set_position(gtk.WIN_POS_CENTER)
+
+        # show the form
+        self.show_all()
+
+    def initLayout(self):
+
+        # initialization
+        self.set_title("Data Acquisition")
+        self.set_border_width(10)
+
+        # add snapshot reading outputs, a tree on the left and a plot on the right
+        self.liststore = gtk.ListStore(str, float, float, str, str)
+
+        # create the TreeView using liststore
+        self.treeview = gtk.TreeView(self.liststore)
+
+        # setup a row in the liststore for each channel, and remember what's in it
+        self.treeCache = []
+        for ch in channels.AllChannels():
+            self.liststore.append([ch.name, float('nan'), float('nan'), ch.units, ''])
+            self.treeCache.append((float('nan'), float('nan'), ch.units, ''))
+
+        # create a channel name column
+        self.tvcolumn = gtk.TreeViewColumn('Channel Name')
+        self.cell = gtk.CellRendererText()
+        self.tvcolumn.pack_start(self.cell, True)
+        self.tvcolumn.set_attributes(self.cell, text=0)
+
+        # create a channel bits column
+        self.tvcolumn1 = gtk.TreeViewColumn('Digital Bits')
+        self.cell1 = gtk.CellRendererText()
+        self.tvcolumn1.pack_start(self.cell1, True)
+        self.tvcolumn1.set_attributes(self.cell1, text=1)
+
+        # create a channel analog voltage column
+        self.tvcolumn2 = gtk.TreeViewColumn('Analog Voltage')
+        self.cell2 = gtk.CellRendererText()
+        self.tvcolumn2.pack_start(self.cell2, True)
+        self.tvcolumn2.set_attributes(self.cell2, text=2)
+
+        # create a channel analog voltage column
+        self.tvcolumn3 = gtk.TreeViewColumn('Value [units]')
+        self.cell3 = gtk.CellRendererText()
+        self.tvcolumn3.pack_start(self.cell3, True)
+        self.tvcolumn3.set_attributes(self.cell3, text=3)
+
+        # create a running statistics column
+        self.tvcolumn4 = gtk.TreeViewColumn('Statistics')
+        self.cell4 = gtk.CellRendererText()
+        self.tvcolumn4.pack_start(self.cell4, True)
+        self.tvcolumn4.set_attributes(self.cell4, text=4)
+
+        # add columns to treeview
+        self.treeview.append_column(self.tvcolumn)
+        self.treeview.append_column(self.tvcolumn1)
+        self.treeview.append_column(self.tvcolumn2)
+        self.treeview.append_column(self.tvcolumn3)
+        self.treeview.append_column(self.tvcolumn4)
+
+        # make room for the plot, which gets made (see initPlot) as soon as the window is up
+        self.canvas = None
+        self.plotHolder = gtk.VBox()
+        self.plotHolder.set_size_request(600,400)
+        gobject.idle_add(self.initPlot)
+
+        # create the hbox to hold this tree and the snapshot plot
+        hbox_plot = gtk.HBox(spacing=6)
+        hbox_plot.pack_start(self.treeview)
+        hbox_plot.pack_start(self.plotHolder)
+
+        # form buttons
+        self.btnEditInfo = gtk.Button(label = "Edit Info")
+        self.btnEditInfo.connect("clicked", self.onEdit)
+        self.btnRunTest = gtk.Button(label = "Start (test)")
+        self.btnRunTest.connect("clicked", self.onRunTest)
+        self.btnRun = gtk.Button(label = "Start (write data)")
+        self.btnRun.connect("clicked", self.onRun)
+        self.btnStop = gtk.Button(label = "Stop")
+        self.btnStop.connect("clicked", self.onStop)
+        self.btnStop.set_sensitive(False)
+        self.btnClose = gtk.Button(stock = gtk.STOCK_CLOSE)
+        self.btnClose.connect("clicked", self.onClose)
+        hbox_btns = gtk.HBox(spacing=6)
+        hbox_btns.pack_start(self.btnEditInfo)
+        hbox_btns.pack_start(self.btnRunTest)
+        hbox_btns.pack_start(self.btnRun)
+        hbox_btns.pack_start(self.btnStop)
+        hbox_btns.pack_start(self.btnClose)
+
+        # status bar
+        self.sbar = gtk.Statusbar()
+        self.context_id = self.sbar.get_context_id("Statusbar")
+        self.sbar.push(self.context_id, "Program has been initialized!")
+        self.sbar.show()
+        hbox_status = gtk.HBox(spacing=6)
+        hbox_status.pack_start(self.sbar)
+
+        # vbox to hold everything
+        vbox = gtk.VBox(spacing=6)
+        vbox.pack_start(hbox_plot, False, False, 0)
+        vbox.pack_start(hbox_btns, False, False, 0)
+        vbox.pack_start(hbox_status)
+
+        # store master container in the window
+        self.add(vbox)
+
+    def initPlot(self):
+        # matplotlib takes longer to load than everything else put together, so it waits until here
+        #   (an idle callback once the window is showing, or the first start, whichever comes first)
+        if self.canvas is not None:
+            return False
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg as Canvas
+        self.fig = Figure()
+        self.ax = self.fig.add_subplot(1,1,1)
+        self.canvas = Canvas(self.fig)
+        self.initPlotLines()
+        self.plotHolder.pack_start(self.canvas)
+        self.canvas.show()
+        return False
+
+    def startThread(self, writeData = True):
+        # instantiate the main data acquisition class
+        self.sink = GtkSink()
+        self.DataAcquirer = MainDataLooper([self.sink], writeData)
+        # start the data acquisition as a separate (background) thread
+        Thread(target=self.DataAcquirer.run).start()
+        # and check for something new to show a few times a second, with just the one timer: one left
+        #   over from a run that was stopped and hasn't finished yet would poll this run's sink too
+        if self.pollTimer is not None:
+            gobject.source_remove(self.pollTimer)
+        self.pollTimer = gobject.timeout_add(int(1000 / config.guiMaxRefreshRate), self.pollUpdates)
+
+    def pollUpdates(self):
+        # show the newest snapshot if there is one, and keep the timer going until sampling completes
+        arrived, snapshot = self.sink.mailbox.take()
+        if not arrived:
+            return True
+        message, rows, complete = snapshot
+        if self.sink.mailbox.dropped:
+            message += ' (%s of %s updates skipped)' % (self.sink.mailbox.dropped, self.sink.mailbox.posted)
+        if metrics.enabled:
+            started = monotonicTime()
+        self.updateStatus(message, rows)
+        if metrics.enabled:
+            metrics.observe('gui_update_seconds', monotonicTime() - started)
+            metrics.gauge('gui_updates_skipped', self.sink.mailbox.dropped)
+        if complete:
+            self.processIsComplete()
+            self.pollTimer = None
+            return False
+        return True
+
+    def onRunTest(self, widget):
+        self.initPlot()
+        self.initPlotLines()
+        self.startThread(writeData = False)
+        self.btnRun.set_sensitive(False)
+        self.btnRunTest.set_sensitive(False)
+        self.btnEditInfo.set_sensitive(False)
+        self.btnStop.set_sensitive(True)
+
+    def onRun(self, widget):
+        self.initPlot()
+        self.initPlotLines()
+        self.startThread()
+        self.btnRun.set_sensitive(False)
+        self.btnRunTest.set_sensitive(False)
+        self.btnEditInfo.set_sensitive(False)
+        self.btnStop.set_sensitive(True)
+
+    def onStop(self, widget):
+        self.DataAcquirer.forceStop = True
+        self.btnRun.set_sensitive(True)
+        self.btnRunTest.set_sensitive(True)
+        self.btnEditInfo.set_sensitive(True)
+        self.btnStop.set_sensitive(False)
+
+    def onClose(self, widget):
+        if hasattr(self, 'DataAcquirer'):
+            self.DataAcquirer.forceStop = True
+        gtk.main_quit()
+
+    def onEdit(self, widget):
+
+        # need to get project inputs first:
+        InputWin = InputWindow()
+
+        # this will block until the user clicks or destroys the form
+        retVal = InputWin.run()
+
+        # only continue if we surely got the OK response
+        if retVal == gtk.RESPONSE_OK:
+            # update the info class
+            info.name.set_val(InputWin.entry_name.get_text())
+            info.location.set_val(InputWin.entry_location.get_text())
+            info.date.set_val(InputWin.entry_date.get_text())
+            info.depth.set_val(InputWin.entry_depth.get_text())
+            info.diameter.set_val(InputWin.entry_diameter.get_text())
+            info.loop.set_val(InputWin.entry_loop.get_text())
+            info.grout.set_val(InputWin.entry_grout.get_text())
+            info.cement.set_val(InputWin.entry_cement.get_text())
+            info.swl.set_val(InputWin.entry_swl.get_text())
+            info.tester.set_val(InputWin.entry_tester.get_text())
+            info.witness.set_val(InputWin.entry_witness.get_text())
+            # update on the status bar
+            self.sbar.push(self.context_id, "Project information was updated!")
+
+        # of course we can destroy the window now
+        InputWin.destroy()
+
+    def updateStatus(self, msg, rows=None):
+        self.sbar.push(self.context_id, msg)
+        self.updateTree(rows)
+        if self.canvas is not None:
+            self.updatePlot()
+
+    def processIsComplete(self):
+        self.btnRun.set_sensitive(True)
+        self.btnRunTest.set_sensitive(True)
+        self.btnEditInfo.set_sensitive(True)
+        self.btnStop.set_sensitive(False)
+        # update on the status bar
+        self.sbar.push(self.context_id, "Data Acquisition Process Complete!")
+
+def main():
+    # instantiate the GUI, it handles everything
+    gui = GUI()
+
+    # run
+    gtk.main()
+
+if __name__ == '__main__':
+    main()
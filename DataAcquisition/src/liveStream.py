@@ -0,0 +1,290 @@
+#!/usr/bin/python
+
+# publishes every scan of a running test over TCP, so it can be watched from elsewhere without VNC
+#   turn it on with Configuration.liveStreamPort; any number of clients can connect, and each one
+#   gets its own bounded send buffer, so a slow or stuck client only ever loses its own frames and
+#   never holds up the sampling.  everything runs on one thread around select() (python 2 has no asyncio)
+#
+#   to watch a running test from the command line:
+#       python liveStream.py --host 192.168.1.20 --port 5050 --history 100
+#
+# frames, both ways, are a little-endian header of uint8 type and uint32 payload length, then the payload:
+#   HELLO    server -> client on connect, json: summary and the channel names and units, in scan order
+#   SCAN     server -> client every scan: uint32 count, float64 wall time, float64 seconds since starting,
+#            then float32 value per channel
+#   HISTORY_REQUEST  client -> server: uint32 number of recent samples wanted per channel
+#   HISTORY  server -> client: uint32 number of channels, then per channel: uint32 n, n float64 times, n float32 values
+
+# OS interaction library imports
+import os
+import socket
+import select
+import errno
+import fcntl
+import struct
+import json
+import argparse
+
+# for background threading we need to import the threading library
+from threading import Thread, Lock
+from collections import deque
+
+import numpy
+
+from dataAcquisition import info, channels, AcquisitionSink
+
+HELLO = 1
+SCAN = 2
+HISTORY_REQUEST = 3
+HISTORY = 4
+
+frameHeader = struct.Struct('<BI')
+
+def packFrame(frameType, payload):
+    return frameHeader.pack(frameType, len(payload)) + payload
+
+class StreamClient():
+
+    # the server's view of one connected client
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.outgoing = deque()
+        self.outgoingBytes = 0
+        self.incoming = ''
+        self.dropped = 0
+        # bytes queued and sent since connecting, and how far into them the latest history answer ends
+        self.queuedTotal = 0
+        self.sentTotal = 0
+        self.historyEnd = 0
+
+    def queue(self, frame, limit):
+        # refuse anything past the client's buffer limit, rather than let it grow without end
+        if self.outgoingBytes + len(frame) > limit:
+            self.dropped += 1
+            return
+        self.outgoing.append(frame)
+        self.outgoingBytes += len(frame)
+        self.queuedTotal += len(frame)
+
+    def historyPending(self):
+        return self.sentTotal < self.historyEnd
+
+class LiveStreamServer(AcquisitionSink):
+
+    def __init__(self, host, port, clientBufferBytes):
+        self.host = host
+        self.port = port
+        self.clientBufferBytes = clientBufferBytes
+        self.channelList = channels.AllChannels()
+        self.scanRecord = struct.Struct('<Idd%df' % len(self.channelList))
+        # scans are handed from the sampling thread to the server thread here, and a byte down the
+        #   wakeup pipe gets select() to notice
+        self.lock = Lock()
+        self.outbox = deque()
+        self.clients = []
+        self.running = False
+
+    def onStart(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(5)
+        self.listener.setblocking(False)
+        self.wakeRead, self.wakeWrite = os.pipe()
+        # never let a wakeup block the sampling thread
+        fcntl.fcntl(self.wakeWrite, fcntl.F_SETFL, fcntl.fcntl(self.wakeWrite, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.hello = packFrame(HELLO, json.dumps({
+            'summary': info.GetSummary(),
+            'channels': [{'name': ch.name, 'units': ch.units} for ch in self.channelList],
+        }))
+        self.running = True
+        self.thread = Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def onScan(self, readerCount, wallTime, currentTime):
+        # the only work done on the sampling thread: pack the frame and drop it in the outbox
+        frame = packFrame(SCAN, self.scanRecord.pack(readerCount, wallTime, currentTime, *[ch.value for ch in self.channelList]))
+        with self.lock:
+            self.outbox.append(frame)
+        self.wake()
+
+    def onComplete(self, message):
+        self.running = False
+        self.wake()
+        self.thread.join()
+
+    def wake(self):
+        try:
+            os.write(self.wakeWrite, 'x')
+        except OSError as exception:
+            # the pipe is full, which means the server already has a wakeup waiting
+            if exception.errno != errno.EAGAIN:
+                raise
+
+    def serve(self):
+        try:
+            while self.running:
+                writers = [c.sock for c in self.clients if c.outgoing]
+                readable, writable, _ = select.select([self.listener, self.wakeRead] + [c.sock for c in self.clients], writers, [], 1.0)
+                if self.wakeRead in readable:
+                    os.read(self.wakeRead, 4096)
+                    self.distribute()
+                if self.listener in readable:
+                    self.accept()
+                for client in list(self.clients):
+                    if client.sock in readable:
+                        self.receive(client)
+                    if client.sock in writable and client in self.clients:
+                        self.send(client)
+        finally:
+            for client in list(self.clients):
+                self.disconnect(client)
+            self.listener.close()
+            os.close(self.wakeRead)
+            os.close(self.wakeWrite)
+
+    def distribute(self):
+        with self.lock:
+            frames, self.outbox = self.outbox, deque()
+        for frame in frames:
+            for client in self.clients:
+                client.queue(frame, self.clientBufferBytes)
+
+    def accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(False)
+        client = StreamClient(sock, address)
+        client.queue(self.hello, self.clientBufferBytes + len(self.hello))
+        self.clients.append(client)
+
+    def disconnect(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+        client.sock.close()
+
+    def receive(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except socket.error:
+            data = ''
+        if not data:
+            self.disconnect(client)
+            return
+        client.incoming += data
+        while len(client.incoming) >= frameHeader.size:
+            frameType, length = frameHeader.unpack(client.incoming[:frameHeader.size])
+            if len(client.incoming) < frameHeader.size + length:
+                break
+            payload = client.incoming[frameHeader.size:frameHeader.size + length]
+            client.incoming = client.incoming[frameHeader.size + length:]
+            if frameType == HISTORY_REQUEST and length == 4:
+                # a catch-up answer can go past the buffer limit, the client asked for it, but only one at a
+                #   time: asking again before the last one has gone out gets nothing more
+                if client.historyPending():
+                    client.dropped += 1
+                    continue
+                history = self.historyFrame(struct.unpack('<I', payload)[0])
+                client.queue(history, self.clientBufferBytes + len(history))
+                client.historyEnd = client.queuedTotal
+
+    def send(self, client):
+        try:
+            while client.outgoing:
+                frame = client.outgoing[0]
+                sent = client.sock.send(frame)
+                client.outgoingBytes -= sent
+                client.sentTotal += sent
+                if sent < len(frame):
+                    client.outgoing[0] = frame[sent:]
+                    break
+                client.outgoing.popleft()
+        except socket.error as exception:
+            if exception.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.disconnect(client)
+
+    def historyFrame(self, numSamples):
+        # the latest samples from the channel ring buffers, copied out of them as they get appended to
+        parts = [struct.pack('<I', len(self.channelList))]
+        for ch in self.channelList:
+            count = ch.history.count
+            times, values = ch.history.copyRange(count - min(numSamples, count, ch.history.capacity - 1), count)
+            parts.append(struct.pack('<I', len(times)))
+            parts.append(times.astype('<f8').tostring())
+            parts.append(values.astype('<f4').tostring())
+        return packFrame(HISTORY, ''.join(parts))
+
+class LiveStreamClient():
+
+    # a minimal client, also handy as an example of reading the stream
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.buffer = ''
+        frameType, payload = self.readFrame()
+        self.hello = json.loads(payload)
+        self.numChannels = len(self.hello['channels'])
+        self.scanRecord = struct.Struct('<Idd%df' % self.numChannels)
+
+    def readFrame(self):
+        while True:
+            if len(self.buffer) >= frameHeader.size:
+                frameType, length = frameHeader.unpack(self.buffer[:frameHeader.size])
+                if len(self.buffer) >= frameHeader.size + length:
+                    payload = self.buffer[frameHeader.size:frameHeader.size + length]
+                    self.buffer = self.buffer[frameHeader.size + length:]
+                    return frameType, payload
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError('the server closed the connection')
+            self.buffer += data
+
+    def requestHistory(self, numSamples):
+        self.sock.sendall(packFrame(HISTORY_REQUEST, struct.pack('<I', numSamples)))
+
+    def decodeScan(self, payload):
+        # (count, wall time, seconds since starting, [value per channel])
+        fields = self.scanRecord.unpack(payload)
+        return fields[0], fields[1], fields[2], list(fields[3:])
+
+    def decodeHistory(self, payload):
+        # {channel name: (times, values)}
+        numChannels = struct.unpack('<I', payload[:4])[0]
+        offset = 4
+        history = {}
+        for i in range(numChannels):
+            n = struct.unpack('<I', payload[offset:offset + 4])[0]
+            offset += 4
+            times = numpy.frombuffer(payload[offset:offset + 8 * n], dtype='<f8')
+            offset += 8 * n
+            values = numpy.frombuffer(payload[offset:offset + 4 * n], dtype='<f4')
+            offset += 4 * n
+            history[self.hello['channels'][i]['name']] = (times, values)
+        return history
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Watch a running test from its live stream')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--history', type=int, default=0, help='first ask for this many recent samples per channel')
+    args = parser.parse_args()
+
+    client = LiveStreamClient(args.host, args.port)
+    names = [c['name'] for c in client.hello['channels']]
+    if args.history:
+        client.requestHistory(args.history)
+    try:
+        while True:
+            frameType, payload = client.readFrame()
+            if frameType == SCAN:
+                count, wallTime, elapsed, values = client.decodeScan(payload)
+                print "%s %10.3f  %s" % (count, elapsed, "  ".join("%s=%.3f" % nv for nv in zip(names, values)))
+            elif frameType == HISTORY:
+                for name, (times, values) in sorted(client.decodeHistory(payload).items()):
+                    print "history %s: %s samples" % (name, len(times))
+    except (KeyboardInterrupt, EOFError):
+        pass
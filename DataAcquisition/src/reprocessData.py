@@ -0,0 +1,134 @@
+#!/usr/bin/python
+
+# regenerates the Volts_* and Processed_* columns of recorded data-*.csv files from their Bits_* columns,
+#   using the conversions as they are defined in dataAcquisition.py now; for when a calibration gets
+#   corrected after the test.  the file is streamed through in chunks, which are converted on all cores
+#
+#       python reprocessData.py ~/dataAcq/data-20140101-120000.csv
+#       python reprocessData.py --jobs 4 --output fixed.csv data-20140101-120000.csv
+#       python reprocessData.py --channel-config corrected.json data-20140101-120000.csv
+
+# OS interaction library imports
+import os
+import argparse
+import multiprocessing
+from collections import deque
+from itertools import islice
+
+import numpy
+
+from dataAcquisition import channels
+
+# the number of leading columns that aren't channel data: count, timestamp, seconds, log(seconds)
+numTimeColumns = 4
+
+def readHeader(inFile):
+    # returns (the project summary lines, the column header line) and leaves the file at the first data row
+    summary = []
+    for line in inFile:
+        if line.startswith('ReadCount,'):
+            return summary, line
+        summary.append(line)
+    raise ValueError("%s doesn't have a ReadCount,... column header line" % inFile.name)
+
+def channelNamesFromHeader(headerLine):
+    # the channel names, in file order, from the Bits_<name> columns
+    return [column[len('Bits_'):] for column in headerLine.strip().split(',') if column.startswith('Bits_')]
+
+def chunks(inFile, chunkRows):
+    while True:
+        lines = list(islice(inFile, chunkRows))
+        if not lines:
+            break
+        yield lines
+
+def parseChunk(lines, numChannels):
+    # split a chunk of data rows into (time column strings, bits array, strings of any columns after the
+    #   processed values, like the quality flags); blank or cut-off rows are skipped
+    times = []
+    bits = []
+    extras = []
+    for line in lines:
+        fields = line.rstrip('\r\n').split(',')
+        if len(fields) < numTimeColumns + 3 * numChannels:
+            continue
+        times.append(fields[:numTimeColumns])
+        bits.append(fields[numTimeColumns:numTimeColumns + numChannels])
+        extras.append(fields[numTimeColumns + 3 * numChannels:])
+    return times, numpy.array(bits, dtype=numpy.float64).reshape(len(bits), numChannels), extras
+
+# the conversion functions for the file being worked on, set in each worker process by initWorker
+workerProcessors = None
+
+def initWorker(processors):
+    global workerProcessors
+    workerProcessors = processors
+
+def reprocessChunk(lines):
+    # convert one chunk and return it formatted the same way IOStuff writes it
+    times, bits, extras = parseChunk(lines, len(workerProcessors))
+    bits, volts, values = channels.convertBatch(bits, workerProcessors)
+    out = []
+    for i in range(len(times)):
+        s_time = ",".join(times[i])
+        s_bits = ",".join("%10.3f" % x for x in bits[i])
+        s_volts = ",".join("%10.3f" % x for x in volts[i])
+        s_vals = ",".join("%10.3f" % x for x in values[i])
+        out.append(",".join([s_time, s_bits, s_volts, s_vals] + extras[i]) + "\n")
+    return "".join(out)
+
+def processorsFor(channelNames):
+    # the current conversion for each recorded channel, by name; channels that no longer exist give nan
+    byName = dict((ch.name, ch.processor) for ch in channels.Channels)
+    missing = [name for name in channelNames if name not in byName]
+    if missing:
+        print "No conversion defined for %s, those columns will be nan" % ", ".join(missing)
+    return [byName.get(name, nanProcessor) for name in channelNames]
+
+def nanProcessor(volts):
+    return volts * float('nan')
+
+def reprocessFile(inPath, outPath, jobs, chunkRows):
+    with open(inPath, 'rb') as inFile:
+        summary, headerLine = readHeader(inFile)
+        processors = processorsFor(channelNamesFromHeader(headerLine))
+        with open(outPath, 'wb') as outFile:
+            outFile.write("".join(summary))
+            outFile.write(headerLine)
+            if jobs == 1:
+                initWorker(processors)
+                for lines in chunks(inFile, chunkRows):
+                    outFile.write(reprocessChunk(lines))
+                return
+            # keep only a couple of chunks per worker in flight, so memory stays bounded
+            #   however big the file is, and write the results back out in their original order
+            pool = multiprocessing.Pool(jobs, initWorker, (processors,))
+            try:
+                pending = deque()
+                for lines in chunks(inFile, chunkRows):
+                    pending.append(pool.apply_async(reprocessChunk, (lines,)))
+                    if len(pending) >= 2 * jobs:
+                        outFile.write(pending.popleft().get())
+                while pending:
+                    outFile.write(pending.popleft().get())
+            finally:
+                pool.terminate()
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Recalculate the volts and processed values of recorded data files')
+    parser.add_argument('files', nargs='+', help='data-*.csv files written by dataAcquisition.py')
+    parser.add_argument('--output', help='output file (only with a single input), default is <input>-reprocessed.csv')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='worker processes (default: all cores)')
+    parser.add_argument('--chunk-rows', type=int, default=20000, help='rows handed to a worker at a time')
+    parser.add_argument('--channel-config', help='take the conversions from this channel configuration file instead')
+    args = parser.parse_args()
+
+    if args.output and len(args.files) > 1:
+        parser.error('--output only works with a single input file')
+    if args.channel_config:
+        channels.Load(args.channel_config)
+    for inPath in args.files:
+        outPath = args.output or '%s-reprocessed.csv' % os.path.splitext(inPath)[0]
+        reprocessFile(inPath, outPath, max(1, args.jobs), args.chunk_rows)
+        print "Wrote %s" % outPath
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+# a stand-in for the BB electronics 232 SDA12 module, for testing without hardware
+#   it sits on the master side of a pseudo-terminal and answers !0RA<n> scan requests the way the
+#   module does, so the real DataReader (serial port, framing, parsing) can be pointed at the pty
+#
+#   run it on its own and put the port it prints into Configuration.getPortName():
+#       python sda12Simulator.py --baud 9600 --signal sine:2000:500:60 --signal ramp:100:2
+#   or start it from another script:
+#       sim = SimulatedSDA12(baudRate=9600); sim.start(); reader = DataReader(sim.portName)
+
+# OS interaction library imports
+import os
+import errno
+import pty
+import tty
+import select
+import argparse
+
+# general math and date/time based library imports
+import math
+import time
+import random
+
+# for background threading we need to import the threading library
+from threading import Thread
+
+class Signal():
+
+    # a channel's reading (in bits) as a function of the seconds since the simulator started
+    #   described by a string like 'sine:mean:amplitude:period', see the shapes below
+    def __init__(self, description):
+        parts = description.split(':')
+        self.shape = parts[0]
+        self.parameters = [float(x) for x in parts[1:]]
+        defaults = {
+            'constant': [2000.0],  # value
+            'sine': [2000.0, 500.0, 60.0],  # mean, amplitude, period [s]
+            'ramp': [0.0, 1.0],  # starting value, slope [bits/s]
+            'noise': [2000.0, 20.0],  # mean, standard deviation
+            'step': [1000.0, 3000.0, 10.0],  # value before, value after, time of the step [s]
+        }
+        if self.shape not in defaults:
+            raise ValueError("Unknown signal shape '%s', use one of: %s" % (self.shape, ", ".join(sorted(defaults))))
+        self.parameters += defaults[self.shape][len(self.parameters):]
+
+    def __call__(self, t):
+        p = self.parameters
+        if self.shape == 'constant':
+            value = p[0]
+        elif self.shape == 'sine':
+            value = p[0] + p[1] * math.sin(2 * math.pi * t / p[2])
+        elif self.shape == 'ramp':
+            value = p[0] + p[1] * t
+        elif self.shape == 'noise':
+            value = random.gauss(p[0], p[1])
+        else:
+            value = p[0] if t < p[2] else p[1]
+        # the reading goes out as one 16 bit word
+        return max(0, min(0xFFFF, int(round(value))))
+
+class SimulatedSDA12():
+
+    def __init__(self, baudRate=2400, latency=0.0, dropRate=0.0, signals=None, realTime=True):
+        # baudRate: the response is held back for as long as its bytes would take on a real line
+        #   (10 bits per byte), unless realTime is off, in which case it goes out as fast as possible
+        # latency: extra seconds before the module starts answering a request
+        # dropRate: probability that any one byte of a response is lost
+        # signals: one description per channel (see Signal), channels past the end repeat the last one
+        self.baudRate = baudRate
+        self.latency = latency
+        self.dropRate = dropRate
+        self.signals = [Signal(s) for s in (signals or ['sine'])]
+        self.realTime = realTime
+        self.running = False
+        # counters, for checking on what the reader actually saw
+        self.requests = 0
+        self.bytesSent = 0
+        self.bytesDropped = 0
+
+    def start(self):
+        # the reader opens portName, we talk through the master end
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.portName = os.ttyname(self.slave)
+        self.startTime = time.time()
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.portName
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def run(self):
+        pending = ''
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                pending += os.read(self.master, 256)
+            except OSError as exception:
+                # the other end went away, just wait for someone new to open it
+                if exception.errno == errno.EIO:
+                    time.sleep(0.05)
+                    continue
+                raise
+            # answer every complete request, anything else on the line is ignored like the module does
+            while True:
+                start = pending.find('!0RA')
+                if start < 0:
+                    pending = pending[-3:]
+                    break
+                if len(pending) < start + 5:
+                    pending = pending[start:]
+                    break
+                numChannels = ord(pending[start + 4]) - ord('0') + 1
+                pending = pending[start + 5:]
+                if numChannels > 0:
+                    self.respond(numChannels)
+
+    def respond(self, numChannels):
+        self.requests += 1
+        t = time.time() - self.startTime
+        # highest channel first, each as a big-endian word
+        response = []
+        for channel in reversed(range(numChannels)):
+            value = self.signals[min(channel, len(self.signals) - 1)](t)
+            response.append(chr(value >> 8))
+            response.append(chr(value & 0xFF))
+        if self.dropRate > 0:
+            kept = [b for b in response if random.random() >= self.dropRate]
+            self.bytesDropped += len(response) - len(kept)
+            response = kept
+        if self.realTime:
+            time.sleep(self.latency + len(response) * 10.0 / self.baudRate)
+        os.write(self.master, ''.join(response))
+        self.bytesSent += len(response)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Simulate an SDA12 module on a pseudo-terminal')
+    parser.add_argument('--baud', type=int, default=2400, help='line speed to emulate (default 2400)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each response starts')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability of losing each byte')
+    parser.add_argument('--signal', action='append', help='channel signal, repeat once per channel, e.g. sine:2000:500:60')
+    parser.add_argument('--fast', action='store_true', help="don't hold responses back to the baud rate")
+    parser.add_argument('--link', help='also make a symlink to the port here, e.g. /tmp/ttySDA12')
+    args = parser.parse_args()
+
+    sim = SimulatedSDA12(args.baud, args.latency, args.drop, args.signal, realTime=not args.fast)
+    portName = sim.start()
+    if args.link:
+        if os.path.lexists(args.link):
+            os.remove(args.link)
+        os.symlink(portName, args.link)
+    print "Simulated SDA12 listening on %s" % (args.link or portName)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    print "Answered %s requests, sent %s bytes, dropped %s" % (sim.requests, sim.bytesSent, sim.bytesDropped)
+    sim.stop()
+    if args.link and os.path.islink(args.link):
+        os.remove(args.link)